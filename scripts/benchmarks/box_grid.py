@@ -0,0 +1,79 @@
+# coding: utf-8
+
+""" Benchmark generating box orbit initial conditions on the equipotential
+    surface with one `scipy.optimize.minimize` call per direction (the old
+    implementation) vs. the batched root finding in `box_grid`: wall time
+    and the largest difference in radius.
+"""
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+import time
+
+# Third-party
+from astropy import log as logger
+import gary.potential as gp
+import numpy as np
+from scipy.optimize import minimize
+
+# Project
+from streammorphology import project_path
+from streammorphology.initialconditions import box_grid
+
+def box_grid_loop(E, potential, approx_num=1000, x0=1.):
+    """ The per-direction loop that `box_grid` used to run. """
+    w0 = box_grid(E, potential, approx_num=approx_num, x0=x0)
+    r0 = np.sqrt(np.sum(w0[:,:3]**2, axis=-1))
+    phi = np.arctan2(w0[:,1], w0[:,0])
+    theta = np.arccos(w0[:,2] / r0)
+
+    def func(r,phi,theta):
+        x = r[0]*np.cos(phi)*np.sin(theta)
+        y = r[0]*np.sin(phi)*np.sin(theta)
+        z = r[0]*np.cos(theta)
+        return (E - potential.value(np.array([[x,y,z]])))**2
+
+    t1 = time.time()
+    r = np.zeros_like(phi)
+    for i,p,t in zip(np.arange(len(phi)),phi,theta):
+        res = minimize(func, x0=[x0], method='powell', args=(p,t))
+        r[i] = res.x[0]
+
+    return r, r0, time.time()-t1
+
+def main(E, approx_nums, nloop):
+    potential = gp.load(os.path.join(project_path, 'potentials/triaxial-NFW.yml'))
+
+    for approx_num in approx_nums:
+        t1 = time.time()
+        w0 = box_grid(E, potential, approx_num=approx_num)
+        t_batch = time.time() - t1
+
+        dE = np.abs(potential.total_energy(w0[:,:3], w0[:,3:]) - E).max()
+        logger.info("approx_num={0}: {1} points, batched {2:.3f} s, max |dE| = {3:.1e}"
+                    .format(approx_num, len(w0), t_batch, dE))
+
+        if approx_num <= nloop:
+            r,r0,t_loop = box_grid_loop(E, potential, approx_num=approx_num)
+            logger.info("\tloop {0:.3f} s ({1:.0f}x slower), max |dr| = {2:.1e}"
+                        .format(t_loop, t_loop/t_batch, np.abs(r - r0).max()))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Define parser object
+    parser = ArgumentParser(description="")
+    parser.add_argument("-E", "--energy", dest="energy", default=-0.15, type=float,
+                        help="Energy of the equipotential surface.")
+    parser.add_argument("--approx-num", dest="approx_nums", default=[1000, 10000, 100000],
+                        type=int, nargs='+', help="Approximate numbers of grid points.")
+    parser.add_argument("--nloop", dest="nloop", default=10000, type=int,
+                        help="Only time the loop for grids up to this size.")
+
+    args = parser.parse_args()
+
+    main(E=args.energy, approx_nums=args.approx_nums, nloop=args.nloop)
@@ -0,0 +1,80 @@
+# coding: utf-8
+
+""" Benchmark the frequency analysis of the ensembles around the `three_orbits`
+    with SuperFreq on one orbit at a time vs. the batched NAFF in
+    `streammorphology.batchfreq`: wall time and the largest difference in
+    the frequencies and amplitudes.
+"""
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+import time
+
+# Third-party
+from astropy import log as logger
+import gary.integrate as gi
+import gary.potential as gp
+import numpy as np
+
+# Project
+from streammorphology import project_path, three_orbits
+from streammorphology.ensemble import create_ensemble, compute_all_freqs
+from streammorphology.util import estimate_dt_nsteps
+
+def main(n, nperiods, nsteps_per_period, hamming_p, nintvec, m_scale):
+    potential = gp.load(os.path.join(project_path, 'potentials/triaxial-NFW.yml'))
+
+    for name in sorted(three_orbits.keys()): # enforce same order
+        w0 = three_orbits[name]
+        dt,nsteps = estimate_dt_nsteps(w0.copy(), potential, nperiods, nsteps_per_period)
+        ew0 = create_ensemble(w0, potential, n=n, m_scale=m_scale)
+        t,ws = potential.integrate_orbit(ew0, dt=dt, nsteps=nsteps,
+                                         Integrator=gi.DOPRI853Integrator,
+                                         Integrator_kwargs=dict(atol=1E-11))
+
+        results = dict()
+        times = dict()
+        for batch in [False, True]:
+            t1 = time.time()
+            results[batch] = compute_all_freqs(t, ws, hamming_p=hamming_p,
+                                               nintvec=nintvec, batch=batch)
+            times[batch] = time.time() - t1
+
+        freqs,amps = results[False]
+        dfreqs = np.abs(results[True][0] / freqs - 1.)
+        damps = np.abs(results[True][1] / amps - 1.)
+        logger.info("{0} ({1} orbits, {2} steps): SuperFreq {3:.2f} s, batched {4:.2f} s ({5:.1f}x)"
+                    .format(name, ws.shape[1], len(t), times[False], times[True],
+                            times[False]/times[True]))
+        logger.info("\tmax. fractional difference: freqs {0:.1e}, amps {1:.1e}"
+                    .format(np.nanmax(dfreqs), np.nanmax(damps)))
+        logger.info("\torbits with NaN frequencies: {0} (SuperFreq), {1} (batched)"
+                    .format(np.any(np.isnan(freqs), axis=1).sum(),
+                            np.any(np.isnan(results[True][0]), axis=1).sum()))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Define parser object
+    parser = ArgumentParser(description="")
+    parser.add_argument("-n", dest="num", default=128, type=int,
+                        help="Number of orbits per ensemble")
+    parser.add_argument("-m", "--mass-scale", dest="mass", default=10000., type=float,
+                        help="Mass scale of ensemble.")
+    parser.add_argument("--nperiods", dest="nperiods", default=50, type=int,
+                        help="Number of orbital periods to integrate for.")
+    parser.add_argument("--nsteps-per-period", dest="nsteps_per_period", default=256, type=int,
+                        help="Number of steps per orbital period.")
+    parser.add_argument("-p", "--hamming-p", dest="hamming_p", default=1, type=int,
+                        help="Exponent of the Hanning filter.")
+    parser.add_argument("--nintvec", dest="nintvec", default=15, type=int,
+                        help="Maximum integer coefficient of frequency combinations.")
+
+    args = parser.parse_args()
+
+    main(n=args.num, nperiods=args.nperiods, nsteps_per_period=args.nsteps_per_period,
+         hamming_p=args.hamming_p, nintvec=args.nintvec, m_scale=args.mass)
@@ -0,0 +1,90 @@
+# coding: utf-8
+
+""" Benchmark the memory allocated (and time spent) per evaluation interval
+    when following an ensemble: the old way (a new output array from every
+    call to `ensemble_integrate` plus a copy between intervals) vs. integrating
+    in place into a preallocated buffer.
+
+    Memory is measured with `tracemalloc`, so this only counts allocations
+    made through Python / numpy (not the DOP853 workspace, which is allocated
+    in C once per call).
+"""
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+import time
+import tracemalloc
+
+# Third-party
+from astropy import log as logger
+import gary.potential as gp
+import numpy as np
+
+# Project
+from streammorphology import project_path, three_orbits
+from streammorphology.ensemble import create_ensemble
+from streammorphology.extern.fast_ensemble import ensemble_integrate
+
+def step_copy(potential, ww, dt, dstep):
+    www = ensemble_integrate(potential.c_instance, ww, dt, dstep, 0.)
+    return www.copy()
+
+def step_inplace(potential, ww, dt, dstep):
+    ensemble_integrate(potential.c_instance, ww, dt, dstep, 0., out=ww)
+    return ww
+
+def main(n, nsteps, neval, dt, m_scale):
+    potential = gp.load(os.path.join(project_path, 'potentials/triaxial-NFW.yml'))
+    dstep = nsteps // neval
+
+    for name in sorted(three_orbits.keys()): # enforce same order
+        ew0 = np.ascontiguousarray(create_ensemble(three_orbits[name], potential,
+                                                   n=n, m_scale=m_scale))
+
+        logger.info("{0} ({1} orbits, {2} evals of {3} steps):".format(name, len(ew0),
+                                                                       neval, dstep))
+        for func in [step_copy, step_inplace]:
+            ww = ew0.copy()
+            nbytes = 0
+            t = 0.
+
+            tracemalloc.start()
+            for i in range(1,neval):
+                # clearing the traces also resets the peak, so the peak after
+                #   the call is what was allocated during this eval
+                tracemalloc.clear_traces()
+                t1 = time.time()
+                ww = func(potential, ww, dt, dstep)
+                t += time.time() - t1
+                nbytes += tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            logger.info("\t{0}: {1:.2f} ms/eval, {2:.0f} bytes allocated/eval"
+                        .format(func.__name__, 1000.*t/(neval-1), nbytes/(neval-1)))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Define parser object
+    parser = ArgumentParser(description="")
+    parser.add_argument("--seed", dest="seed", default=42, type=int,
+                        help="Random number generator seed.")
+    parser.add_argument("-n", dest="num", default=1000, type=int,
+                        help="Number of orbits per ensemble")
+    parser.add_argument("-m", "--mass-scale", dest="mass", default=10000., type=float,
+                        help="Progenitor mass scale")
+    parser.add_argument("--nsteps", dest="nsteps", default=8192, type=int,
+                        help="Total number of steps to integrate for.")
+    parser.add_argument("--neval", dest="neval", default=128, type=int,
+                        help="Number of evaluation intervals.")
+    parser.add_argument("--dt", dest="dt", default=1., type=float,
+                        help="Timestep.")
+
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+
+    main(n=args.num, nsteps=args.nsteps, neval=args.neval, dt=args.dt, m_scale=args.mass)
@@ -0,0 +1,95 @@
+# coding: utf-8
+
+""" Benchmark sampling the ensembles around the `three_orbits` at `neval`
+    evaluation times: restarting the integrator for each interval (the old
+    `follow_ensemble` loop) vs. one uninterrupted integration with dense
+    output (`ensemble_integrate_dense`).
+"""
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+import time
+
+# Third-party
+from astropy import log as logger
+import gary.potential as gp
+import numpy as np
+
+# Project
+from streammorphology import project_path, three_orbits
+from streammorphology.ensemble import create_ensemble
+from streammorphology.extern.fast_ensemble import (ensemble_integrate,
+                                                   ensemble_integrate_independent,
+                                                   ensemble_integrate_dense)
+
+def restarted(potential, ew0, dt, idx, per_orbit_steps):
+    ww = ew0.copy()
+    ws = np.zeros((len(idx),) + ww.shape)
+    ws[0] = ww
+    for i in range(1,len(idx)):
+        dstep = idx[i] - idx[i-1]
+        if per_orbit_steps:
+            ensemble_integrate_independent(potential.c_instance, ww, dt, dstep, 0., out=ww)
+        else:
+            ensemble_integrate(potential.c_instance, ww, dt, dstep, 0., out=ww)
+        ws[i] = ww
+    return ws
+
+def dense(potential, ew0, dt, idx, per_orbit_steps):
+    return ensemble_integrate_dense(potential.c_instance, ew0, dt*idx.astype(float), dt0=dt,
+                                    per_orbit_steps=int(per_orbit_steps))
+
+def main(n, nsteps, neval, dt, m_scale):
+    potential = gp.load(os.path.join(project_path, 'potentials/triaxial-NFW.yml'))
+    idx = np.linspace(0, nsteps, neval).astype(int)
+
+    for name in sorted(three_orbits.keys()): # enforce same order
+        ew0 = np.ascontiguousarray(create_ensemble(three_orbits[name], potential,
+                                                   n=n, m_scale=m_scale))
+        E0 = potential.total_energy(ew0[:,:3], ew0[:,3:])
+
+        logger.info("{0} ({1} orbits, {2} evals over {3} steps):".format(name, len(ew0),
+                                                                        neval, nsteps))
+        for per_orbit_steps in [False, True]:
+            ws = dict()
+            for func in [restarted, dense]:
+                t1 = time.time()
+                ws[func.__name__] = func(potential, ew0, dt, idx, per_orbit_steps)
+                t = time.time() - t1
+
+                w = ws[func.__name__][-1]
+                E = potential.total_energy(w[:,:3], w[:,3:])
+                dE = np.abs((E - E0) / E0).max()
+                logger.info("\t{0} (per-orbit steps: {1}): {2:.3f} s, max. fractional "
+                            "energy error {3:.2e}".format(func.__name__, per_orbit_steps,
+                                                          t, dE))
+
+            dw = np.abs(ws['dense'] - ws['restarted']).max()
+            logger.info("\tmax. difference between samples: {0:.2e}".format(dw))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Define parser object
+    parser = ArgumentParser(description="")
+    parser.add_argument("--seed", dest="seed", default=42, type=int,
+                        help="Random number generator seed.")
+    parser.add_argument("-n", dest="num", default=1000, type=int,
+                        help="Number of orbits per ensemble")
+    parser.add_argument("-m", "--mass-scale", dest="mass", default=10000., type=float,
+                        help="Progenitor mass scale")
+    parser.add_argument("--nsteps", dest="nsteps", default=8192, type=int,
+                        help="Total number of steps to integrate for.")
+    parser.add_argument("--neval", dest="neval", default=128, type=int,
+                        help="Number of evaluation times.")
+    parser.add_argument("--dt", dest="dt", default=1., type=float,
+                        help="Timestep.")
+
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+
+    main(n=args.num, nsteps=args.nsteps, neval=args.neval, dt=args.dt, m_scale=args.mass)
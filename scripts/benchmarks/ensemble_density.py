@@ -0,0 +1,86 @@
+# coding: utf-8
+
+""" Benchmark the density estimators for `follow_ensemble` on the ensembles
+    around the `three_orbits` at a few times: wall time per evaluation and
+    the moments of the log-density compared to the cross-validated KDE
+    (`density_method='kde'`).
+"""
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+import time
+
+# Third-party
+from astropy import log as logger
+import gary.integrate as gi
+import gary.potential as gp
+import numpy as np
+from scipy.stats import skew, kurtosis
+
+# Project
+from streammorphology import project_path, three_orbits
+from streammorphology.ensemble import create_ensemble
+from streammorphology.ensemble.density import get_density_estimator
+from streammorphology.util import estimate_dt_nsteps
+
+_moments = [('mean',np.mean), ('median',np.median), ('skew',skew), ('kurtosis',kurtosis)]
+
+def main(n, nperiods, nsnapshots, m_scale, k):
+    potential = gp.load(os.path.join(project_path, 'potentials/triaxial-NFW.yml'))
+    methods = ['kde', 'knn', 'loo', 'scott']
+
+    for name in sorted(three_orbits.keys()): # enforce same order
+        w0 = three_orbits[name]
+        dt,nsteps = estimate_dt_nsteps(w0.copy(), potential, nperiods, 256)
+        ew0 = create_ensemble(w0, potential, n=n, m_scale=m_scale)
+        t,ws = potential.integrate_orbit(ew0, dt=dt, nsteps=nsteps,
+                                         Integrator=gi.DOPRI853Integrator,
+                                         Integrator_kwargs=dict(atol=1E-11))
+
+        logger.info("{0} ({1} orbits):".format(name, ws.shape[1]))
+        for ix in np.linspace(0, len(t)-1, nsnapshots).astype(int):
+            x = np.ascontiguousarray(ws[ix,:,:3])
+            logger.info("\tt = {0:.1f}".format(t[ix]))
+
+            moments = dict()
+            for method in methods:
+                kwargs = dict()
+                if method != 'kde' and k is not None:
+                    kwargs['k'] = k
+                estimator = get_density_estimator(method, **kwargs)
+
+                t1 = time.time()
+                ln_dens = estimator(x)
+                dt_eval = time.time() - t1
+
+                moments[method] = np.array([func(ln_dens) for _,func in _moments])
+                logger.info("\t\t{0:>5s}: {1:.3f} s, bandwidth {2:.4f}, moments of log-density {3}"
+                            .format(method, dt_eval, estimator.bandwidth, moments[method]))
+
+            for method in methods[1:]:
+                logger.info("\t\t{0:>5s} - kde: {1}".format(method, moments[method] - moments['kde']))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Define parser object
+    parser = ArgumentParser(description="")
+    parser.add_argument("-n", dest="num", default=1000, type=int,
+                        help="Number of orbits per ensemble")
+    parser.add_argument("-m", "--mass-scale", dest="mass", default=10000., type=float,
+                        help="Mass scale of ensemble.")
+    parser.add_argument("--nperiods", dest="nperiods", default=16, type=int,
+                        help="Number of orbital periods to integrate for.")
+    parser.add_argument("--nsnapshots", dest="nsnapshots", default=4, type=int,
+                        help="Number of times to evaluate the density at.")
+    parser.add_argument("-k", dest="k", default=None, type=int,
+                        help="Number of neighbors for the tree-based estimators.")
+
+    args = parser.parse_args()
+
+    main(n=args.num, nperiods=args.nperiods, nsnapshots=args.nsnapshots,
+         m_scale=args.mass, k=args.k)
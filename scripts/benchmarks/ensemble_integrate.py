@@ -0,0 +1,73 @@
+# coding: utf-8
+
+""" Benchmark integrating the ensembles around the `three_orbits` with one
+    shared DOP853 step size vs. a separate step size for each orbit (with
+    one or more threads).
+"""
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+import time
+
+# Third-party
+from astropy import log as logger
+import gary.potential as gp
+import numpy as np
+
+# Project
+from streammorphology import project_path, three_orbits
+from streammorphology.ensemble import create_ensemble
+from streammorphology.extern.fast_ensemble import ensemble_integrate, ensemble_integrate_independent
+
+def main(n, nsteps, dt, m_scale, nthreads):
+    potential = gp.load(os.path.join(project_path, 'potentials/triaxial-NFW.yml'))
+
+    for name in sorted(three_orbits.keys()): # enforce same order
+        ew0 = np.ascontiguousarray(create_ensemble(three_orbits[name], potential,
+                                                   n=n, m_scale=m_scale))
+        E0 = potential.total_energy(ew0[:,:3], ew0[:,3:])
+
+        logger.info("{0} ({1} orbits, {2} steps):".format(name, len(ew0), nsteps))
+        runs = [("ensemble_integrate", ensemble_integrate, dict()),
+                ("ensemble_integrate_independent", ensemble_integrate_independent, dict())]
+        if nthreads > 1:
+            runs.append(("ensemble_integrate_independent, {0} threads".format(nthreads),
+                         ensemble_integrate_independent, dict(nthreads=nthreads)))
+
+        for label,func,kwargs in runs:
+            t1 = time.time()
+            w = func(potential.c_instance, ew0, dt, nsteps, 0., **kwargs)
+            t = time.time() - t1
+
+            E = potential.total_energy(w[:,:3], w[:,3:])
+            dE = np.abs((E - E0) / E0).max()
+            logger.info("\t{0}: {1:.3f} s, max. fractional energy error {2:.2e}"
+                        .format(label, t, dE))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Define parser object
+    parser = ArgumentParser(description="")
+    parser.add_argument("--seed", dest="seed", default=42, type=int,
+                        help="Random number generator seed.")
+    parser.add_argument("-n", dest="num", default=1000, type=int,
+                        help="Number of orbits per ensemble")
+    parser.add_argument("-m", "--mass-scale", dest="mass", default=10000., type=float,
+                        help="Progenitor mass scale")
+    parser.add_argument("--nsteps", dest="nsteps", default=10000, type=int,
+                        help="Number of steps to integrate for.")
+    parser.add_argument("--dt", dest="dt", default=1., type=float,
+                        help="Timestep.")
+    parser.add_argument("--nthreads", dest="nthreads", default=1, type=int,
+                        help="Also time the per-orbit integration with this many threads.")
+
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+
+    main(n=args.num, nsteps=args.nsteps, dt=args.dt, m_scale=args.mass,
+         nthreads=args.nthreads)
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+""" Benchmark FreqVariance on the `three_orbits` with SuperFreq rerun in every
+    window vs. following the frequencies incrementally (`incremental=True`):
+    wall time and the largest difference in the frequencies and amplitudes.
+"""
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+import time
+
+# Third-party
+from astropy import log as logger
+import gary.potential as gp
+import numpy as np
+
+# Project
+from streammorphology import project_path, three_orbits
+from streammorphology.freqvar import FreqVariance
+
+def main(total_nperiods, window_width, window_stride, nsteps_per_period):
+    potential = gp.load(os.path.join(project_path, 'potentials/triaxial-NFW.yml'))
+    kwargs = dict(total_nperiods=total_nperiods, window_width=window_width,
+                  window_stride=window_stride, nsteps_per_period=nsteps_per_period)
+
+    for name in sorted(three_orbits.keys()): # enforce same order
+        w0 = three_orbits[name]
+
+        results = dict()
+        times = dict()
+        for incremental in [False, True]:
+            t1 = time.time()
+            results[incremental] = FreqVariance.run(w0.copy(), potential,
+                                                    incremental=incremental, **kwargs)
+            times[incremental] = time.time() - t1
+
+        if not results[False]['success'] or not results[True]['success']:
+            logger.info("{0}: failed (error codes {1}, {2})"
+                        .format(name, results[False]['error_code'], results[True]['error_code']))
+            continue
+
+        freqs = results[False]['freqs']
+        dfreqs = np.abs(results[True]['freqs'] / freqs - 1.)
+        damps = np.abs(results[True]['amps'] / results[False]['amps'] - 1.)
+        logger.info("{0} ({1} windows): SuperFreq {2:.2f} s, incremental {3:.2f} s ({4:.1f}x)"
+                    .format(name, len(freqs), times[False], times[True],
+                            times[False]/times[True]))
+        logger.info("\tmax. fractional difference: freqs {0:.1e}, amps {1:.1e}"
+                    .format(dfreqs.max(), damps.max()))
+        logger.info("\tstd. dev. of the frequencies over windows: {0} (SuperFreq), {1} (incremental)"
+                    .format(np.std(freqs, axis=0), np.std(results[True]['freqs'], axis=0)))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Define parser object
+    parser = ArgumentParser(description="")
+    parser.add_argument("--total-nperiods", dest="total_nperiods", default=128+64, type=int,
+                        help="Number of orbital periods to integrate for.")
+    parser.add_argument("--window-width", dest="window_width", default=128, type=int,
+                        help="Width of the window in orbital periods.")
+    parser.add_argument("--window-stride", dest="window_stride", default=1, type=int,
+                        help="Stride of the window in orbital periods.")
+    parser.add_argument("--nsteps-per-period", dest="nsteps_per_period", default=512, type=int,
+                        help="Number of steps per orbital period.")
+
+    args = parser.parse_args()
+
+    main(total_nperiods=args.total_nperiods, window_width=args.window_width,
+         window_stride=args.window_stride, nsteps_per_period=args.nsteps_per_period)
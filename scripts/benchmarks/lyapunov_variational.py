@@ -0,0 +1,67 @@
+# coding: utf-8
+
+""" Benchmark estimating the maximum Lyapunov exponent for the `three_orbits`
+    with offset orbits (`mle`) vs. integrating the variational equations
+    (`lyapunov_spectrum`): wall time and the MLE estimates.
+"""
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+import time
+
+# Third-party
+from astropy import log as logger
+import gary.potential as gp
+import numpy as np
+
+# Project
+from streammorphology import project_path, three_orbits
+from streammorphology.util import estimate_dt_nsteps
+from streammorphology.extern.fast_mle import mle, lyapunov_spectrum
+
+def main(nperiods, nsteps_per_period, noffset_orbits, nvectors):
+    potential = gp.load(os.path.join(project_path, 'potentials/triaxial-NFW.yml'))
+
+    for name in sorted(three_orbits.keys()): # enforce same order
+        w0 = three_orbits[name]
+        dt,nsteps = estimate_dt_nsteps(w0.copy(), potential, nperiods, nsteps_per_period)
+        logger.info("{0} (dt={1:.3f}, {2} steps):".format(name, dt, nsteps))
+
+        for d0 in [1E-5, 1E-8]:
+            t1 = time.time()
+            LEs,t,w = mle(w0.copy(), potential, dt=dt, nsteps=nsteps,
+                          d0=d0, noffset_orbits=noffset_orbits)
+            logger.info("\tmle, d0={0:.0e}, {1} offset orbits: {2:.2f} s, MLE = {3:.3e} (spread {4:.1e})"
+                        .format(d0, noffset_orbits, time.time()-t1, np.mean(LEs), np.ptp(LEs)))
+
+        for n in sorted(set([1, nvectors])):
+            t1 = time.time()
+            LEs,t,w = lyapunov_spectrum(w0.copy(), potential, dt=dt, nsteps=nsteps, nvectors=n)
+            logger.info("\tlyapunov_spectrum, {0} vectors: {1:.2f} s, MLE = {2:.3e}, sum = {3:.1e}"
+                        .format(n, time.time()-t1, LEs[0], LEs.sum()))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Define parser object
+    parser = ArgumentParser(description="")
+    parser.add_argument("--seed", dest="seed", default=42, type=int,
+                        help="Random number generator seed.")
+    parser.add_argument("--nperiods", dest="nperiods", default=250, type=int,
+                        help="Number of orbital periods to integrate for.")
+    parser.add_argument("--nsteps-per-period", dest="nsteps_per_period", default=512, type=int,
+                        help="Number of steps per orbital period.")
+    parser.add_argument("--noffset", dest="noffset_orbits", default=2, type=int,
+                        help="Number of offset orbits for mle().")
+    parser.add_argument("--nvectors", dest="nvectors", default=6, type=int,
+                        help="Number of tangent vectors for the full spectrum.")
+
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+
+    main(nperiods=args.nperiods, nsteps_per_period=args.nsteps_per_period,
+         noffset_orbits=args.noffset_orbits, nvectors=args.nvectors)
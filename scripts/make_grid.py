@@ -19,6 +19,7 @@ import numpy as np
 # Project
 from streammorphology import project_path
 import streammorphology.initialconditions as ic
+from streammorphology.refine import tree_filename
 
 def main(potential_name, E, ic_func, run_name=None, output_path=None, overwrite=False, plot=False, **kwargs):
     """ Calls one of the grid-making utility functions to generate a
@@ -51,6 +52,11 @@ def main(potential_name, E, ic_func, run_name=None, output_path=None, overwrite=
     if os.path.exists(w0path) and overwrite:
         os.remove(w0path)
 
+        # the refinement tree belongs to the old grid
+        tree_path = tree_filename(w0path)
+        if os.path.exists(tree_path):
+            os.remove(tree_path)
+
     if not os.path.exists(w0path):
         # initial conditions
         w0 = ic_func(E=E, potential=potential, **kwargs)
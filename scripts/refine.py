@@ -0,0 +1,78 @@
+# coding: utf-8
+
+"""
+Adaptively refine a grid of initial conditions in the x-z plane where a
+completed experiment (e.g., the frequency diffusion time from Freqmap, or
+the Lyapunov exponent from Lyapmap) has structure. The new orbits are
+appended to the initial conditions file, so re-running the experiment on
+the same path only runs the new orbits. For example::
+
+    python scripts/refine.py --path=output/freqmap/triaxial-NFW/E-0.140_tube_grid_xz/ \
+    -c Freqmap --threshold=0.5
+
+    python scripts/freqmap/freqmap.py --path=output/freqmap/triaxial-NFW/E-0.140_tube_grid_xz/ \
+    --config-filename=Freqmap.cfg
+
+"""
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import logging
+import sys
+
+# Third-party
+from astropy import log as logger
+
+# Project
+import streammorphology
+from streammorphology.refine import refine_experiment
+
+def main(path, class_name, config_name, threshold, max_generation, max_new):
+    ExperimentClass = getattr(streammorphology, class_name)
+
+    if config_name is None:
+        config_name = "{0}.cfg".format(class_name)
+
+    experiment = ExperimentClass.from_config(cache_path=path, config_filename=config_name)
+    nnew = refine_experiment(experiment, threshold=threshold,
+                             max_generation=max_generation, max_new=max_new)
+    logger.info("{0} new orbits".format(nnew))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    # Define parser object
+    parser = ArgumentParser(description="")
+    parser.add_argument("-v", "--verbose", action="store_true", dest="verbose",
+                        default=False, help="Be chatty! (default = False)")
+    parser.add_argument("-p", "--path", dest="path", required=True,
+                        help="Path to the experiment cache and initial conditions.")
+    parser.add_argument("-c", "--class", dest="class_name", required=True,
+                        help="Name of the experiment Class whose results are used "
+                             "to refine the grid, e.g., 'Freqmap' or 'Lyapmap'")
+    parser.add_argument("--cfg", dest="cfg_name", default=None, type=str,
+                        help="Name of the config file.")
+
+    parser.add_argument("--threshold", dest="threshold", required=True, type=float,
+                        help="Split cells whose map value differs from a neighbor's "
+                             "by more than this.")
+    parser.add_argument("--max-generation", dest="max_generation", default=4, type=int,
+                        help="Maximum number of times a cell can be split.")
+    parser.add_argument("--max-new", dest="max_new", default=None, type=int,
+                        help="Maximum number of new orbits.")
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    main(args.path, class_name=args.class_name, config_name=args.cfg_name,
+         threshold=args.threshold, max_generation=args.max_generation,
+         max_new=args.max_new)
+
+    sys.exit(0)
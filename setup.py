@@ -6,8 +6,12 @@ __author__ = "adrn <adrn@astro.columbia.edu>"
 
 # Standard library
 import os
+import shutil
+import tempfile
+from distutils.ccompiler import new_compiler, CompileError, LinkError
 from distutils.core import setup
 from distutils.extension import Extension
+from distutils.sysconfig import customize_compiler
 
 # Third-party
 import numpy as np
@@ -26,13 +30,57 @@ import gary
 gary_base_path = os.path.split(gary.__file__)[0]
 gary_incl_path = os.path.join(gary_base_path, "integrate", "cyintegrators", "dopri")
 
+# re-entrant integrator used by the multi-threaded kernels
+extern_src_path = os.path.join("streammorphology", "extern", "src")
+
+def has_openmp():
+    """
+    Whether the C compiler can build and link a program with ``-fopenmp``
+    (e.g., Apple's clang can't).
+    """
+    tmp_path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_path, "test_openmp.c")
+        with open(filename, "w") as f:
+            f.write("#include <omp.h>\n"
+                    "int main(void) { return omp_get_max_threads() < 1; }\n")
+
+        compiler = new_compiler()
+        customize_compiler(compiler)
+        try:
+            objects = compiler.compile([filename], output_dir=tmp_path,
+                                       extra_postargs=['-fopenmp'])
+            compiler.link_executable(objects, os.path.join(tmp_path, "test_openmp"),
+                                     extra_postargs=['-fopenmp'])
+        except (CompileError, LinkError):
+            return False
+        return True
+
+    finally:
+        shutil.rmtree(tmp_path)
+
+# OpenMP for the multi-threaded kernels: set STREAMMORPHOLOGY_OPENMP=0 or 1 to
+#   force it off or on, otherwise use it if the compiler supports it. Without
+#   OpenMP, the prange loops compile to serial loops and nthreads is ignored.
+use_openmp = os.environ.get("STREAMMORPHOLOGY_OPENMP")
+if use_openmp is None:
+    use_openmp = has_openmp()
+else:
+    use_openmp = use_openmp.lower() not in ["0", "false", "no", "off", ""]
+
+openmp_args = ['-fopenmp'] if use_openmp else []
+if not use_openmp:
+    print("Building without OpenMP -- the extensions will run single-threaded.")
+
 extensions = []
 
 mle = Extension("streammorphology.extern.*",
                 ["streammorphology/extern/*.pyx",
-                 os.path.join(gary_incl_path,"dop853.c")],
-                include_dirs=[numpy_incl_path, gary_incl_path, mac_incl_path],
-                extra_compile_args=['-std=c99'])
+                 os.path.join(gary_incl_path,"dop853.c"),
+                 os.path.join(extern_src_path,"dop853_ws.c")],
+                include_dirs=[numpy_incl_path, gary_incl_path, extern_src_path, mac_incl_path],
+                extra_compile_args=['-std=c99'] + openmp_args,
+                extra_link_args=openmp_args)
 extensions.append(mle)
 
 setup(
@@ -10,15 +10,18 @@ __author__ = "adrn <adrn@astro.columbia.edu>"
 import numpy as np
 from astropy import log as logger
 import gary.integrate as gi
-import gary.dynamics as gd
 from scipy.signal import argrelmin, argrelmax
 
 # Project
+from .util import estimate_dt_nsteps
 from .experimentrunner import OrbitGridExperiment
 
 __all__ = ['ApoPer']
 
 class ApoPer(OrbitGridExperiment):
+    # share the estimated periods with other experiments on the same grid
+    cache_periods = True
+
     # failure error codes
     error_codes = {
         1: "Failed to integrate orbit or estimate dt, nsteps.",
@@ -62,12 +65,16 @@ class ApoPer(OrbitGridExperiment):
 
         # get timestep and nsteps for integration
         try:
-            # integrate orbit
-            t,w = potential.integrate_orbit(w0.copy(), dt=0.2, nsteps=50000)
+            _,_,periods = estimate_dt_nsteps(w0.copy(), potential,
+                                             c['nperiods'], c['nsteps_per_period'],
+                                             periods=kwargs.get('periods'),
+                                             return_periods=True,
+                                             **cls.period_cache_params)
 
             # radial oscillations
-            r = np.sqrt(np.sum(w[:,0,:3]**2, axis=-1))
-            T = gd.peak_to_peak_period(t, r)
+            T = periods['T_r']
+            if np.isnan(T):
+                raise RuntimeError("Failed to find radial period.")
 
             # timestep from number of steps per period
             dt = float(T) / float(c['nsteps_per_period'])
@@ -78,6 +85,7 @@ class ApoPer(OrbitGridExperiment):
             result['success'] = False
             result['error_code'] = 1
             return result
+        result['_periods'] = periods
 
         # integrate orbit
         logger.debug("Integrating orbit with dt={0}, nsteps={1}".format(dt, nsteps))
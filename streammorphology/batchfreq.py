@@ -0,0 +1,218 @@
+# coding: utf-8
+
+""" Frequency analysis (NAFF) of many orbits at once. """
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Third-party
+import numpy as np
+from astropy import log as logger
+
+__all__ = ['batch_fundamental_frequencies']
+
+def _phases(omega, tau):
+    r"""
+    :math:`e^{-i\omega\tau}` for uniformly spaced ``tau`` and any shape of
+    ``omega``. With :math:`k = aB + b`, the phase at sample k is the product of
+    the phases at :math:`aB` and :math:`b`, so only about :math:`2\sqrt{n}`
+    complex exponentials need to be computed per frequency instead of n.
+    """
+    ntimes = len(tau)
+    dtau = (tau[-1] - tau[0]) / (ntimes - 1)
+    B = int(np.sqrt(ntimes)) + 1
+    na = -(-ntimes // B)
+
+    omega = np.asarray(omega)[...,None]
+    wa = np.exp(-1j*omega*(tau[0] + dtau*B*np.arange(na)))
+    wb = np.exp(-1j*omega*dtau*np.arange(B))
+    E = wa[...,:,None] * wb[...,None,:]
+    return E.reshape(omega.shape[:-1] + (na*B,))[...,:ntimes]
+
+def _refine_peaks(cf, tau, omega, T, niter):
+    r"""
+    Newton iterations towards the maximum of the magnitude of the filtered
+    transform, :math:`|\sum \chi f e^{-i\omega\tau}|^2`, for all of the
+    filtered time series ``cf`` at once. Returns the frequencies, the
+    transform at the peaks, and :math:`e^{-i\omega\tau}` at the peaks.
+    """
+    tau2 = tau**2
+    for i in range(niter):
+        e = cf * _phases(omega, tau)
+        F = e.sum(axis=-1)
+        dF = -1j*e.dot(tau)
+        d2F = -e.dot(tau2)
+
+        g1 = 2*np.real(np.conj(F)*dF)
+        g2 = 2*(np.abs(dF)**2 + np.real(np.conj(F)*d2F))
+
+        # only step if we are near a maximum, and never by more than the
+        #   width of the peak
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.where(g2 < 0, -g1/g2, 0.)
+        omega = omega + np.clip(delta, -0.5*np.pi/T, 0.5*np.pi/T)
+
+    E = _phases(omega, tau)
+    F = (cf * E).sum(axis=-1)
+    return omega, F, E
+
+def _find_terms(t, f, chi, nterms, niter):
+    r"""
+    Find the ``nterms`` strongest terms :math:`A e^{i\omega t}` in each of the
+    time series ``f`` (any shape, with time along the last axis) by iteratively
+    locating the peak of the filtered FFT, refining it, and subtracting the
+    term from the time series.
+    """
+    ntimes = f.shape[-1]
+    dt = (t[-1] - t[0]) / (ntimes - 1)
+    T = 0.5 * (t[-1] - t[0])
+    tau = t - t[0] - T
+    norm = chi.sum()
+
+    # zero-pad to a power of 2 for the FFT
+    nfft = 2**int(np.ceil(np.log2(ntimes)))
+    omega_fft = 2*np.pi*np.fft.fftfreq(nfft, d=dt)
+
+    f = f.copy()
+    f -= ((chi*f).sum(axis=-1) / norm)[...,None]
+
+    omegas = np.zeros(f.shape[:-1] + (nterms,))
+    amps = np.zeros(f.shape[:-1] + (nterms,))
+    for k in range(nterms):
+        # peak of the spectrum, interpolated between bins
+        cf = chi*f
+        P = np.abs(np.fft.fft(cf, n=nfft, axis=-1)).reshape(-1,nfft)
+        ix = P.argmax(axis=-1)
+        rows = np.arange(len(ix))
+        a,b,c = [np.log(P[rows,(ix+d) % nfft] + 1E-300).reshape(f.shape[:-1])
+                 for d in [-1,0,1]]
+        ix = ix.reshape(f.shape[:-1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = np.where(a - 2*b + c < 0, 0.5*(a - c)/(a - 2*b + c), 0.)
+        omega = omega_fft[ix] + np.clip(offset, -0.5, 0.5)*(omega_fft[1] - omega_fft[0])
+
+        omega,F,E = _refine_peaks(cf, tau, omega, T, niter=niter)
+        A = F / norm
+
+        omegas[...,k] = omega
+        amps[...,k] = np.abs(A)
+        f -= A[...,None] * np.conj(E)
+
+    return omegas, amps
+
+def _select_fundamentals(omegas, amps, nintvec, min_freq, min_freq_diff, min_amp_ratio):
+    """
+    For each orbit, choose one fundamental frequency per component: the
+    strongest term in the component that isn't an integer combination (with
+    coefficients up to ``nintvec``) of the fundamental frequencies of the
+    preceding components.
+    """
+    norbits,ncomp,nterms = omegas.shape
+    freqs = np.zeros((norbits,ncomp)) + np.nan
+    famps = np.zeros((norbits,ncomp)) + np.nan
+
+    # terms that are left over from subtracting stronger terms
+    min_amp = min_amp_ratio * amps.reshape(norbits,-1).max(axis=-1)
+
+    n = np.arange(-nintvec, nintvec+1)
+    for j in range(ncomp):
+        valid = (np.abs(omegas[:,j]) > min_freq) & (amps[:,j] > min_amp[:,None])
+
+        if j > 0:
+            # all integer combinations of the fundamentals found so far
+            intvecs = np.array(np.meshgrid(*([n]*j), indexing='ij')).reshape(j,-1)
+            combos = freqs[:,:j].dot(intvecs)
+            dist = np.abs(omegas[:,j,:,None] - combos[:,None,:]).min(axis=-1)
+            valid &= dist > min_freq_diff
+
+        A = np.where(valid, amps[:,j], -1.)
+        ix = A.argmax(axis=-1)
+        ok = valid[np.arange(norbits),ix]
+        freqs[ok,j] = omegas[ok,j,ix[ok]]
+        famps[ok,j] = amps[ok,j,ix[ok]]
+
+    return freqs, famps
+
+def batch_fundamental_frequencies(t, fs, p=1, nintvec=10, nterms=8, niter=3,
+                                  min_freq=1E-6, min_freq_diff=None, min_amp_ratio=1E-6,
+                                  max_size=2**20):
+    r"""
+    Find the fundamental frequencies of many orbits at once with a simple
+    version of NAFF that is vectorized over orbits and components. This is
+    meant as a fast replacement for calling
+    :meth:`~superfreq.SuperFreq.find_fundamental_frequencies` on each orbit in
+    turn, e.g., for all orbits in an ensemble.
+
+    For each time series (an orbit component) the ``nterms`` strongest terms
+    :math:`A e^{i\omega t}` are found one at a time. Each term's frequency is the
+    peak of the FFT of the Hanning-filtered time series, interpolated between
+    bins and refined with Newton iterations on the magnitude of the filtered
+    transform. The term is then subtracted from the time series. Unlike
+    SuperFreq, the terms aren't orthogonalized against each other.
+
+    The fundamental frequency of each component is the strongest term in
+    that component that isn't an integer combination of the fundamental
+    frequencies of the preceding components. Frequencies are NaN if no such
+    term was found.
+
+    Parameters
+    ----------
+    t : array_like
+        Uniformly sampled times, shape ``(ntimes,)``.
+    fs : array_like
+        Complex time series, shape ``(norbits, ncomponents, ntimes)``, e.g.,
+        :math:`x + i v_x` for each coordinate.
+    p : int (optional)
+        Exponent of the Hanning filter.
+    nintvec : int (optional)
+        Maximum integer coefficient of the combinations of frequencies.
+    nterms : int (optional)
+        Number of terms to find in each component.
+    niter : int (optional)
+        Number of Newton iterations per term.
+    min_freq : numeric (optional)
+        Ignore terms with frequencies smaller than this.
+    min_freq_diff : numeric (optional)
+        Terms within this distance of a combination of the fundamental
+        frequencies are considered combinations. Defaults to 1% of the width
+        of the peaks, :math:`\pi/T`, for the half-length of the time series
+        :math:`T`, since the frequencies are only exact to ~1E-6 for ``p=1``.
+    min_amp_ratio : numeric (optional)
+        Ignore terms with amplitudes smaller than this fraction of the largest
+        amplitude in the orbit -- these are mostly residuals of the
+        subtraction of stronger terms.
+    max_size : int (optional)
+        Maximum number of samples (orbits x components x times) to process at
+        once, to limit memory use.
+
+    Returns
+    -------
+    freqs : :class:`numpy.ndarray`
+        Fundamental frequencies, shape ``(norbits, ncomponents)``.
+    amps : :class:`numpy.ndarray`
+        Amplitudes of the fundamental frequencies.
+    """
+    t = np.asarray(t)
+    fs = np.asarray(fs)
+    norbits,ncomp,ntimes = fs.shape
+
+    T = 0.5 * (t[-1] - t[0])
+    tau = t - t[0] - T
+    chi = (1. + np.cos(np.pi*tau/T))**p
+    if min_freq_diff is None:
+        min_freq_diff = 0.01 * np.pi / T
+
+    chunk = max(int(max_size // (ncomp*ntimes)), 1)
+    logger.debug("Finding {0} terms in {1} components of {2} orbits, {3} orbits at a time"
+                 .format(nterms, ncomp, norbits, chunk))
+
+    omegas = np.zeros((norbits,ncomp,nterms))
+    amps = np.zeros((norbits,ncomp,nterms))
+    for i1 in range(0, norbits, chunk):
+        sl = slice(i1, i1+chunk)
+        omegas[sl],amps[sl] = _find_terms(t, fs[sl], chi, nterms=nterms, niter=niter)
+
+    return _select_fundamentals(omegas, amps, nintvec=nintvec,
+                                min_freq=min_freq, min_freq_diff=min_freq_diff,
+                                min_amp_ratio=min_amp_ratio)
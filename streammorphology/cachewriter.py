@@ -0,0 +1,194 @@
+# coding: utf-8
+
+""" Buffered writer for the memmap'd experiment cache files. """
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+import time
+
+# Third-party
+import numpy as np
+from astropy import log as logger
+
+__all__ = ['BufferedCacheWriter']
+
+class BufferedCacheWriter(object):
+    """
+    Accumulate single-orbit results in an in-memory staging buffer and
+    periodically flush them to a long-lived memmap of the cache file.
+
+    Every result is also appended to an on-disk journal before it is
+    staged, so that if the master process dies with unflushed results in
+    the buffer, they are replayed into the cache the next time a writer
+    is opened on the same file. The journal is truncated after each
+    successful flush.
+
+    Parameters
+    ----------
+    cache_file : str
+        Path to the (already existing) memmap'd cache file.
+    dtype : list, :class:`numpy.dtype`
+        The structured dtype of the cache file.
+    norbits : int
+        Number of rows (orbits) in the cache file.
+    buffer_size : int (optional)
+        Flush once this many results have been staged.
+    flush_interval : numeric (optional)
+        Flush if more than this many seconds have passed since the last
+        flush.
+    journal_file : str (optional)
+        Path to the journal file. Defaults to the cache filename with
+        ``.journal`` appended.
+    """
+
+    def __init__(self, cache_file, dtype, norbits, buffer_size=1024,
+                 flush_interval=60., journal_file=None):
+        self.cache_file = os.path.abspath(cache_file)
+        self.dtype = np.dtype(dtype)
+        self.norbits = int(norbits)
+        self.buffer_size = int(buffer_size)
+        self.flush_interval = float(flush_interval)
+
+        if journal_file is None:
+            journal_file = "{0}.journal".format(self.cache_file)
+        self.journal_file = journal_file
+
+        # one journal record is the row index followed by the row itself
+        self._journal_dtype = np.dtype([('index','i8'), ('row',self.dtype)])
+
+        # staging buffer
+        self._rows = np.zeros(self.buffer_size, dtype=self.dtype)
+        self._index = np.zeros(self.buffer_size, dtype=np.int64)
+        self._nbuffered = 0
+
+        self._memmap = np.memmap(self.cache_file, mode='r+',
+                                 dtype=self.dtype, shape=(self.norbits,))
+
+        # replay anything left over from a previous run that died
+        self.recover()
+
+        self._journal = open(self.journal_file, 'ab')
+        self._last_flush = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._memmap is None
+
+    def recover(self):
+        """
+        Replay any records in the journal into the cache file. Returns the
+        number of records recovered.
+        """
+        if not os.path.exists(self.journal_file):
+            return 0
+
+        # drop a partially written trailing record, if any
+        nbytes = os.path.getsize(self.journal_file)
+        nrecords = nbytes // self._journal_dtype.itemsize
+        records = np.fromfile(self.journal_file, dtype=self._journal_dtype,
+                              count=nrecords)
+
+        if nrecords > 0:
+            logger.info("Recovering {0} unflushed results from journal {1}"
+                        .format(nrecords, self.journal_file))
+            self._memmap[records['index']] = records['row']
+            self._memmap.flush()
+
+        os.remove(self.journal_file)
+        return nrecords
+
+    def write(self, result):
+        """
+        Stage a single result dictionary (must contain the key ``'index'``).
+        Only keys that are also columns of the cache are written; any other
+        columns keep their current values (e.g., an error result only
+        updates the columns it sets).
+        """
+        if self.closed:
+            raise ValueError("Writer has already been closed.")
+
+        index = result['index']
+        record = np.zeros(1, dtype=self._journal_dtype)
+        record['index'] = index
+
+        # start from the current row -- the latest staged one, if any
+        staged = np.where(self._index[:self._nbuffered] == index)[0]
+        if len(staged) > 0:
+            record['row'] = self._rows[staged[-1]]
+        else:
+            record['row'] = self._memmap[index]
+
+        for key in self.dtype.names:
+            if key in result:
+                record['row'][key] = result[key]
+
+        # journal first, so the result survives a crash before the flush
+        self._journal.write(record.tobytes())
+        self._journal.flush()
+
+        self._rows[self._nbuffered] = record['row'][0]
+        self._index[self._nbuffered] = record['index'][0]
+        self._nbuffered += 1
+
+        if (self._nbuffered >= self.buffer_size or
+                (time.time() - self._last_flush) > self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write all staged results to the cache file, one slice assignment
+        per contiguous run of orbit indices, then truncate the journal.
+        """
+        if self.closed:
+            return
+
+        n = self._nbuffered
+        if n > 0:
+            # sort by index and split into contiguous runs -- if the same
+            #   index was written twice, the later result wins
+            order = np.argsort(self._index[:n], kind='mergesort')
+            index = self._index[:n][order]
+            rows = self._rows[:n][order]
+
+            keep = np.append(index[1:] != index[:-1], True)
+            index = index[keep]
+            rows = rows[keep]
+
+            breaks = np.where(np.diff(index) != 1)[0] + 1
+            for i1,i2 in zip(np.append(0, breaks), np.append(breaks, len(index))):
+                self._memmap[index[i1]:index[i2-1]+1] = rows[i1:i2]
+
+            self._memmap.flush()
+            logger.debug("Flushed {0} results ({1} contiguous blocks) to {2}"
+                         .format(n, len(breaks)+1, self.cache_file))
+
+        # everything in the journal is now safely in the cache
+        self._journal.seek(0)
+        self._journal.truncate()
+        self._nbuffered = 0
+        self._last_flush = time.time()
+
+    def close(self):
+        """
+        Flush any staged results, release the memmap, and remove the journal.
+        """
+        if self.closed:
+            return
+
+        self.flush()
+        self._journal.close()
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+        del self._memmap
+        self._memmap = None
@@ -4,7 +4,12 @@ from __future__ import division, print_function
 
 __author__ = "adrn <adrn@astro.columbia.edu>"
 
+# Standard library
+import copy
+import sys
+
 # Third-party
+from astropy import log as logger
 import astropy.units as u
 from astropy.coordinates.angles import rotation_matrix
 import gary.coordinates as gc
@@ -12,9 +17,9 @@ import gary.integrate as gi
 import gary.dynamics as gd
 import numpy as np
 from scipy.signal import argrelmin, argrelmax
-from superfreq import SuperFreq
 
-from ..util import _validate_nd_array, estimate_dt_nsteps
+from ..batchfreq import batch_fundamental_frequencies
+from ..util import _validate_nd_array, estimate_dt_nsteps, superfreq_context
 
 __all__ = ['create_ensemble', 'nearest_pericenter', 'nearest_apocenter',
            'align_ensemble', 'prepare_parent_orbit', 'compute_align_matrix',
@@ -345,7 +350,8 @@ def align_ensemble(ws):
     new_w = np.vstack((new_x.T, new_v.T)).T
     return new_w
 
-def prepare_parent_orbit(w0, potential, nperiods, nsteps_per_period, min_pericenter=True):
+def prepare_parent_orbit(w0, potential, nperiods, nsteps_per_period, min_pericenter=True,
+                         periods=None, return_periods=False, **kwargs):
     """
 
     Parameters
@@ -360,12 +366,20 @@ def prepare_parent_orbit(w0, potential, nperiods, nsteps_per_period, min_pericen
         Number of steps to take per (max) orbital period.
     min_pericenter : bool (optional)
         Find the nearest *minimum* pericenter.
+    periods : :class:`numpy.void` (optional)
+        Previously estimated periods of the orbit -- see
+        :func:`~streammorphology.util.estimate_dt_nsteps`.
+    return_periods : bool (optional)
+        Also return the estimated periods.
+    **kwargs
+        Any other keyword arguments are passed to
+        :func:`~streammorphology.util.estimate_dt_nsteps`.
 
     """
 
-    dt,nsteps,T = estimate_dt_nsteps(w0, potential, nperiods, nsteps_per_period,
-                                     return_periods=True)
-    T = T.max()
+    dt,nsteps,periods = estimate_dt_nsteps(w0, potential, nperiods, nsteps_per_period,
+                                           periods=periods, return_periods=True, **kwargs)
+    T = np.nanmax(periods['T'])
 
     # get position of nearest pericenter
     if min_pericenter:
@@ -385,9 +399,85 @@ def prepare_parent_orbit(w0, potential, nperiods, nsteps_per_period, min_pericen
     except:
         final_apo_ix = apo_ix[nperiods-2]
 
+    if return_periods:
+        return peri_w0, dt, final_apo_ix, periods
     return peri_w0, dt, final_apo_ix
 
-def compute_all_freqs(t, ws, hamming_p=1, nintvec=10, force_cartesian=False):
+def _freqs_chunk(t, ws, orbit_ixs, circ, sf=None, hamming_p=1, nintvec=10,
+                 force_cartesian=False, batch=False):
+    """
+    Frequencies and amplitudes of the orbits ``orbit_ixs`` in ``ws`` -- the work
+    done by each worker of :func:`compute_all_freqs`.
+    """
+    is_tube = np.any(circ)
+    ndim = ws.shape[-1]//2
+
+    if batch:
+        all_fs = np.zeros((len(orbit_ixs),ndim,ws.shape[0]), dtype=complex)
+    elif sf is None:
+        # all orbits have the same times, so share the setup of the frequency analysis
+        sf = superfreq_context(t, p=hamming_p)
+
+    allfreqs = []
+    allamps = []
+    for n,i in enumerate(orbit_ixs):
+        ww = ws[:,i]
+        if is_tube and not force_cartesian:
+            # need to flip coordinates until circulation is around z axis
+            new_ws = gd.align_circulation_with_z(ww, circ)
+            new_ws = gc.cartesian_to_poincare_polar(new_ws)
+        else:
+            new_ws = ww
+
+        fs = [(new_ws[:,j] + 1j*new_ws[:,j+ndim]) for j in range(ndim)]
+        if batch:
+            all_fs[n] = fs
+            continue
+
+        try:
+            freqs,d,ixs = sf.find_fundamental_frequencies(fs, nintvec=nintvec)
+        except:
+            allfreqs.append([np.nan,np.nan,np.nan])
+            allamps.append([np.nan,np.nan,np.nan])
+            continue
+
+        allfreqs.append(freqs.tolist())
+        allamps.append(d['|A|'][ixs].tolist())
+
+    if batch:
+        return batch_fundamental_frequencies(t, all_fs, p=hamming_p, nintvec=nintvec)
+
+    allfreqs = np.array(allfreqs)
+    allamps = np.array(allamps)
+
+    return allfreqs, allamps
+
+# trajectories for the worker processes of compute_all_freqs() -- set before
+#   the workers are forked, so they inherit the arrays instead of receiving a
+#   pickled copy
+_freqs_shared = dict()
+
+def _freqs_worker(args):
+    orbit_ixs, kwargs = args
+    return _freqs_chunk(_freqs_shared['t'], _freqs_shared['ws'], orbit_ixs,
+                        _freqs_shared['circ'], **kwargs)
+
+def _mpi_initialized():
+    """
+    Whether this process is running under MPI (e.g., as a rank of an
+    ``MPIPool``), in which case it isn't safe to fork.
+    """
+    MPI = sys.modules.get('mpi4py.MPI')
+    if MPI is None:
+        return False
+
+    try:
+        return MPI.Is_initialized() and not MPI.Is_finalized()
+    except Exception:
+        return True
+
+def compute_all_freqs(t, ws, hamming_p=1, nintvec=10, force_cartesian=False, batch=False,
+                      nworkers=1, worker_type='thread'):
     """
     Compute the fundamental frequencies and amplitudes for all
     specified orbits.
@@ -397,6 +487,15 @@ def compute_all_freqs(t, ws, hamming_p=1, nintvec=10, force_cartesian=False):
     ``False``) if the first orbit is a tube orbit, it assumes all orbits
     are tubes.
 
+    With ``nworkers > 1``, the orbits are split into ``nworkers`` chunks that
+    are analyzed in parallel. Worker threads share ``ws``, but only run in
+    parallel where numpy releases the GIL. Worker processes are forked, so
+    they share the trajectories in ``ws`` with this process (copy-on-write)
+    and only the orbit indices and the resulting frequencies are sent
+    between processes. Forking after MPI has been initialized isn't safe
+    with many MPI implementations, so when running under MPI (e.g., in an
+    ``MPIPool``), threads are used instead.
+
     Parameters
     ----------
     t : array_like
@@ -404,6 +503,15 @@ def compute_all_freqs(t, ws, hamming_p=1, nintvec=10, force_cartesian=False):
     hamming_p : int (optional)
     nintvec : int (optional)
     force_cartesian : bool (optional)
+    batch : bool (optional)
+        Analyze all orbits at once with
+        :func:`~streammorphology.batchfreq.batch_fundamental_frequencies`
+        instead of running SuperFreq on each orbit.
+    nworkers : int (optional)
+        Number of worker processes or threads.
+    worker_type : str (optional)
+        Either ``'thread'`` or ``'process'``. Processes are not used under
+        MPI (see above).
 
     Returns
     -------
@@ -413,34 +521,65 @@ def compute_all_freqs(t, ws, hamming_p=1, nintvec=10, force_cartesian=False):
 
     # classify parent orbit
     circ = gd.classify_orbit(ws[:,0])
-    is_tube = np.any(circ)
 
-    allfreqs = []
-    allamps = []
-    for i in range(ws.shape[1]):
-        ww = ws[:,i]
-        if is_tube and not force_cartesian:
-            # need to flip coordinates until circulation is around z axis
-            new_ws = gd.align_circulation_with_z(ww, circ)
-            new_ws = gc.cartesian_to_poincare_polar(new_ws)
-        else:
-            new_ws = ww
+    kwargs = dict(hamming_p=hamming_p, nintvec=nintvec,
+                  force_cartesian=force_cartesian, batch=batch)
 
-        fs = [(new_ws[:,j] + 1j*new_ws[:,j+ws.shape[-1]//2]) for j in range(ws.shape[-1]//2)]
-        sf = SuperFreq(t, p=hamming_p)
+    norbits = ws.shape[1]
+    nworkers = min(int(nworkers), norbits)
+    if nworkers <= 1:
+        return _freqs_chunk(t, ws, range(norbits), circ, **kwargs)
 
+    if worker_type == 'process' and _mpi_initialized():
+        logger.warning("Can't fork worker processes under MPI -- using threads instead.")
+        worker_type = 'thread'
+
+    chunks = np.array_split(np.arange(norbits), nworkers)
+    logger.debug("Analyzing {0} orbits with {1} worker {2}s"
+                 .format(norbits, nworkers, worker_type))
+
+    if worker_type == 'thread':
+        from multiprocessing.pool import ThreadPool
+
+        # each thread gets its own copy of the (shared) SuperFreq instance
+        if not batch:
+            sf = superfreq_context(t, p=hamming_p)
+
+        def worker(ixs):
+            kw = kwargs.copy()
+            if not batch:
+                kw['sf'] = copy.copy(sf)
+            return _freqs_chunk(t, ws, ixs, circ, **kw)
+
+        pool = ThreadPool(nworkers)
         try:
-            freqs,d,ixs = sf.find_fundamental_frequencies(fs, nintvec=nintvec)
-        except:
-            allfreqs.append([np.nan,np.nan,np.nan])
-            allamps.append([np.nan,np.nan,np.nan])
-            continue
+            results = pool.map(worker, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    elif worker_type == 'process':
+        import multiprocessing
+        if hasattr(multiprocessing, 'get_context'):
+            # the workers have to be forked to inherit the trajectories
+            multiprocessing = multiprocessing.get_context('fork')
+
+        _freqs_shared.update(t=t, ws=ws, circ=circ)
+        try:
+            pool = multiprocessing.Pool(nworkers)
+            try:
+                results = pool.map(_freqs_worker, [(ixs,kwargs) for ixs in chunks])
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _freqs_shared.clear()
 
-        allfreqs.append(freqs.tolist())
-        allamps.append(d['|A|'][ixs].tolist())
+    else:
+        raise ValueError("Invalid worker type '{0}' -- must be 'process' or 'thread'."
+                         .format(worker_type))
 
-    allfreqs = np.array(allfreqs)
-    allamps = np.array(allamps)
+    allfreqs = np.vstack([r[0] for r in results])
+    allamps = np.vstack([r[1] for r in results])
 
     return allfreqs, allamps
-
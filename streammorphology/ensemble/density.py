@@ -0,0 +1,383 @@
+# coding: utf-8
+
+""" Estimators of the configuration-space density of an orbit ensemble. """
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+from functools import partial
+
+# Third-party
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.special import gammaln
+from astropy import log as logger
+
+__all__ = ['BandwidthSearch', 'KDEDensity', 'KNNDensity', 'NeighborKDEDensity', 'TreeKDEDensity',
+           'density_methods', 'get_density_estimator']
+
+def _logsumexp(a, axis=-1):
+    amax = a.max(axis=axis)
+    return amax + np.log(np.exp(a - np.expand_dims(amax, axis)).sum(axis=axis))
+
+class BandwidthSearch(object):
+    """
+    Search a grid of bandwidths for the best one, either from scratch or,
+    when ``track=True``, only in a bracket of ``track_width`` grid points to
+    either side of the previous best bandwidth. The full grid is searched
+    if the best bandwidth ends up at the edge of the bracket.
+
+    Parameters
+    ----------
+    bandwidths : array_like
+        Grid of bandwidths to search.
+    track : bool (optional)
+        Search around the previous best bandwidth.
+    track_width : int (optional)
+        Half-width of the bracket in grid points.
+    """
+    def __init__(self, bandwidths, track=False, track_width=2):
+        self.bandwidths = np.asarray(bandwidths)
+        self.track = bool(track)
+        self.track_width = int(track_width)
+        self.bandwidth = np.nan
+
+        # number of tracked / full searches
+        self.ntracked = 0
+        self.nfull = 0
+
+    def search_bandwidth(self, score):
+        """
+        Find (and store as ``self.bandwidth``) the bandwidth that maximizes
+        ``score``, a function that takes an array of bandwidths and returns
+        the score of each.
+        """
+        full = self.bandwidths
+        if self.track and np.isfinite(self.bandwidth):
+            i = np.abs(np.log(full) - np.log(self.bandwidth)).argmin()
+            i1 = max(i - self.track_width, 0)
+            i2 = min(i + self.track_width + 1, len(full))
+            j = np.argmax(score(full[i1:i2]))
+
+            # edges of the full grid are fine
+            if (j > 0 or i1 == 0) and (j < i2-i1-1 or i2 == len(full)):
+                self.ntracked += 1
+                self.bandwidth = full[i1+j]
+                return self.bandwidth
+
+            logger.debug("Bandwidth {0:.2e} at the edge of the bracket -- searching full grid"
+                         .format(full[i1+j]))
+
+        self.nfull += 1
+        self.bandwidth = full[np.argmax(score(full))]
+        return self.bandwidth
+
+class KDEDensity(BandwidthSearch):
+    """
+    Kernel density estimate with scikit-learn. With a fixed ``bandwidth``,
+    use an Epanechnikov kernel. Otherwise, use a Gaussian kernel with the
+    bandwidth that maximizes the likelihood of held-out particles in a
+    10-fold cross-validation over ``bandwidths`` (see
+    :class:`BandwidthSearch` for ``track`` and ``track_width``).
+
+    Parameters
+    ----------
+    bandwidth : numeric, None (optional)
+        Fixed bandwidth, or None for adaptive.
+    bandwidths : array_like (optional)
+        Grid of bandwidths to search.
+    cv : int (optional)
+        Number of cross-validation folds.
+    rtol : numeric (optional)
+        Relative tolerance of the (dual-tree) evaluation of the density.
+        Zero is exact.
+    track : bool (optional)
+    track_width : int (optional)
+    """
+    def __init__(self, bandwidth=None, bandwidths=np.logspace(-3, 1., 32), cv=10, rtol=0.,
+                 track=False, track_width=2):
+        super(KDEDensity, self).__init__(bandwidths, track=track, track_width=track_width)
+        self.cv = cv
+        self.rtol = float(rtol)
+        self.adaptive = bandwidth is None
+        if not self.adaptive:
+            self.bandwidth = bandwidth
+
+    def __call__(self, x):
+        """
+        Log-density at the positions of the particles ``x``, shape
+        ``(nparticles, ndim)``.
+        """
+        from sklearn.grid_search import GridSearchCV
+        from sklearn.neighbors import KernelDensity
+
+        if self.adaptive:
+            def score(bandwidths):
+                grid = GridSearchCV(KernelDensity(rtol=self.rtol),
+                                    {'bandwidth': bandwidths},
+                                    cv=self.cv, refit=False)
+                grid.fit(x)
+                return [s.mean_validation_score for s in grid.grid_scores_]
+
+            self.search_bandwidth(score)
+            kde = KernelDensity(bandwidth=self.bandwidth, rtol=self.rtol)
+        else:
+            kde = KernelDensity(kernel='epanechnikov', bandwidth=self.bandwidth,
+                                rtol=self.rtol)
+
+        kde.fit(x)
+        return kde.score_samples(x)
+
+class KNNDensity(object):
+    r"""
+    k-nearest-neighbor density estimate. The density at each particle is
+    :math:`k / (N V_k)` where :math:`V_k` is the volume of the sphere that
+    reaches out to the particle's k-th nearest neighbor (not counting the
+    particle itself).
+
+    Parameters
+    ----------
+    k : int (optional)
+        Number of neighbors.
+    """
+    def __init__(self, k=32):
+        self.k = int(k)
+        self.bandwidth = np.nan
+
+    def __call__(self, x):
+        """
+        Log-density at the positions of the particles ``x``, shape
+        ``(nparticles, ndim)``.
+        """
+        N,ndim = x.shape
+        k = min(self.k, N-1)
+        r,_ = cKDTree(x).query(x, k=k+1)
+        r = r[:,-1]
+
+        # volume of the unit ball
+        ln_V1 = 0.5*ndim*np.log(np.pi) - gammaln(0.5*ndim + 1)
+        return np.log(k) - np.log(N) - ln_V1 - ndim*np.log(r)
+
+class NeighborKDEDensity(BandwidthSearch):
+    r"""
+    Gaussian kernel density estimate that only sums over the ``k`` nearest
+    neighbors of each particle, found with a single tree query.
+
+    The bandwidth is either fixed, Scott's rule of thumb
+    (:math:`\sigma N^{-1/(d+4)}` for the mean variance per dimension
+    :math:`\sigma^2`), or the one in ``bandwidths`` that maximizes the
+    leave-one-out likelihood,
+
+    .. math::
+
+        \mathcal{L}(h) = \sum_i \ln \frac{1}{N-1} \sum_{j \neq i} K_h(|x_i - x_j|),
+
+    which follows from the neighbor distances of the same tree query. The
+    kernel contributions of particles beyond the k-th neighbor are
+    neglected, which is accurate as long as the bandwidth is small compared
+    to the distance to the k-th neighbor.
+
+    Parameters
+    ----------
+    bandwidth : numeric, str (optional)
+        A fixed bandwidth, ``'loo'``, or ``'scott'``.
+    k : int (optional)
+        Number of neighbors.
+    bandwidths : array_like (optional)
+        Grid of bandwidths to search for ``bandwidth='loo'``.
+    track : bool (optional)
+    track_width : int (optional)
+        See :class:`BandwidthSearch`.
+    """
+    def __init__(self, bandwidth='loo', k=128, bandwidths=np.logspace(-3, 1., 32),
+                 track=False, track_width=2):
+        super(NeighborKDEDensity, self).__init__(bandwidths, track=track,
+                                                 track_width=track_width)
+        if bandwidth not in ['loo', 'scott']:
+            bandwidth = float(bandwidth)
+        self.rule = bandwidth
+        self.k = int(k)
+
+    def _ln_kernel(self, r2, h, ndim):
+        return -0.5*r2/h**2 - 0.5*ndim*np.log(2*np.pi*h**2)
+
+    def loo_likelihood(self, r2, hs, ndim=3):
+        """
+        Leave-one-out log-likelihood for each bandwidth in ``hs`` given the
+        squared distances ``r2`` to the neighbors of each particle (not
+        including the particle itself), shape ``(nparticles, k)``.
+        """
+        N,k = r2.shape
+        hs = np.asarray(hs)
+        L = np.zeros(len(hs))
+        for n,h in enumerate(hs):
+            L[n] = _logsumexp(self._ln_kernel(r2, h, ndim), axis=-1).sum()
+        return L - N*np.log(N-1)
+
+    def _select_bandwidth(self, x, r2=None):
+        """
+        Set the bandwidth for the particles ``x`` given the squared distances
+        ``r2`` of (some of) the particles to their nearest neighbors, with
+        the particle itself first (only needed for ``'loo'``).
+        """
+        N,ndim = x.shape
+        if self.rule == 'scott':
+            sigma = np.sqrt(np.mean(np.var(x, axis=0)))
+            self.bandwidth = sigma * N**(-1./(ndim+4))
+
+        elif self.rule == 'loo':
+            # the first neighbor is the particle itself
+            self.search_bandwidth(lambda hs: self.loo_likelihood(r2[:,1:], hs, ndim=ndim))
+
+        else:
+            self.bandwidth = self.rule
+
+    def __call__(self, x):
+        """
+        Log-density at the positions of the particles ``x``, shape
+        ``(nparticles, ndim)``.
+        """
+        N,ndim = x.shape
+        k = min(self.k, N-1)
+        r,_ = cKDTree(x).query(x, k=k+1)
+        r2 = r**2
+
+        self._select_bandwidth(x, r2)
+        return _logsumexp(self._ln_kernel(r2, self.bandwidth, ndim), axis=-1) - np.log(N)
+
+class TreeKDEDensity(NeighborKDEDensity):
+    r"""
+    Gaussian kernel density estimate that sums over all pairs of particles
+    closer than the radius where the kernel drops to ``rtol`` of its peak,
+    :math:`r_c = h \sqrt{2\ln(1/{\rm rtol})}`, for ensembles too large for
+    :class:`KDEDensity`.
+
+    The pairs come from a neighbor list of all pairs within
+    :math:`(1 + {\rm skin})\,r_c`, found with a KD-tree. The list is reused
+    for later evaluations (e.g., the next time step of the ensemble) as long
+    as no particle has moved by more than half of the margin between the
+    radius of the list and the new :math:`r_c`. Displacements are measured
+    relative to the mean displacement of the ensemble, since moving the
+    ensemble as a whole doesn't change the distances between particles.
+
+    The bandwidth is chosen as for :class:`NeighborKDEDensity`, but the
+    leave-one-out likelihood is only computed for ``nsample`` of the
+    particles.
+
+    Parameters
+    ----------
+    bandwidth : numeric, str (optional)
+        A fixed bandwidth, ``'loo'``, or ``'scott'``.
+    rtol : numeric (optional)
+        Relative value of the kernel at which it is truncated.
+    skin : numeric (optional)
+        Extra radius of the neighbor list, as a fraction of :math:`r_c`.
+    k : int (optional)
+        Number of neighbors for the leave-one-out likelihood.
+    nsample : int, None (optional)
+        Number of particles for the leave-one-out likelihood, or None for
+        all particles.
+    bandwidths : array_like (optional)
+    track : bool (optional)
+    track_width : int (optional)
+        See :class:`NeighborKDEDensity`.
+    """
+    def __init__(self, bandwidth='loo', rtol=1E-3, skin=0.25, k=128, nsample=2000,
+                 bandwidths=np.logspace(-3, 1., 32), track=False, track_width=2):
+        super(TreeKDEDensity, self).__init__(bandwidth=bandwidth, k=k, bandwidths=bandwidths,
+                                             track=track, track_width=track_width)
+        self.rtol = float(rtol)
+        self.skin = float(skin)
+        self.nsample = nsample
+
+        # neighbor list, the radius it extends to, and the positions when it was built
+        self._pairs = None
+        self._radius = 0.
+        self._x_ref = None
+
+        # number of times the neighbor list was built / reused
+        self.nbuild = 0
+        self.nreuse = 0
+
+    def neighbor_pairs(self, x, r_c, tree=None):
+        """
+        Indices of (at least) all pairs of particles closer than ``r_c``,
+        shape ``(npairs, 2)``, from the previous neighbor list if possible.
+        """
+        if self._pairs is not None and self._x_ref.shape == x.shape:
+            dx = x - self._x_ref
+            dx -= dx.mean(axis=0)
+            max_disp = np.sqrt(np.max(np.sum(dx**2, axis=-1)))
+            if r_c + 2*max_disp <= self._radius:
+                self.nreuse += 1
+                return self._pairs
+
+        if tree is None:
+            tree = cKDTree(x)
+
+        self._radius = (1 + self.skin) * r_c
+        self._pairs = tree.query_pairs(self._radius, output_type='ndarray')
+        self._x_ref = x.copy()
+        self.nbuild += 1
+        logger.debug("Built neighbor list with {0} pairs".format(len(self._pairs)))
+
+        return self._pairs
+
+    def __call__(self, x):
+        """
+        Log-density at the positions of the particles ``x``, shape
+        ``(nparticles, ndim)``.
+        """
+        N,ndim = x.shape
+
+        tree = None
+        r2 = None
+        if self.rule == 'loo':
+            tree = cKDTree(x)
+            if self.nsample is None or self.nsample >= N:
+                ix = slice(None)
+            else:
+                # the particles are independent, so any subset is a random sample
+                ix = np.linspace(0, N-1, self.nsample).astype(int)
+            r,_ = tree.query(x[ix], k=min(self.k, N-1)+1)
+            r2 = r**2
+
+        self._select_bandwidth(x, r2)
+        h = self.bandwidth
+
+        r_c = h*np.sqrt(-2*np.log(self.rtol))
+        i,j = self.neighbor_pairs(x, r_c, tree=tree).T
+
+        # each particle's own contribution, plus both sides of each pair
+        K = np.exp(-0.5*np.sum((x[i] - x[j])**2, axis=-1) / h**2)
+        dens = 1. + np.bincount(i, K, minlength=N) + np.bincount(j, K, minlength=N)
+        return np.log(dens) + self._ln_kernel(0., h, ndim) - np.log(N)
+
+# names of the density estimators for follow_ensemble()
+density_methods = dict(kde=KDEDensity,
+                       knn=KNNDensity,
+                       loo=partial(NeighborKDEDensity, bandwidth='loo'),
+                       scott=partial(NeighborKDEDensity, bandwidth='scott'),
+                       tree=TreeKDEDensity)
+
+def get_density_estimator(method, **kwargs):
+    """
+    Create a density estimator by name (see ``density_methods``). Keyword
+    arguments are passed to the estimator class.
+
+    Parameters
+    ----------
+    method : str
+        One of ``'kde'`` (:class:`KDEDensity`), ``'knn'`` (:class:`KNNDensity`),
+        ``'loo'`` or ``'scott'`` (:class:`NeighborKDEDensity` with the
+        leave-one-out or rule-of-thumb bandwidth), ``'tree'``
+        (:class:`TreeKDEDensity`).
+    """
+    try:
+        Estimator = density_methods[method]
+    except KeyError:
+        raise ValueError("Invalid density method '{0}' -- must be one of: {1}"
+                         .format(method, ", ".join(sorted(density_methods.keys()))))
+    return Estimator(**kwargs)
@@ -21,6 +21,9 @@ from ..experimentrunner import OrbitGridExperiment
 __all__ = ['Ensemble']
 
 class Ensemble(OrbitGridExperiment):
+    # share the estimated periods with other experiments on the same grid
+    cache_periods = True
+
     # failure error codes
     error_codes = {
         1: "Failed to integrate orbit or estimate dt, nsteps.",
@@ -31,7 +34,9 @@ class Ensemble(OrbitGridExperiment):
 
     _run_kwargs = ['energy_tolerance', 'nperiods', 'nsteps_per_period',
                    'nensemble', 'mscale', 'kde_bandwidth', 'neval',
-                   'store_all_dens', 'store_all_w', 'min_pericenter']
+                   'store_all_dens', 'store_all_w', 'min_pericenter', 'per_orbit_steps',
+                   'nthreads', 'density_method', 'density_k', 'density_rtol',
+                   'track_bandwidth']
     config_defaults = dict(
         energy_tolerance=1E-8, # Maximum allowed fractional energy difference
         nperiods=16, # Total number of orbital periods to integrate for
@@ -40,9 +45,15 @@ class Ensemble(OrbitGridExperiment):
         mscale=1E4, # mass scale of the ensemble
         kde_bandwidth=None, # KDE bandwidth (default=None, uses adaptive)
         neval=128, # Number of times during integration to build KDE
-        store_all_dens=False, # Store full distribution of density values for each particle at each eval
-        store_all_w=False, # Store all phase-space positions for all ensemble particles at each eval
+        store_all_dens=False, # Store full distribution of density values for each particle at each eval (in the history file)
+        store_all_w=False, # Store all phase-space positions for all ensemble particles at each eval (in the history file)
         min_pericenter=True, # Start the ensembles at minimum pericenter
+        per_orbit_steps=False, # Integrate each ensemble orbit with its own adaptive step size
+        nthreads=1, # Number of threads for integrating the ensemble (> 1 implies per_orbit_steps)
+        density_method='kde', # Density estimator: 'kde' (sklearn), 'knn', 'loo', 'scott', 'tree' (see density.py)
+        density_k=None, # Number of neighbors for the 'knn', 'loo', 'scott', 'tree' density estimators
+        density_rtol=None, # Relative tolerance of the 'kde' and 'tree' density estimators
+        track_bandwidth=False, # Only search for the bandwidth around the one of the previous eval
         w0_filename='w0.npy', # Name of the initial conditions file
         cache_filename='ensemble.npy', # Name of the cache file
         potential_filename='potential.yml' # Name of cached potential file
@@ -64,14 +75,24 @@ class Ensemble(OrbitGridExperiment):
             ('skew_log_dens','f8',self.config.neval), # mean density at the end of integration
             ('kurtosis_dens','f8',self.config.neval), # mean density at the end of integration
             ('kurtosis_log_dens','f8',self.config.neval), # mean density at the end of integration
-            ('t','f8',self.config.neval) # times of each evaluation
+            ('t','f8',self.config.neval), # times of each evaluation
+            ('bandwidth','f8',self.config.neval) # bandwidth of the density estimate at each evaluation
         ]
+        return dt
+
+    @property
+    def history_dtype(self):
+        # the full per-particle arrays are stored in a separate file, so that
+        #   they don't make every row of the cache nensemble times larger
+        dt = []
         if self.config.store_all_dens:
             dt.append(('all_dens','f8',(self.config.neval,self.config.nensemble+1)))
 
         if self.config.store_all_w:
             dt.append(('all_w','f8',(self.config.neval,self.config.nensemble+1,6)))
 
+        if len(dt) == 0:
+            return None
         return dt
 
     @classmethod
@@ -87,13 +108,17 @@ class Ensemble(OrbitGridExperiment):
         result = dict()
 
         try:
-            new_w0,dt,nsteps = prepare_parent_orbit(w0.copy(), potential,
-                                                    c['nperiods'], c['nsteps_per_period'])
+            new_w0,dt,nsteps,periods = prepare_parent_orbit(w0.copy(), potential,
+                                                            c['nperiods'], c['nsteps_per_period'],
+                                                            periods=kwargs.get('periods'),
+                                                            return_periods=True,
+                                                            **cls.period_cache_params)
         except RuntimeError:
             logger.warning("Failed to integrate orbit when estimating dt,nsteps")
             result['success'] = False
             result['error_code'] = 1
             return result
+        result['_periods'] = periods
 
         logger.debug("Integrating orbit with dt={0}, nsteps={1}".format(dt, nsteps))
 
@@ -106,12 +131,23 @@ class Ensemble(OrbitGridExperiment):
         ensemble_w0 = create_ensemble(new_w0, potential, n=c['nensemble'], m_scale=mscale)
         logger.debug("Generated ensemble of {0} particles".format(c['nensemble']))
 
+        density_kwargs = dict()
+        if c['density_k'] is not None and c['density_method'] != 'kde':
+            density_kwargs['k'] = c['density_k']
+        if c['density_rtol'] is not None and c['density_method'] in ['kde', 'tree']:
+            density_kwargs['rtol'] = c['density_rtol']
+
         try:
             ret = follow_ensemble(ensemble_w0, potential, dt, nsteps,
                                   neval=c['neval'],
                                   kde_bandwidth=c['kde_bandwidth'],
                                   return_all_density=c['store_all_dens'],
-                                  return_all_w=c['store_all_w'])
+                                  return_all_w=c['store_all_w'],
+                                  per_orbit_steps=c['per_orbit_steps'],
+                                  nthreads=c['nthreads'],
+                                  density_method=c['density_method'],
+                                  density_kwargs=density_kwargs,
+                                  track_bandwidth=c['track_bandwidth'])
         except:
             import traceback
             t,v,tb = sys.exc_info()
@@ -149,10 +185,16 @@ class Ensemble(OrbitGridExperiment):
         result['kurtosis_log_dens'] = data['kurtosis_log']
 
         result['t'] = t
+        result['bandwidth'] = ret['bandwidth']
+
+        history = dict()
         if c['store_all_dens']:
-            result['all_dens'] = ret['all_density']
+            history['all_dens'] = ret['all_density']
 
         if c['store_all_w']:
-            result['all_w'] = ret['all_w']
+            history['all_w'] = ret['all_w']
+
+        if len(history) > 0:
+            result['_history'] = history
 
         return result
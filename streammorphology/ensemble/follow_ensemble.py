@@ -6,16 +6,17 @@ __author__ = "adrn <adrn@astro.columbia.edu>"
 
 # Third-party
 import numpy as np
-from scipy.stats import skew, kurtosis
-from sklearn.grid_search import GridSearchCV
-from sklearn.neighbors import KernelDensity
 
 # Project
-from ..extern.fast_ensemble import ensemble_integrate
+from .density import get_density_estimator
+from .moments import StreamingMoments
+from ..extern.fast_ensemble import ensemble_integrate_dense
 
 def follow_ensemble(ensemble_w0, potential, dt, nsteps, neval,
                     kde_bandwidth=None, return_all_density=False,
-                    return_all_w=False):
+                    return_all_w=False, per_orbit_steps=False, nthreads=1,
+                    density_method='kde', density_kwargs=None, track_bandwidth=False,
+                    max_size=2**22):
     """
     Compute diagnostics / metrics at ``neval`` times over the integration
     of the input orbit ensemble. Use this to follow the, e.g., mean density
@@ -36,10 +37,35 @@ def follow_ensemble(ensemble_w0, potential, dt, nsteps, neval,
         distribution.
     kde_bandwidth : float, None (optional)
         If None, use an adaptive bandwidth, or a float for a fixed bandwidth.
+        Only used with ``density_method='kde'``.
     return_all_density : bool (optional)
         Return the full density distributions along with metrics.
     return_all_w : bool (optional)
         Return the phase-space positions of the ensemble at each step.
+    per_orbit_steps : bool (optional)
+        Integrate each orbit with its own adaptive step size instead of
+        advancing the whole ensemble with one shared step size.
+    nthreads : int (optional)
+        Number of threads to split the ensemble orbits over. The shared
+        step size integration can't be split up, so ``nthreads > 1``
+        implies ``per_orbit_steps=True``.
+    density_method : str, callable (optional)
+        How to estimate the density of the ensemble: the name of one of the
+        estimators in :mod:`~streammorphology.ensemble.density` (``'kde'``,
+        ``'knn'``, ``'loo'``, ``'scott'``, ``'tree'``), or any callable that takes the
+        positions of the particles and returns the log-density at each.
+    density_kwargs : dict (optional)
+        Keyword arguments for the density estimator, if given by name.
+    track_bandwidth : bool (optional)
+        For the estimators that search for the best bandwidth (``'kde'``
+        with an adaptive bandwidth, ``'loo'``, ``'tree'``), only search around the
+        bandwidth of the previous evaluation. See
+        :class:`~streammorphology.ensemble.density.BandwidthSearch`.
+    max_size : int (optional)
+        Maximum number of phase-space values (``6`` per orbit per evaluation
+        time) to hold in memory at once. The ensemble is integrated through
+        as many evaluation times as fit in one uninterrupted integration,
+        and sampled at those times with the dense output of the integrator.
     """
     # make sure initial conditions are a contiguous C array
     ww = np.ascontiguousarray(ensemble_w0.copy())
@@ -50,13 +76,16 @@ def follow_ensemble(ensemble_w0, potential, dt, nsteps, neval,
 #                         np.linspace(nsteps//4, nsteps, nkld//2+1)[1:]).astype(int)
     idx = np.linspace(0, nsteps, neval).astype(int)
 
-    # if None, adaptive
-    if kde_bandwidth is None:
-        adaptive_bandwidth = True
+    if callable(density_method):
+        estimator = density_method
     else:
-        adaptive_bandwidth = False
-        kde = KernelDensity(kernel='epanechnikov',
-                            bandwidth=kde_bandwidth)
+        density_kwargs = dict(density_kwargs or dict())
+        if density_method == 'kde':
+            # if None, adaptive
+            density_kwargs.setdefault('bandwidth', kde_bandwidth)
+        if density_method in ['kde', 'loo', 'tree']:
+            density_kwargs.setdefault('track', track_bandwidth)
+        estimator = get_density_estimator(density_method, **density_kwargs)
 
     # if set, store and return all of the density values
     if return_all_density:
@@ -66,66 +95,63 @@ def follow_ensemble(ensemble_w0, potential, dt, nsteps, neval,
         all_w = np.zeros((neval, nensemble, 6))
 
     # container to store fraction of stars with density above each threshold
-    _moments = dict(mean=np.mean, median=np.median, skew=skew, kurtosis=kurtosis)
+    _moments = ['mean', 'median', 'skew', 'kurtosis']
     dtype = []
-    for k,v in _moments.items():
+    for k in _moments:
         dtype.append((k,'f8'))
         dtype.append(("{0}_log".format(k),'f8'))
     data = np.zeros(neval, dtype=dtype)
 
+    # bandwidth of the density estimate at each eval
+    bandwidth = np.zeros(neval) + np.nan
+
     # store energies
     Es = np.empty((neval,nensemble))
     Es[0] = potential.total_energy(ensemble_w0[:,:3], ensemble_w0[:,3:])
 
-    # time container
-    t = np.zeros(neval)
+    # evaluation times -- the integrator isn't restarted at each of these, only
+    #   at the start of each block of times that fits in memory
+    t = dt*idx
+    nblock = max(1, max_size // (6*nensemble) - 1)
     for i in range(neval):
-        if i == 0:
-            www = ww
-
-        else:
-            # number of steps to advance the ensemble -- not necessarily constant
-            dstep = idx[i] - idx[i-1]
-            www = ensemble_integrate(potential.c_instance, ww, dt, dstep, 0.)
-
-            Es[i] = potential.total_energy(www[:,:3], www[:,3:])
-
-            # store the time
-            t[i] = t[i-1] + dt*dstep
+        if i > 0:
+            j = (i-1) % nblock + 1
+            if j == 1:
+                # sampled states for the next block, starting from the current one
+                tblock = np.ascontiguousarray(t[i-1:i+nblock])
+                ws = ensemble_integrate_dense(potential.c_instance, ww, tblock, dt0=dt,
+                                              per_orbit_steps=int(per_orbit_steps or nthreads > 1),
+                                              nthreads=nthreads)
+            ww = ws[j]
+            Es[i] = potential.total_energy(ww[:,:3], ww[:,3:])
 
         if return_all_w:
-            all_w[i] = www
+            all_w[i] = ww
 
-        # build an estimate of the configuration space density of the ensemble
-        if adaptive_bandwidth:
-            grid = GridSearchCV(KernelDensity(),
-                                {'bandwidth': np.logspace(-3, 1., 32)},
-                                cv=10) # 10-fold cross-validation
-            grid.fit(www[:,:3])
-            kde = grid.best_estimator_
-
-        kde.fit(www[:,:3])
-
-        # evaluate density at the position of the particles
-        ln_density = kde.score_samples(www[:,:3])
+        # estimate the configuration space density of the ensemble at the
+        #   position of the particles
+        ln_density = estimator(ww[:,:3])
         density = np.exp(ln_density)
+        bandwidth[i] = getattr(estimator, 'bandwidth', np.nan)
 
         # store
         if return_all_density:
             all_density[i] = density
 
-        # evaluate the metrics and save
-        for k,v in _moments.items():
-            data[k][i] = v(density)
-            data["{0}_log".format(k)][i] = v(ln_density)
-
-        # reset initial conditions
-        ww = www.copy()
+        # evaluate the metrics and save -- all of the values are in memory, so
+        #   the median is exact and the moments come from one pass
+        for suffix,values in [("", density), ("_log", ln_density)]:
+            moments = StreamingMoments()
+            moments.add(values)
+            data['median'+suffix][i] = np.median(values)
+            for k in ['mean', 'skew', 'kurtosis']:
+                data[k+suffix][i] = getattr(moments, k)
 
     ret = dict()
     ret['t'] = t
     ret['data'] = data
     ret['energy'] = Es
+    ret['bandwidth'] = bandwidth
     if return_all_density:
         ret['all_density'] = all_density
 
@@ -0,0 +1,81 @@
+# coding: utf-8
+
+""" Accumulate moments of a stream of values in one pass. """
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Third-party
+import numpy as np
+
+__all__ = ['StreamingMoments']
+
+class StreamingMoments(object):
+    """
+    Mean, variance, skewness, and kurtosis of values that arrive in chunks,
+    without keeping the values around.
+
+    The central moments of each chunk are merged into the running moments
+    with the pairwise update formulas of Chan et al. and Terriberry, so
+    each value is touched once. The skewness and kurtosis match
+    :func:`scipy.stats.skew` and :func:`scipy.stats.kurtosis` with their
+    defaults (biased, Fisher's definition of the kurtosis).
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self._M2 = 0.
+        self._M3 = 0.
+        self._M4 = 0.
+
+    def add(self, x):
+        """
+        Add a chunk of values ``x`` (any shape).
+        """
+        x = np.asarray(x, dtype=float).ravel()
+        nb = len(x)
+        if nb == 0:
+            return
+
+        mean_b = x.mean()
+        d = x - mean_b
+        d2 = d*d
+        M2_b = d2.sum()
+        M3_b = (d2*d).sum()
+        M4_b = (d2*d2).sum()
+
+        na = self.n
+        n = na + nb
+        delta = mean_b - self.mean
+        M2_a, M3_a = self._M2, self._M3
+
+        self._M4 = (self._M4 + M4_b
+                    + delta**4 * na*nb*(na*na - na*nb + nb*nb) / n**3
+                    + 6*delta**2 * (na*na*M2_b + nb*nb*M2_a) / n**2
+                    + 4*delta * (na*M3_b - nb*M3_a) / n)
+        self._M3 = (M3_a + M3_b
+                    + delta**3 * na*nb*(na - nb) / n**2
+                    + 3*delta * (na*M2_b - nb*M2_a) / n)
+        self._M2 = M2_a + M2_b + delta**2 * na*nb / n
+        self.mean = self.mean + delta * nb / n
+        self.n = n
+
+    @property
+    def var(self):
+        if self.n < 1:
+            return np.nan
+        return self._M2 / self.n
+
+    @property
+    def skew(self):
+        # undefined for fewer than two (distinct) values
+        if self.n < 2 or self._M2 == 0:
+            return np.nan
+        return np.sqrt(self.n) * self._M3 / self._M2**1.5
+
+    @property
+    def kurtosis(self):
+        if self.n < 2 or self._M2 == 0:
+            return np.nan
+        return self.n * self._M4 / self._M2**2 - 3.
@@ -6,6 +6,7 @@ __author__ = "adrn <adrn@astro.columbia.edu>"
 
 # Standard library
 import os
+import sys
 import logging
 
 # Third-party
@@ -15,7 +16,8 @@ import gary.potential as gp
 
 # Project
 from ... import project_path
-from ..core import align_ensemble, compute_align_matrix
+from ..core import (align_ensemble, compute_align_matrix, compute_all_freqs,
+                    _mpi_initialized)
 
 logger.setLevel(logging.DEBUG)
 
@@ -95,3 +97,34 @@ def test_align_ensemble():
 
         a = np.array([np.linalg.norm(new_x[0]), 0., 0.])
         assert np.allclose(a,new_x[0])
+
+def test_compute_all_freqs_workers():
+    parent_w0 = np.array([1., 0., 30., 0., 0.15, -0.1])
+    w0 = np.random.normal(parent_w0,
+                          [0.01,0.01,0.01,0.002,0.002,0.002],
+                          size=(9,6))
+    w0 = np.vstack((parent_w0[None], w0))
+    t,w = potential.integrate_orbit(w0, dt=1., nsteps=20000)
+
+    for batch in [False, True]:
+        freqs,amps = compute_all_freqs(t, w, batch=batch)
+        assert freqs.shape == (10,3)
+
+        # same result split over processes or threads
+        for worker_type in ['process', 'thread']:
+            f,A = compute_all_freqs(t, w, batch=batch, nworkers=3, worker_type=worker_type)
+            np.testing.assert_allclose(f, freqs)
+            np.testing.assert_allclose(A, amps)
+
+    # processes aren't forked under MPI, threads are used instead
+    class FakeMPI(object):
+        Is_initialized = staticmethod(lambda: True)
+        Is_finalized = staticmethod(lambda: False)
+
+    sys.modules['mpi4py.MPI'] = FakeMPI()
+    try:
+        assert _mpi_initialized()
+        f,A = compute_all_freqs(t, w, batch=True, nworkers=3, worker_type='process')
+        np.testing.assert_allclose(f, freqs)
+    finally:
+        del sys.modules['mpi4py.MPI']
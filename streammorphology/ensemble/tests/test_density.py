@@ -0,0 +1,125 @@
+# coding: utf-8
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Third-party
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+
+# Project
+from ..density import (get_density_estimator, BandwidthSearch, NeighborKDEDensity,
+                       TreeKDEDensity,
+                       _logsumexp)
+
+np.random.seed(42)
+N = 1000
+sigma = np.array([1., 0.5, 0.2])
+x = np.random.normal(0., sigma, size=(N,3))
+true_ln_dens = (-0.5*np.sum((x/sigma)**2, axis=-1) - 1.5*np.log(2*np.pi)
+                - np.log(np.prod(sigma)))
+
+def _ln_kernel(h):
+    return -0.5*cdist(x,x)**2/h**2 - 1.5*np.log(2*np.pi*h**2)
+
+def test_knn():
+    ln_dens = get_density_estimator('knn')(x)
+    assert np.abs(np.median(ln_dens - true_ln_dens)) < 0.1
+    assert np.std(ln_dens - true_ln_dens) < 0.5
+
+def test_loo():
+    # leave-one-out bandwidth from a direct sum over all pairs
+    bandwidths = np.logspace(-3, 1., 32)
+    L = []
+    for h in bandwidths:
+        a = _ln_kernel(h)
+        np.fill_diagonal(a, -np.inf)
+        L.append(_logsumexp(a, axis=-1).sum())
+    h = bandwidths[np.argmax(L)]
+
+    estimator = get_density_estimator('loo', bandwidths=bandwidths)
+    ln_dens = estimator(x)
+    assert estimator.bandwidth == h
+    np.testing.assert_allclose(ln_dens, _logsumexp(_ln_kernel(h), axis=-1) - np.log(N),
+                               atol=0.05)
+    assert np.std(ln_dens - true_ln_dens) < 0.7
+
+def test_fixed_and_scott():
+    estimator = get_density_estimator('scott')
+    estimator(x)
+    assert np.allclose(estimator.bandwidth, np.sqrt(np.mean(sigma**2)) * N**(-1/7.), rtol=0.1)
+
+    # enough neighbors for the sum to converge
+    estimator = NeighborKDEDensity(bandwidth=0.1, k=256)
+    ln_dens = estimator(x)
+    np.testing.assert_allclose(ln_dens, _logsumexp(_ln_kernel(0.1), axis=-1) - np.log(N),
+                               atol=1E-6)
+
+    with pytest.raises(ValueError):
+        get_density_estimator('not-a-method')
+
+def test_track_bandwidth():
+    bandwidths = np.logspace(-3, 1., 32)
+    search = BandwidthSearch(bandwidths, track=True, track_width=2)
+
+    def make_score(h0):
+        def score(hs):
+            score.nevals += len(hs)
+            return -(np.log(hs) - np.log(h0))**2
+        score.nevals = 0
+        return score
+
+    # slowly drifting optimum -- only the bracket is searched
+    for n,h0 in enumerate(np.logspace(-2, -1.5, 8)):
+        score = make_score(h0)
+        h = search.search_bandwidth(score)
+        assert h == bandwidths[np.argmin(np.abs(np.log(bandwidths/h0)))]
+        if n > 0:
+            assert score.nevals == 5
+    assert search.nfull == 1
+    assert search.ntracked == 7
+
+    # large jump -- falls back to the full grid
+    score = make_score(3.)
+    assert search.search_bandwidth(score) == bandwidths[np.argmin(np.abs(np.log(bandwidths/3.)))]
+    assert search.nfull == 2
+
+    # same bandwidths as searching from scratch for a slowly expanding ensemble
+    tracked = get_density_estimator('loo', track=True)
+    full = get_density_estimator('loo')
+    for f in np.linspace(1., 2., 5):
+        np.testing.assert_allclose(tracked(f*x), full(f*x))
+        assert tracked.bandwidth == full.bandwidth
+    assert tracked.ntracked == 4
+
+def test_tree():
+    h = 0.1
+    exact = _logsumexp(_ln_kernel(h), axis=-1) - np.log(N)
+    for rtol in [1E-2, 1E-4]:
+        estimator = TreeKDEDensity(bandwidth=h, rtol=rtol)
+        ln_dens = estimator(x)
+        assert np.all(ln_dens <= exact + 1E-12)
+        assert np.all(ln_dens - exact > np.log(1 - 10*rtol))
+
+    # leave-one-out bandwidth as for the k nearest neighbors
+    estimator = TreeKDEDensity(nsample=None)
+    estimator(x)
+    neighbor = get_density_estimator('loo')
+    neighbor(x)
+    assert estimator.bandwidth == neighbor.bandwidth
+
+    # neighbor list is reused if the particles move together...
+    estimator = TreeKDEDensity(bandwidth=h, rtol=1E-4)
+    estimator(x)
+    y = x + np.array([10., -5., 3.]) + np.random.normal(0., 1E-3, size=x.shape)
+    np.testing.assert_allclose(estimator(y), TreeKDEDensity(bandwidth=h, rtol=1E-4)(y),
+                               atol=1E-3)
+    assert estimator.nbuild == 1 and estimator.nreuse == 1
+
+    # ...but not when the ensemble is deformed
+    y = 1.5*y
+    np.testing.assert_allclose(estimator(y),
+                               TreeKDEDensity(bandwidth=h, rtol=1E-4)(y))
+    assert estimator.nbuild == 2
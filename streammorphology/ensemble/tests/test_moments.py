@@ -0,0 +1,34 @@
+# coding: utf-8
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Third-party
+import numpy as np
+from scipy.stats import skew, kurtosis
+
+# Project
+from ..moments import StreamingMoments
+
+def test_moments():
+    np.random.seed(42)
+    x = np.exp(np.random.normal(3., 1., size=20001))
+
+    for chunk in [len(x), 1000, 7]:
+        m = StreamingMoments()
+        for i in range(0, len(x), chunk):
+            m.add(x[i:i+chunk])
+
+        assert m.n == len(x)
+        np.testing.assert_allclose(m.mean, np.mean(x), rtol=1E-12)
+        np.testing.assert_allclose(m.var, np.var(x), rtol=1E-12)
+        np.testing.assert_allclose(m.skew, skew(x), rtol=1E-12)
+        np.testing.assert_allclose(m.kurtosis, kurtosis(x), rtol=1E-12)
+
+def test_moments_small():
+    # skewness and kurtosis are undefined for fewer than two values
+    m = StreamingMoments()
+    m.add([1.5])
+    assert m.mean == 1.5 and m.var == 0.
+    assert np.isnan(m.skew) and np.isnan(m.kurtosis)
@@ -20,6 +20,9 @@ from .experimentrunner import OrbitGridExperiment
 __all__ = ['EnsembleFreqVariance']
 
 class EnsembleFreqVariance(OrbitGridExperiment):
+    # share the estimated periods with other experiments on the same grid
+    cache_periods = True
+
     # failure error codes
     error_codes = {
         1: "Failed to integrate orbit or estimate dt, nsteps.",
@@ -28,7 +31,8 @@ class EnsembleFreqVariance(OrbitGridExperiment):
     }
 
     _run_kwargs = ['nperiods', 'energy_tolerance', 'nsteps_per_period',
-                   'hamming_p', 'nensemble', 'nintvec', 'force_cartesian']
+                   'hamming_p', 'nensemble', 'nintvec', 'force_cartesian', 'batch_naff',
+                   'nworkers', 'worker_type']
     config_defaults = dict(
         nperiods=50, # total number of periods to integrate for
         energy_tolerance=1E-8, # Maximum allowed fractional energy difference
@@ -38,6 +42,9 @@ class EnsembleFreqVariance(OrbitGridExperiment):
         nensemble=128, # How many orbits per ensemble
         nintvec=15, # maximum number of integer vectors to use in SuperFreq
         force_cartesian=False, # Do frequency analysis on cartesian coordinates
+        batch_naff=False, # Analyze all orbits in the ensemble at once (see batchfreq.py)
+        nworkers=1, # Number of processes or threads for the frequency analysis of the ensemble
+        worker_type='thread', # 'thread' or 'process' (processes aren't forked under MPI)
         w0_filename='w0.npy', # Name of the initial conditions file
         cache_filename='ensemblefreqvariance.npy', # Name of the cache file
         potential_filename='potential.yml' # Name of cached potential file
@@ -73,16 +80,20 @@ class EnsembleFreqVariance(OrbitGridExperiment):
             #                                         potential=potential,
             #                                         nperiods=c['nperiods'],
             #                                         nsteps_per_period=c['nsteps_per_period'])
-            dt,nsteps = estimate_dt_nsteps(w0=w0.copy(),
-                                           potential=potential,
-                                           nperiods=c['nperiods'],
-                                           nsteps_per_period=c['nsteps_per_period'])
+            dt,nsteps,periods = estimate_dt_nsteps(w0=w0.copy(),
+                                                   potential=potential,
+                                                   nperiods=c['nperiods'],
+                                                   nsteps_per_period=c['nsteps_per_period'],
+                                                   periods=kwargs.get('periods'),
+                                                   return_periods=True,
+                                                   **cls.period_cache_params)
             new_w0 = w0.copy()
         except RuntimeError:
             logger.warning("Failed to integrate orbit when estimating dt,nsteps")
             result['success'] = False
             result['error_code'] = 1
             return result
+        result['_periods'] = periods
 
         logger.debug("Integrating orbit with dt={0}, nsteps={1}".format(dt, nsteps))
 
@@ -119,7 +130,10 @@ class EnsembleFreqVariance(OrbitGridExperiment):
         allfreqs, allamps = compute_all_freqs(t, ws,
                                               hamming_p=c['hamming_p'],
                                               nintvec=c['nintvec'],
-                                              force_cartesian=c['force_cartesian'])
+                                              force_cartesian=c['force_cartesian'],
+                                              batch=c['batch_naff'],
+                                              nworkers=c['nworkers'],
+                                              worker_type=c['worker_type'])
 
         result['freqs'] = allfreqs
         result['amps'] = allamps
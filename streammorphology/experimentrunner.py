@@ -20,10 +20,7 @@ except ImportError: # only works in Python 3
 from argparse import ArgumentParser
 import logging
 import os
-try:
-    import cPickle as pickle
-except ImportError: # only works in Python 3
-    import pickle
+import time
 
 # Third-party
 import numpy as np
@@ -31,14 +28,47 @@ from astropy import log as logger
 from gary.util import get_pool
 
 # Project
+from .cachewriter import BufferedCacheWriter
 from .config import ConfigNamespace, save, load
+from .periodcache import PeriodCache
+from .scheduling import guided_chunks, dynamical_time, longest_first, predict_makespan
+from .util import period_dtype
 
 __all__ = ['OrbitGridExperiment', 'ExperimentRunner']
 
+# state that is set up once per worker process, keyed by experiment --
+#   see OrbitGridExperiment._setup_worker()
+_worker_state = dict()
+
 class OrbitGridExperiment(object):
 
     __metaclass__ = ABCMeta
 
+    # results are staged in memory and flushed to the cache file once this
+    #   many have accumulated, or this many seconds have passed
+    cache_buffer_size = 1024
+    cache_flush_interval = 60.
+
+    # optional per-orbit history (e.g., a time series) that is too large to
+    #   keep in the cache: subclasses can set a structured dtype here and
+    #   return the history in the result dictionary under the key '_history'.
+    #   It is appended, along with the orbit index, to a separate file.
+    history_dtype = None
+
+    # subclasses that estimate the periods of the orbits with
+    #   estimate_dt_nsteps() can set this to share the estimates with all other
+    #   experiments on the same grid: the periods are passed in to run() (or
+    #   run_batch()) with the keyword 'periods' (None if not yet estimated),
+    #   and any new estimates should be returned in the result dictionary
+    #   under the key '_periods'. The cache is keyed by the potential and
+    #   these parameters of estimate_dt_nsteps(), which set how the
+    #   exploratory orbit is integrated and sampled, so they must be passed
+    #   to every call of estimate_dt_nsteps() in run(). Cached periods are
+    #   only used if they were estimated for the same initial conditions
+    cache_periods = False
+    period_cache_params = dict(explore_time=10000., dE_threshold=1E-9,
+                               explore_nsteps_per_period=512)
+
     def __init__(self, cache_path, overwrite=False, **kwargs):
 
         # validate cache path
@@ -58,33 +88,90 @@ class OrbitGridExperiment(object):
         self.config = ns
 
         self.cache_file = os.path.join(self.cache_path, self.config.cache_filename)
+        self.journal_file = "{0}.journal".format(self.cache_file)
+        self.history_file = "{0}_history.npy".format(os.path.splitext(self.cache_file)[0])
         if os.path.exists(self.cache_file) and overwrite:
             os.remove(self.cache_file)
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            if os.path.exists(self.history_file):
+                os.remove(self.history_file)
+        self._writer = None
+        self._history = None
+        self._timing = dict(setup=0., compute=0., norbits=0)
+        self._orbit_times = None
 
         # load initial conditions
-        w0_path = os.path.join(self.cache_path, self.config.w0_filename)
-        if not os.path.exists(w0_path):
+        self.w0_path = os.path.join(self.cache_path, self.config.w0_filename)
+        if not os.path.exists(self.w0_path):
             raise IOError("Initial conditions file '{0}' doesn't exist! You need"
-                          "to generate this file first using make_grid.py".format(w0_path))
-        self.w0 = np.load(w0_path)
+                          "to generate this file first using make_grid.py".format(self.w0_path))
+        self.w0 = np.load(self.w0_path)
         self.norbits = len(self.w0)
         logger.info("Number of orbits: {0}".format(self.norbits))
 
+        # periods of the orbits, shared by all experiments on this grid
+        self._periods = None
+        self.periods_file = None
+        potential_path = os.path.join(self.cache_path, self.config.potential_filename)
+        if self.cache_periods and os.path.exists(potential_path):
+            self._periods = PeriodCache(self.w0_path, potential_path, self.norbits,
+                                        **self.period_cache_params)
+            self.periods_file = self._periods.filename
+
+        # wall time spent computing each orbit, filled in by the callback
+        self._orbit_times = np.zeros(self.norbits) + np.nan
+
     # Context management
     def __enter__(self):
-        self._tmpdir = os.path.join(self.cache_path, "_tmp_{0}".format(self.__class__.__name__))
-        logger.debug("Creating temp. directory {0}".format(self._tmpdir))
-        if os.path.exists(self._tmpdir):
-            import shutil
-            shutil.rmtree(self._tmpdir)
-        os.mkdir(self._tmpdir)
+        self._ensure_cache_exists()
+        self._open_writer()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if os.path.exists(self._tmpdir):
-            logger.debug("Removing temp. directory {0}".format(self._tmpdir))
-            import shutil
-            shutil.rmtree(self._tmpdir)
+        if self._timing['norbits'] > 0:
+            setup = self._timing['setup']
+            compute = self._timing['compute']
+            logger.info("{0} orbits: {1:.2f} s total worker setup time, {2:.2f} s total "
+                        "compute time ({3:.2%} setup)"
+                        .format(self._timing['norbits'], setup, compute,
+                                setup / max(setup + compute, 1E-300)))
+
+        # drop any per-process state, in case the cache is recreated later on
+        #   in this same process
+        _worker_state.pop((self.__class__.__name__, self.cache_file), None)
+
+        if self._writer is not None:
+            logger.debug("Flushing remaining results to {0}".format(self.cache_file))
+            self._writer.close()
+            self._writer = None
+
+        if self._history is not None:
+            self._history.close()
+            self._history = None
+
+        if self._periods is not None:
+            self._periods.close()
+
+    def __getstate__(self):
+        # the writer (open file handles, memmap) only lives on the master, and
+        #   workers read the initial conditions from their own memmap
+        state = self.__dict__.copy()
+        state['_writer'] = None
+        state['_history'] = None
+        state['_periods'] = None
+        state['w0'] = None
+        state['_orbit_times'] = None
+        return state
+
+    def _open_writer(self):
+        if self._writer is None:
+            self._writer = BufferedCacheWriter(self.cache_file, dtype=self.cache_dtype,
+                                               norbits=self.norbits,
+                                               buffer_size=self.cache_buffer_size,
+                                               flush_interval=self.cache_flush_interval,
+                                               journal_file=self.journal_file)
+        return self._writer
 
     def _ensure_cache_exists(self):
         # make sure memmap file exists
@@ -94,6 +181,19 @@ class OrbitGridExperiment(object):
                           dtype=self.cache_dtype, shape=(self.norbits,))
             d[:] = np.zeros(shape=(self.norbits,), dtype=self.cache_dtype)
 
+        else:
+            # orbits may have been appended to the grid (e.g., by refine.py):
+            #   pad the cache with empty rows, leaving existing results alone
+            itemsize = np.dtype(self.cache_dtype).itemsize
+            ncached = os.path.getsize(self.cache_file) // itemsize
+            if ncached < self.norbits:
+                logger.info("Extending cache from {0} to {1} orbits"
+                            .format(ncached, self.norbits))
+                with open(self.cache_file, 'r+b') as f:
+                    f.truncate(ncached*itemsize)
+                    f.seek(0, os.SEEK_END)
+                    f.write(np.zeros(self.norbits - ncached, dtype=self.cache_dtype).tobytes())
+
     def read_cache(self):
         """
         Read the numpy memmap'd file containing cached results from running
@@ -102,9 +202,64 @@ class OrbitGridExperiment(object):
         """
 
         # first get the memmap array
-        return np.memmap(self.cache_file, mode='r', shape=(len(self.w0),),
+        return np.memmap(self.cache_file, mode='r', shape=(self.norbits,),
                          dtype=self.cache_dtype)
 
+    @property
+    def _history_record_dtype(self):
+        return np.dtype([('index','i8')] + list(self.history_dtype))
+
+    def _write_history(self, index, history):
+        """
+        Append the history of a single orbit (a dictionary with keys from
+        ``history_dtype``) to the history file.
+        """
+        if self._history is None:
+            self._history = open(self.history_file, 'ab')
+
+        record = np.zeros(1, dtype=self._history_record_dtype)
+        record['index'] = index
+        for key in record.dtype.names[1:]:
+            if key in history:
+                record[key] = history[key]
+        self._history.write(record.tobytes())
+
+    def read_history(self):
+        """
+        Read the file of per-orbit histories. This returns a numpy structured
+        array with an ``index`` column (the orbit index) and the columns in
+        ``history_dtype``, sorted by index, with one row per orbit that has
+        been run. If an orbit was run more than once, the last history wins.
+        """
+        if self.history_dtype is None:
+            raise ValueError("This experiment doesn't store a history.")
+
+        dtype = self._history_record_dtype
+        if self._history is not None:
+            self._history.flush()
+
+        if not os.path.exists(self.history_file):
+            return np.zeros(0, dtype=dtype)
+
+        # ignore a partially written trailing record, if any
+        nrecords = os.path.getsize(self.history_file) // dtype.itemsize
+        d = np.fromfile(self.history_file, dtype=dtype, count=nrecords)
+
+        d = d[np.argsort(d['index'], kind='mergesort')]
+        keep = np.append(d['index'][1:] != d['index'][:-1], True)
+        return d[keep]
+
+    @classmethod
+    def map_value(cls, d):
+        """
+        The quantity that is mapped over the grid for this experiment (e.g., to
+        decide where to refine the grid -- see ``refine.py``), computed for each
+        row of the cache ``d``. Should be NaN for orbits that failed or haven't
+        been run yet. Subclasses that support refinement must implement this.
+        """
+        raise NotImplementedError("{0} doesn't define a map value."
+                                  .format(cls.__name__))
+
     def dump_config(self, config_filename):
         """
         Write the current configuration out to the specified filename.
@@ -122,71 +277,189 @@ class OrbitGridExperiment(object):
             config_path = config_filename
         return cls(cache_path=cache_path, overwrite=overwrite, **load(config_path))
 
-    def callback(self, tmpfile):
+    def callback(self, result):
         """
-        TODO:
+        Stage the result dictionary returned from running a single orbit (or
+        list of them, from a block of orbits) in the buffered cache writer.
+        ``None`` (e.g., the orbit was already completed) is ignored.
         """
 
-        if tmpfile is None:
-            logger.debug("Tempfile is None")
+        if result is None:
+            logger.debug("Result is None")
             return
 
-        with open(tmpfile) as f:
-            result = pickle.load(f)
-        os.remove(tmpfile)
+        # a block of orbits was run together
+        if isinstance(result, list):
+            for res in result:
+                self.callback(res)
+            return
 
-        logger.debug("Flushing {0} to output array...".format(result['index']))
-        memmap = np.memmap(self.cache_file, mode='r+',
-                           dtype=self.cache_dtype, shape=(len(self.w0),))
         if result['error_code'] != 0.:
             logger.error("Error code = {0}".format(result['error_code']))
-            # error happened
-            for key in memmap.dtype.names:
-                if key in result:
-                    memmap[key][result['index']] = result[key]
 
-        else:
-            # all is well
-            for key in memmap.dtype.names:
-                memmap[key][result['index']] = result[key]
+        history = result.pop('_history', None)
+        if history is not None:
+            self._write_history(result['index'], history)
+
+        periods = result.pop('_periods', None)
+        if periods is not None and self._periods is not None:
+            self._periods.write(result['index'], periods)
 
-        # flush to output array
-        memmap.flush()
-        logger.debug("...flushed, washing hands.")
+        logger.debug("Staging {0} for output array...".format(result['index']))
+        self._open_writer().write(result)
 
-        del result
-        del memmap
+        if '_compute_time' in result:
+            logger.debug("Orbit {0}: setup {1:.3f} s, compute {2:.3f} s"
+                         .format(result['index'], result['_setup_time'],
+                                 result['_compute_time']))
+            self._timing['setup'] += result['_setup_time']
+            self._timing['compute'] += result['_compute_time']
+            self._timing['norbits'] += 1
+            self._orbit_times[result['index']] = result['_compute_time']
 
     def __call__(self, index):
+        if np.ndim(index) > 0: # a block of orbit indices
+            if hasattr(self, 'run_batch') and getattr(self.config, 'batch_size', 1) > 1:
+                return self._run_batch_wrapper(index)
+            return [self._run_wrapper(i) for i in index]
         return self._run_wrapper(index)
 
-    def _run_wrapper(self, index):
-        logger.info("Orbit {0}".format(index))
+    @property
+    def mean_compute_time(self):
+        """
+        The mean wall time (in seconds) spent running a single orbit, measured
+        from the results received so far. ``None`` if no results are in yet.
+        """
+        if self._timing['norbits'] == 0:
+            return None
+        return self._timing['compute'] / self._timing['norbits']
+
+    def estimate_costs(self):
+        """
+        Predict the relative cost of running each orbit, proportional to the
+        total time the orbit has to be integrated for. If the cache contains
+        ``dt`` and ``nsteps`` from a previous run, those are used, otherwise the
+        cost is taken to be proportional to the dynamical time of the initial
+        conditions (rescaled to match any orbits that do have cached values).
+        """
+        costs = np.zeros(self.norbits) + np.nan
+
+        d = self.read_cache()
+        if 'dt' in d.dtype.names and 'nsteps' in d.dtype.names:
+            costs[:] = np.abs(d['dt']) * d['nsteps']
+            costs[costs <= 0] = np.nan
+        has_cost = np.isfinite(costs)
+
+        if not np.all(has_cost):
+            potential = self._setup_worker()['potential']
+            t_dyn = dynamical_time(self.w0, potential)
+
+            if np.any(has_cost):
+                scale = np.median(costs[has_cost] / t_dyn[has_cost])
+            else:
+                scale = 1.
+            costs[~has_cost] = scale * t_dyn[~has_cost]
+
+        logger.debug("Estimated costs for {0} orbits ({1} from a previous run)"
+                     .format(self.norbits, has_cost.sum()))
+        return costs
+
+    def _setup_worker(self):
+        """
+        Load everything that a worker process needs and that doesn't change
+        from orbit to orbit: the potential (and its C instance), and read-only
+        memmaps of the initial conditions and the cache file. This happens once
+        per process, the first time it runs an orbit from this experiment, and
+        the result is reused for all subsequent orbits.
+        """
+        key = (self.__class__.__name__, self.cache_file)
+        if key in _worker_state:
+            return _worker_state[key]
 
-        # unpack input argument dictionary
+        t1 = time.time()
         import gary.potential as gp
-        potential = gp.load(os.path.join(self.cache_path, self.config.potential_filename))
 
-        # read out just this initial condition
-        norbits = len(self.w0)
-        allfreqs = np.memmap(self.cache_file, mode='r',
-                             shape=(norbits,), dtype=self.cache_dtype)
+        state = dict()
+        state['potential'] = gp.load(os.path.join(self.cache_path, self.config.potential_filename))
+        state['w0'] = np.load(self.w0_path, mmap_mode='r')
+        state['cache'] = np.memmap(self.cache_file, mode='r',
+                                   shape=(self.norbits,), dtype=self.cache_dtype)
+        state['periods'] = None
+        if self.periods_file is not None:
+            state['periods'] = np.memmap(self.periods_file, mode='r',
+                                         shape=(self.norbits,), dtype=period_dtype)
+        state['setup_time'] = time.time() - t1
+        logger.debug("Worker {0} set up in {1:.3f} s".format(os.getpid(), state['setup_time']))
+
+        _worker_state[key] = state
+        return state
+
+    def _cached_periods(self, state, index):
+        """
+        The periods of the orbit at the given index from the period cache, or
+        ``None`` if they haven't been estimated yet, or were estimated for
+        different initial conditions (e.g., the grid was regenerated).
+        """
+        periods = state['periods']
+        if periods is None or not periods['success'][index]:
+            return None
+        if not np.all(periods['w0'][index] == state['w0'][index]):
+            return None
+        return periods[index].copy()
+
+    def _run_wrapper(self, index):
+        logger.info("Orbit {0}".format(index))
+
+        t1 = time.time()
+        state = self._setup_worker()
 
         # short-circuit if this orbit is already done
-        if allfreqs['success'][index]:
+        if state['cache']['success'][index]:
             logger.debug("Orbit {0} already successfully completed.".format(index))
             return None
 
         # Only pass in things specified in _run_kwargs (w0 and potential required)
         kwargs = dict([(k,self.config[k]) for k in self.config.keys() if k in self._run_kwargs])
-        res = self.run(w0=self.w0[index], potential=potential, **kwargs)
+        if self.cache_periods:
+            kwargs['periods'] = self._cached_periods(state, index)
+
+        t2 = time.time()
+        res = self.run(w0=np.array(state['w0'][index]), potential=state['potential'], **kwargs)
         res['index'] = index
+        res['_setup_time'] = t2 - t1
+        res['_compute_time'] = time.time() - t2
+
+        # results are passed back in memory and buffered by the callback
+        return res
+
+    def _run_batch_wrapper(self, index):
+        logger.info("Orbits {0} ({1} total)".format(index[0], len(index)))
 
-        # cache res into a tempfile, return name of tempfile
-        tmpfile = os.path.join(self._tmpdir, "{0}-{1}.pickle".format(self.__class__.__name__, index))
-        with open(tmpfile, 'w') as f:
-            pickle.dump(res, f)
-        return tmpfile
+        t1 = time.time()
+        state = self._setup_worker()
+
+        # short-circuit any orbits that are already done
+        index = np.asarray(index)
+        index = index[~state['cache']['success'][index]]
+        if len(index) == 0:
+            return None
+
+        kwargs = dict([(k,self.config[k]) for k in self.config.keys() if k in self._run_kwargs])
+        if self.cache_periods:
+            kwargs['periods'] = [self._cached_periods(state, i) for i in index]
+
+        t2 = time.time()
+        results = self.run_batch(w0=np.array(state['w0'][index]),
+                                 potential=state['potential'], **kwargs)
+        t3 = time.time()
+
+        # split the timing evenly over the orbits in the block
+        for i,res in zip(index, results):
+            res['index'] = i
+            res['_setup_time'] = (t2 - t1) / len(index)
+            res['_compute_time'] = (t3 - t2) / len(index)
+
+        return results
 
     def status(self):
         """
@@ -241,6 +514,11 @@ class OrbitGridExperiment(object):
     def run(cls, w0, potential, **kwargs):
         """ (classmethod) Run the experiment on a single orbit """
 
+    # Subclasses may also implement a classmethod ``run_batch(w0, potential, **kwargs)``
+    #   that takes a 2D array of initial conditions and returns a list of result
+    #   dicts. It is used for blocks of orbits (see --chunk-time) if the config
+    #   has batch_size > 1.
+
 # ----------------------------------------------------------------------------
 
 class ExperimentRunner(object):
@@ -266,6 +544,14 @@ class ExperimentRunner(object):
     parser.add_argument("--index", dest="index", type=str, default=None,
                         help="Specify a subset of orbits to run, e.g., "
                              "--index=20:40 to do only orbits 20-39.")
+    parser.add_argument("--schedule", dest="schedule", type=str, default="index",
+                        choices=["index", "cost"],
+                        help="Order in which to dispatch orbits: by index, or by "
+                             "predicted cost (most expensive first).")
+    parser.add_argument("--chunk-time", dest="chunk_time", type=float, default=None,
+                        help="Send orbits to the workers in blocks that take roughly "
+                             "this many seconds to run. Default is to send one "
+                             "orbit at a time.")
 
     def _parse_args(self):
         # Define parser object
@@ -330,11 +616,99 @@ class ExperimentRunner(object):
             else:
                 indices = np.arange(experiment.norbits, dtype=int)[index]
 
+            if args.schedule == 'cost':
+                costs = experiment.estimate_costs()
+                indices = indices[longest_first(costs[indices])]
+            else:
+                costs = None
+
+            t1 = time.time()
             try:
-                pool.map(experiment, indices, callback=experiment.callback)
+                if args.chunk_time is None:
+                    pool.map(experiment, indices, callback=experiment.callback)
+                else:
+                    self._run_chunked(pool, experiment, indices, args.chunk_time,
+                                      costs=costs)
             except:
                 pool.close()
                 logger.error("Unexpected error!")
                 raise
             else:
                 pool.close()
+
+            if costs is not None:
+                self._report_makespan(experiment, indices, costs,
+                                      nworkers=max(getattr(pool, 'size', 1), 1),
+                                      wall_time=time.time() - t1)
+
+    def _run_chunked(self, pool, experiment, indices, chunk_time, costs=None):
+        """
+        Dispatch the orbits in blocks. First, run one orbit per worker to
+        measure the time per orbit, then split the rest of the orbits into
+        blocks that shrink towards the end of the run and take at most
+        ``chunk_time`` seconds each. If the predicted ``costs`` of the orbits
+        are given, the pilot run instead measures the time per unit cost, and
+        the blocks are sized by their total predicted cost.
+        """
+        nworkers = max(getattr(pool, 'size', 1), 1)
+
+        # pilot run: one orbit per worker
+        pilot, indices = indices[:nworkers], indices[nworkers:]
+        pool.map(experiment, pilot, callback=experiment.callback)
+
+        sec_per_cost = None
+        if costs is not None:
+            sec_per_cost = self._sec_per_cost(experiment, pilot, costs)
+
+        if sec_per_cost is not None:
+            logger.info("Time per unit cost: {0:.3e} s".format(sec_per_cost))
+            chunks = guided_chunks(indices, nworkers, costs=costs[indices],
+                                   max_cost=chunk_time / sec_per_cost)
+
+        else:
+            orbit_time = experiment.mean_compute_time
+            if orbit_time is None or orbit_time <= 0.:
+                max_chunk = None
+            else:
+                max_chunk = max(int(chunk_time / orbit_time), 1)
+                logger.info("Mean time per orbit: {0:.3f} s".format(orbit_time))
+
+            chunks = guided_chunks(indices, nworkers, max_chunk=max_chunk)
+        if len(chunks) > 0:
+            logger.info("Dispatching {0} orbits in {1} blocks of {2} to {3} orbits"
+                        .format(len(indices), len(chunks),
+                                min(map(len,chunks)), max(map(len,chunks))))
+
+        pool.map(experiment, chunks, callback=experiment.callback)
+
+    def _sec_per_cost(self, experiment, indices, costs):
+        """
+        The measured run time per unit of predicted cost for the orbits that
+        have run, or ``None`` if none of them have.
+        """
+        times = experiment._orbit_times[indices]
+        ran = np.isfinite(times) & np.isfinite(costs[indices])
+        if not np.any(ran) or costs[indices][ran].sum() <= 0. or times[ran].sum() <= 0.:
+            return None
+        return times[ran].sum() / costs[indices][ran].sum()
+
+    def _report_makespan(self, experiment, indices, costs, nworkers, wall_time):
+        """
+        Compare the predicted total run time (using the predicted costs,
+        calibrated to seconds with the measured time per orbit) to the actual
+        wall time of the run.
+        """
+        # convert from cost units to seconds
+        sec_per_cost = self._sec_per_cost(experiment, indices, costs)
+        if sec_per_cost is None:
+            return
+
+        times = experiment._orbit_times[indices]
+        ran = np.isfinite(times) & np.isfinite(costs[indices])
+        predicted = predict_makespan(sec_per_cost * costs[indices][ran], nworkers)
+        predicted_index = predict_makespan(sec_per_cost * costs[np.sort(indices[ran])], nworkers)
+        ideal = predict_makespan(times[ran], nworkers)
+
+        logger.info("Makespan on {0} workers: predicted {1:.1f} s (index order: {2:.1f} s), "
+                    "measured orbit times {3:.1f} s, actual wall time {4:.1f} s"
+                    .format(nworkers, predicted, predicted_index, ideal, wall_time))
@@ -17,6 +17,8 @@ cimport numpy as np
 np.import_array()
 
 from libc.stdio cimport printf
+from libc.stdlib cimport calloc, malloc, free
+from cython.parallel cimport parallel, prange
 
 from gary.potential.cpotential cimport _CPotential
 
@@ -35,46 +37,259 @@ cdef extern from "dop853.h":
                 double* rtoler, double* atoler, int itoler, SolTrait solout,
                 int iout, FILE* fileout, double uround, double safe, double fac1,
                 double fac2, double beta, double hmax, double h, long nmax, int meth,
-                long nstiff, unsigned nrdens, unsigned* icont, unsigned licont)
+                long nstiff, unsigned nrdens, unsigned* icont, unsigned licont) nogil
 
     void Fwrapper (unsigned ndim, double t, double *w, double *f,
-                   GradFn func, double *pars, unsigned norbits)
+                   GradFn func, double *pars, unsigned norbits) nogil
     double six_norm (double *x)
 
+cdef extern from "dop853_ws.h":
+    ctypedef struct Dop853Workspace:
+        double hnext
+
+    # Re-entrant DOP853 -- each thread needs its own workspace
+    int dop853_ws_alloc (Dop853Workspace *ws, unsigned n) nogil
+    void dop853_ws_free (Dop853Workspace *ws) nogil
+    int dop853_ws (Dop853Workspace *ws, FcnEqDiff fcn, GradFn gradfunc, double *gpars,
+                   unsigned norbits, double x, double *y, double xend,
+                   double rtol, double atol, double h, long nmax) nogil
+    int dop853_ws_dense (Dop853Workspace *ws, FcnEqDiff fcn, GradFn gradfunc, double *gpars,
+                         unsigned norbits, double x, double *y, double xend,
+                         double rtol, double atol, double h, long nmax,
+                         double *tout, unsigned nout, double *yout) nogil
+
 cdef extern from "stdio.h":
     ctypedef struct FILE
     FILE *stdout
 
 cpdef ensemble_integrate(_CPotential cpotential, double[:,::1] w0,
-                         double dt0, int nsteps, double t0):
+                         double dt0, int nsteps, double t0, double[:,::1] out=None):
+    """
+    Integrate all orbits in the ensemble as one system of ODEs (with one
+    shared step size), stopping at the same ``nsteps`` times as
+    ``np.linspace(t0, nsteps*dt0, nsteps)``.
+
+    If ``out`` is given, the final positions are written to this array
+    (which may be ``w0`` itself, to integrate in place) and no new arrays
+    are allocated, so this can be called repeatedly in a loop. The DOP853
+    workspace is allocated once per call rather than once per step.
+    """
     cdef:
-        int i, j, k
-        int res
+        int j
+        int res = 1
         unsigned norbits = w0.shape[0]
         unsigned ndim = w0.shape[1]
-        double[::1] t = np.empty(nsteps)
-        double[::1] w = np.empty(norbits*ndim)
+        Dop853Workspace ws
 
         # Note: icont not needed because nrdens == ndim
         double t_end = (<double>nsteps) * dt0
+        double t1, t2, step
 
         # set these here
         double atol = 1E-8
         double rtol = 1E-8
 
+        GradFn gradfunc = <GradFn>cpotential.c_gradient
+        double *gpars = &(cpotential._parameters[0])
+
+    if out is None:
+        out = np.empty((norbits, ndim))
+
+    elif out.shape[0] != norbits or out.shape[1] != ndim:
+        raise ValueError("Output array must have the same shape as the initial conditions.")
+
     # store initial conditions
+    if &out[0,0] != &w0[0,0]:
+        out[:,:] = w0
+
+    if dop853_ws_alloc(&ws, ndim*norbits) != 0:
+        raise MemoryError("Failed to allocate integrator workspace.")
+
+    # same times as np.linspace(t0, t_end, nsteps), computed on the fly
+    if nsteps > 1:
+        step = (t_end - t0) / (nsteps - 1)
+
+    with nogil:
+        t1 = t0
+        for j in range(1,nsteps,1):
+            if j == nsteps-1:
+                t2 = t_end
+            else:
+                t2 = t0 + j*step
+
+            res = dop853_ws(&ws, <FcnEqDiff> Fwrapper, gradfunc, gpars, norbits,
+                            t1, &out[0,0], t2, rtol, atol, dt0, 0)
+            if res < 0:
+                break
+            t1 = t2
+
+    dop853_ws_free(&ws)
+
+    if res == -1:
+        raise RuntimeError("Input is not consistent.")
+    elif res == -2:
+        raise RuntimeError("Larger nmax is needed.")
+    elif res == -3:
+        raise RuntimeError("Step size becomes too small.")
+    elif res == -4:
+        raise RuntimeError("The problem is probably stff (interrupted).")
+
+    return np.asarray(out)
+
+cpdef ensemble_integrate_independent(_CPotential cpotential, double[:,::1] w0,
+                                     double dt0, int nsteps, double t0, int nthreads=1,
+                                     double[:,::1] out=None):
+    """
+    Same as ``ensemble_integrate()``, but each orbit is integrated on its own
+    with a separate DOP853 state, so the adaptive step size of one orbit
+    (e.g., a particle passing close to the center) doesn't set the step size
+    for the whole ensemble. The loop over orbits runs without the GIL and is
+    split over ``nthreads`` OpenMP threads, each with its own integrator
+    workspace. ``out`` works the same as for ``ensemble_integrate()``.
+    """
+    cdef:
+        int i
+        int res
+        unsigned norbits = w0.shape[0]
+        unsigned ndim = w0.shape[1]
+        int[::1] status = np.ones(norbits, dtype=np.int32)
+        Dop853Workspace *ws
+
+        # set by any thread that fails to allocate its workspace
+        int[::1] failed = np.zeros(1, dtype=np.int32)
+
+        # same start and end times as ensemble_integrate()
+        double t_end = (<double>nsteps) * dt0
+
+        # set these here
+        double atol = 1E-8
+        double rtol = 1E-8
+
+        GradFn gradfunc = <GradFn>cpotential.c_gradient
+        double *gpars = &(cpotential._parameters[0])
+
+    if out is None:
+        out = np.empty((norbits, ndim))
+
+    elif out.shape[0] != norbits or out.shape[1] != ndim:
+        raise ValueError("Output array must have the same shape as the initial conditions.")
+
+    if &out[0,0] != &w0[0,0]:
+        out[:,:] = w0
+
+    with nogil, parallel(num_threads=nthreads):
+        # zeroed, so the workspace can be freed even if allocating it failed
+        ws = <Dop853Workspace*>calloc(1, sizeof(Dop853Workspace))
+        if ws == NULL or dop853_ws_alloc(ws, ndim) != 0:
+            failed[0] = 1
+
+        # can't raise in the parallel block: stop taking orbits instead
+        for i in prange(norbits, schedule='dynamic'):
+            if failed[0] == 0:
+                status[i] = dop853_ws(ws, <FcnEqDiff> Fwrapper, gradfunc, gpars, 1,
+                                      t0, &out[i,0], t_end, rtol, atol, dt0, 0)
+
+        if ws != NULL:
+            dop853_ws_free(ws)
+            free(ws)
+
+    if failed[0]:
+        raise MemoryError("Failed to allocate integrator workspace.")
+
     for i in range(norbits):
-        for k in range(ndim):
-            w[i*ndim + k] = w0[i,k]
+        res = status[i]
+        if res == -1:
+            raise RuntimeError("Input is not consistent.")
+        elif res == -2:
+            raise RuntimeError("Larger nmax is needed.")
+        elif res == -3:
+            raise RuntimeError("Step size becomes too small.")
+        elif res == -4:
+            raise RuntimeError("The problem is probably stff (interrupted).")
+
+    return np.asarray(out)
+
+cpdef ensemble_integrate_dense(_CPotential cpotential, double[:,::1] w0, double[::1] t,
+                               double dt0=0., int per_orbit_steps=0, int nthreads=1,
+                               long nmax=0):
+    """
+    Integrate the ensemble from ``t[0]`` to ``t[-1]`` in one uninterrupted
+    DOP853 integration, and sample the orbits at all of the (sorted) times
+    ``t`` with the continuous extension of the method. Unlike calling
+    ``ensemble_integrate()`` for each interval, the integrator isn't
+    restarted (with a new step size guess) at each output time, and the
+    steps aren't cut short to land on the output times.
+
+    By default, all orbits are integrated as one system with one shared step
+    size. With ``per_orbit_steps``, each orbit is integrated on its own, as
+    in ``ensemble_integrate_independent()``, split over ``nthreads`` threads.
+    ``dt0`` is the initial step size (0 to let DOP853 choose), and ``nmax``
+    the maximum number of steps for the whole integration (0 for 100000 per
+    output time).
+
+    Returns the orbits at the times ``t``, with shape ``(len(t), norbits, ndim)``.
+    """
+    cdef:
+        int i
+        int res = 1
+        unsigned norbits = w0.shape[0]
+        unsigned ndim = w0.shape[1]
+        unsigned nout = t.shape[0]
+        int[::1] status
+        double[:,::1] w = np.array(w0)
+        double[:,:,::1] wout
+        Dop853Workspace ws
+        Dop853Workspace *tws
+
+        # set by any thread that fails to allocate its workspace
+        int[::1] failed = np.zeros(1, dtype=np.int32)
+
+        # same tolerances as ensemble_integrate()
+        double atol = 1E-8
+        double rtol = 1E-8
+
+        GradFn gradfunc = <GradFn>cpotential.c_gradient
+        double *gpars = &(cpotential._parameters[0])
+
+    if nmax <= 0:
+        nmax = 100000 * nout
+
+    if not per_orbit_steps:
+        wout = np.zeros((nout,norbits,ndim)) + np.nan
+        if dop853_ws_alloc(&ws, ndim*norbits) != 0:
+            raise MemoryError("Failed to allocate integrator workspace.")
+
+        with nogil:
+            res = dop853_ws_dense(&ws, <FcnEqDiff> Fwrapper, gradfunc, gpars, norbits,
+                                  t[0], &w[0,0], t[nout-1], rtol, atol, dt0, nmax,
+                                  &t[0], nout, &wout[0,0,0])
+        dop853_ws_free(&ws)
+        status = np.array([res], dtype=np.int32)
+
+    else:
+        # each orbit writes its samples contiguously, so the orbit axis comes first
+        wout = np.zeros((norbits,nout,ndim)) + np.nan
+        status = np.ones(norbits, dtype=np.int32)
+        with nogil, parallel(num_threads=nthreads):
+            tws = <Dop853Workspace*>calloc(1, sizeof(Dop853Workspace))
+            if tws == NULL or dop853_ws_alloc(tws, ndim) != 0:
+                failed[0] = 1
+
+            for i in prange(norbits, schedule='dynamic'):
+                if failed[0] == 0:
+                    status[i] = dop853_ws_dense(tws, <FcnEqDiff> Fwrapper, gradfunc, gpars, 1,
+                                                t[0], &w[i,0], t[nout-1], rtol, atol, dt0, nmax,
+                                                &t[0], nout, &wout[i,0,0])
+
+            if tws != NULL:
+                dop853_ws_free(tws)
+                free(tws)
 
-    # define full array of times
-    t = np.linspace(t0, t_end, nsteps)
-    for j in range(1,nsteps,1):
-        res = dop853(ndim*norbits, <FcnEqDiff> Fwrapper,
-                     <GradFn>cpotential.c_gradient, &(cpotential._parameters[0]), norbits,
-                     t[j-1], &w[0], t[j], &rtol, &atol, 0, NULL, 0,
-                     NULL, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, dt0, 0, 0, 1, 0, NULL, 0);
+        if failed[0]:
+            raise MemoryError("Failed to allocate integrator workspace.")
 
+    for i in range(status.shape[0]):
+        res = status[i]
         if res == -1:
             raise RuntimeError("Input is not consistent.")
         elif res == -2:
@@ -84,4 +299,6 @@ cpdef ensemble_integrate(_CPotential cpotential, double[:,::1] w0,
         elif res == -4:
             raise RuntimeError("The problem is probably stff (interrupted).")
 
-    return np.asarray(w).reshape(norbits, ndim)
+    if per_orbit_steps:
+        return np.ascontiguousarray(np.asarray(wout).transpose(1,0,2))
+    return np.asarray(wout)
@@ -0,0 +1,75 @@
+# coding: utf-8
+# cython: boundscheck=False
+# cython: nonecheck=False
+# cython: cdivision=True
+# cython: wraparound=False
+# cython: profile=False
+
+""" Adaptive DOP853 integration with dense output in Cython. """
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Third-party
+import numpy as np
+cimport numpy as np
+np.import_array()
+
+from gary.potential.cpotential cimport _CPotential
+
+cdef extern from "dop853.h":
+    ctypedef void (*GradFn)(double *pars, double *q, double *grad) nogil
+    ctypedef void (*FcnEqDiff)(unsigned n, double x, double *y, double *f, GradFn gradfunc, double *gpars, unsigned norbits) nogil
+
+    void Fwrapper (unsigned ndim, double t, double *w, double *f,
+                   GradFn func, double *pars, unsigned norbits) nogil
+
+cdef extern from "dop853_ws.h":
+    ctypedef struct Dop853Workspace:
+        unsigned ndense
+        long nfcn
+
+    int dop853_ws_alloc (Dop853Workspace *ws, unsigned n) nogil
+    void dop853_ws_free (Dop853Workspace *ws) nogil
+    int dop853_ws_dense (Dop853Workspace *ws, FcnEqDiff fcn, GradFn gradfunc, double *gpars,
+                         unsigned norbits, double x, double *y, double xend,
+                         double rtol, double atol, double h, long nmax,
+                         double *tout, unsigned nout, double *yout) nogil
+
+cpdef dense_integrate(_CPotential cpotential, double[::1] w0, double[::1] t,
+                      double atol, double rtol, int nmax):
+    """
+    Integrate a single orbit from ``t[0]`` to ``t[-1]`` with error-controlled
+    steps, and interpolate the orbit at all of the (sorted) times ``t``
+    using the continuous extension of DOP853. Unlike ``integrate_orbit()``,
+    the step size is chosen only by the error control, not by the spacing
+    of the output times.
+
+    Returns the orbit, with shape ``(len(t), len(w0))``, the DOP853 status
+    code, and the number of force evaluations. If the integration fails,
+    the rows after the time of the failure are NaN.
+    """
+    cdef:
+        int res
+        unsigned ndim = w0.shape[0]
+        unsigned nout = t.shape[0]
+        double[::1] w = np.array(w0)
+        double[:,::1] wout = np.zeros((nout,ndim)) + np.nan
+        Dop853Workspace ws
+
+        GradFn gradfunc = <GradFn>cpotential.c_gradient
+        double *gpars = &(cpotential._parameters[0])
+
+    if dop853_ws_alloc(&ws, ndim) != 0:
+        raise MemoryError("Failed to allocate integrator workspace.")
+
+    with nogil:
+        res = dop853_ws_dense(&ws, <FcnEqDiff> Fwrapper, gradfunc, gpars, 1,
+                              t[0], &w[0], t[nout-1], rtol, atol, 0., nmax,
+                              &t[0], nout, &wout[0,0])
+
+    nfcn = ws.nfcn
+    dop853_ws_free(&ws)
+
+    return np.array(wout), res, nfcn
@@ -17,12 +17,15 @@ cimport numpy as np
 np.import_array()
 
 from libc.stdio cimport printf
+from libc.stdlib cimport calloc, malloc, free
+from cython.parallel cimport parallel, prange
 
 from gary.potential.cpotential cimport _CPotential
 
 cdef extern from "math.h":
     double sqrt(double x) nogil
     double log(double x) nogil
+    double fabs(double x) nogil
 
 cdef extern from "dop853.h":
     ctypedef void (*GradFn)(double *pars, double *q, double *grad) nogil
@@ -39,20 +42,108 @@ cdef extern from "dop853.h":
                 long nstiff, unsigned nrdens, unsigned* icont, unsigned licont)
 
     void Fwrapper (unsigned ndim, double t, double *w, double *f,
-                   GradFn func, double *pars, unsigned norbits)
-    double six_norm (double *x)
+                   GradFn func, double *pars, unsigned norbits) nogil
+    double six_norm (double *x) nogil
+
+cdef extern from "dop853_ws.h":
+    ctypedef struct Dop853Workspace:
+        double hnext
+
+    # Re-entrant DOP853 -- each thread needs its own workspace
+    int dop853_ws_alloc (Dop853Workspace *ws, unsigned n) nogil
+    void dop853_ws_free (Dop853Workspace *ws) nogil
+    int dop853_ws (Dop853Workspace *ws, FcnEqDiff fcn, GradFn gradfunc, double *gpars,
+                   unsigned norbits, double x, double *y, double xend,
+                   double rtol, double atol, double h, long nmax) nogil
 
 cdef extern from "stdio.h":
     ctypedef struct FILE
     FILE *stdout
 
+# status codes returned (along with the DOP853 failure codes) by the
+#   Lyapunov exponent kernels when they stop integrating early
+cdef int MLE_CONVERGED = 2
+cdef int MLE_REGULAR = 3
+
+# number of successive convergence checks that have to agree before stopping
+cdef int NCHECKS = 2
+
+cdef int _check_convergence(double lyap_sum, double t, double *lyap_prev, double *t_prev,
+                            int *nconverged, int *nregular,
+                            double convergence_tol, double regular_slope) nogil:
+    """
+    Online convergence test for the running (finite-time) estimate of the
+    Lyapunov exponent, ``lyap_sum / t`` after integrating for a time ``t``.
+    This is called at geometrically spaced times (each check at twice the
+    time of the previous one), and compares to the estimate from the last
+    check, stored in ``lyap_prev`` and ``t_prev``.
+
+    Returns ``MLE_CONVERGED`` if the estimate changed by less than a fraction
+    ``convergence_tol``, or ``MLE_REGULAR`` if it is decaying as a power law
+    in time steeper than ``regular_slope`` (regular orbits have an estimate
+    that decays like ~1/t), for ``NCHECKS`` checks in a row. Otherwise,
+    returns 0 to keep integrating.
+    """
+    cdef double lyap, slope
+
+    lyap = lyap_sum / t
+    if t_prev[0] > 0 and lyap > 0 and lyap_prev[0] > 0:
+        if fabs(lyap - lyap_prev[0]) < convergence_tol*lyap:
+            nconverged[0] = nconverged[0] + 1
+        else:
+            nconverged[0] = 0
+
+        slope = log(lyap / lyap_prev[0]) / log(t / t_prev[0])
+        if slope < regular_slope:
+            nregular[0] = nregular[0] + 1
+        else:
+            nregular[0] = 0
+
+    lyap_prev[0] = lyap
+    t_prev[0] = t
+
+    if nconverged[0] >= NCHECKS:
+        return MLE_CONVERGED
+    elif nregular[0] >= NCHECKS:
+        return MLE_REGULAR
+    return 0
+
+cdef inline long _segment_nmax(int nmax, int nsteps) nogil:
+    """
+    Maximum number of integrator steps for integrating over ``nsteps`` time
+    steps in one call, with ``nmax`` (or DOP853's default if 0) per time step.
+    """
+    if nmax <= 0:
+        return 100000 * (<long>nsteps)
+    return (<long>nmax) * nsteps
+
 cpdef max_lyapunov_exp(_CPotential cpotential, double[:,::1] w0,
                        double dt, int nsteps, double t0,
                        double atol, double rtol, int nmax,
-                       double d0, int nsteps_per_pullback):
+                       double d0, int nsteps_per_pullback,
+                       double convergence_tol=0., double regular_slope=-0.8,
+                       int min_nsteps=0):
+    """
+    If ``convergence_tol`` is > 0, the running estimate of the Lyapunov
+    exponent is checked for convergence at geometrically spaced times (but
+    not before ``min_nsteps`` steps) and the integration stops early once it
+    converges or the orbit looks regular -- see ``_check_convergence()``.
+    The returned time is the time at which the integration stopped.
+
+    The orbits are integrated from one pullback to the next in a single
+    call to the integrator, so the step size is set by the error control
+    rather than by ``dt``; ``dt`` is the initial step size, and ``nmax`` is
+    the maximum number of integrator steps per ``dt``.
+    """
     cdef:
         int i, j, k, jiter
         int res
+        Dop853Workspace ws
+        int stop = 0
+        int next_check = max(min_nsteps, nsteps_per_pullback)
+        double t_start = t0
+        double lyap_prev = 0., t_prev = 0., lyap_sum
+        int nconverged = 0, nregular = 0
 
         unsigned norbits = w0.shape[0]
         unsigned noffset_orbits = norbits - 1
@@ -69,13 +160,28 @@ cpdef max_lyapunov_exp(_CPotential cpotential, double[:,::1] w0,
         for k in range(ndim):
             w[i*ndim + k] = w0[i,k]
 
-    # dummy counter for storing Lyapunov stuff, which only happens every few steps
-    for j in range(1,nsteps+1,1):
-        t = t0 + dt
-        res = dop853(ndim*norbits, <FcnEqDiff> Fwrapper,
-                     <GradFn>cpotential.c_gradient, &(cpotential._parameters[0]), norbits,
-                     t0, &w[0], t, &rtol, &atol, 0, NULL, 0,
-                     NULL, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, dt, nmax, 0, 1, 0, NULL, 0);
+    if dop853_ws_alloc(&ws, ndim*norbits) != 0:
+        raise MemoryError("Failed to allocate integrator workspace.")
+
+    # integrate straight to each pullback, starting from the last step size
+    ws.hnext = dt
+    t = t0
+    j = 0
+    while j < nsteps:
+        jiter = min(nsteps_per_pullback, nsteps - j)
+        j = j + jiter
+
+        # same (accumulated) times as stepping by dt
+        t = t0
+        for k in range(jiter):
+            t = t + dt
+
+        res = dop853_ws(&ws, <FcnEqDiff> Fwrapper,
+                        <GradFn>cpotential.c_gradient, &(cpotential._parameters[0]), norbits,
+                        t0, &w[0], t, rtol, atol, ws.hnext, _segment_nmax(nmax, jiter))
+
+        if res < 0:
+            dop853_ws_free(&ws)
 
         if res == -1:
             raise RuntimeError("Input is not consistent.")
@@ -99,14 +205,463 @@ cpdef max_lyapunov_exp(_CPotential cpotential, double[:,::1] w0,
                 for k in range(ndim):
                     w[(i+1)*ndim + k] = w[k] + d0 * d1[i,k] / d1_mag
 
+            if convergence_tol > 0 and j >= next_check:
+                lyap_sum = 0.
+                for i in range(noffset_orbits):
+                    lyap_sum = lyap_sum + LEs[i] / noffset_orbits
+                stop = _check_convergence(lyap_sum, t - t_start, &lyap_prev, &t_prev,
+                                          &nconverged, &nregular,
+                                          convergence_tol, regular_slope)
+                next_check = 2*j
+
         t0 = t
+        if stop:
+            break
+
+    dop853_ws_free(&ws)
 
     # LEs = np.array([np.sum(LEs[:j],axis=0)/t[j*nsteps_per_pullback] for j in range(1,niter)])
     return np.array(LEs) / t, t, np.array(w).reshape(norbits,ndim)
 
+cdef int _mle_one(Dop853Workspace *ws, GradFn gradfunc, double *gpars,
+                  double *w, unsigned norbits, unsigned ndim,
+                  double dt, int nsteps, double t0,
+                  double atol, double rtol, int nmax,
+                  double d0, int nsteps_per_pullback,
+                  double convergence_tol, double regular_slope, int min_nsteps,
+                  int nhistory, int *history_steps, double *history_t, double *history,
+                  double *d1, double *LEs, double *t_stop) nogil:
+    """
+    Same algorithm as ``max_lyapunov_exp()`` for a single parent orbit (the
+    first ``ndim`` elements of ``w``) and its offset orbits, but using the
+    given integrator workspace so it can be called from many threads.
+    The orbits are integrated from one pullback to the next in one call to
+    the integrator, as in ``max_lyapunov_exp()``.
+    Returns the DOP853 status code, or ``MLE_CONVERGED`` / ``MLE_REGULAR``
+    if the integration stopped early, and stores the final time in
+    ``t_stop``. The running estimate is recorded in ``history`` (and the
+    times in ``history_t``) at the first pullback on or after each of the
+    ``nhistory`` steps in ``history_steps``.
+    """
+    cdef:
+        int i, j, k, jiter
+        int res = 1
+        int stop = 0
+        int ihistory = 0
+        int next_check = nsteps_per_pullback
+        unsigned noffset_orbits = norbits - 1
+        double t, d1_mag
+        double t_start = t0
+        double lyap_prev = 0., t_prev = 0., lyap_sum
+        int nconverged = 0, nregular = 0
+
+    if min_nsteps > next_check:
+        next_check = min_nsteps
+
+    for i in range(noffset_orbits):
+        LEs[i] = 0.
+
+    ws.hnext = dt
+    j = 0
+    while j < nsteps:
+        jiter = min(nsteps_per_pullback, nsteps - j)
+        j = j + jiter
+
+        # same (accumulated) times as stepping by dt
+        t = t0
+        for k in range(jiter):
+            t = t + dt
+
+        res = dop853_ws(ws, <FcnEqDiff> Fwrapper, gradfunc, gpars, norbits,
+                        t0, w, t, rtol, atol, ws.hnext, _segment_nmax(nmax, jiter))
+        if res < 0:
+            return res
+
+        if (j % nsteps_per_pullback) == 0:
+            # get magnitude of deviation vector
+            for i in range(noffset_orbits):
+                for k in range(ndim):
+                    d1[k] = w[(i+1)*ndim + k] - w[k]
+
+                d1_mag = six_norm(d1)
+                LEs[i] = LEs[i] + log(d1_mag / d0)
+
+                # renormalize offset orbits
+                for k in range(ndim):
+                    w[(i+1)*ndim + k] = w[k] + d0 * d1[k] / d1_mag
+
+            lyap_sum = 0.
+            for i in range(noffset_orbits):
+                lyap_sum = lyap_sum + LEs[i] / noffset_orbits
+
+            while ihistory < nhistory and history_steps[ihistory] <= j:
+                history_t[ihistory] = t
+                history[ihistory] = lyap_sum / (t - t_start)
+                ihistory = ihistory + 1
+
+            if convergence_tol > 0 and j >= next_check:
+                stop = _check_convergence(lyap_sum, t - t_start, &lyap_prev, &t_prev,
+                                          &nconverged, &nregular,
+                                          convergence_tol, regular_slope)
+                next_check = 2*j
+
+        t0 = t
+        if stop:
+            res = stop
+            break
+
+    for i in range(noffset_orbits):
+        LEs[i] = LEs[i] / t0
+    t_stop[0] = t0
+
+    return res
+
+cpdef max_lyapunov_exp_many(_CPotential cpotential, double[:,:,::1] w0,
+                            double[::1] dt, int[::1] nsteps, double t0,
+                            double atol, double rtol, int nmax,
+                            double d0, int nsteps_per_pullback, int nthreads=1,
+                            double convergence_tol=0., double regular_slope=-0.8,
+                            int min_nsteps=0, int[:,::1] history_steps=None,
+                            double[:,::1] history_t=None, double[:,::1] history=None):
+    """
+    Estimate the maximum Lyapunov exponent for many independent orbits at
+    once. ``w0`` has shape (norbits, noffset_orbits+1, ndim) where the first
+    row for each orbit is the parent orbit, and each orbit has its own
+    timestep and number of steps. Orbits are distributed over ``nthreads``
+    OpenMP threads without the GIL, each thread with its own integrator
+    workspace.
+
+    Unlike ``max_lyapunov_exp()``, a failed integration does not raise an
+    error but is reported in the returned array of DOP853 status codes
+    (negative = failure) so that one bad orbit doesn't lose the rest. With
+    ``convergence_tol`` > 0, orbits can stop early as in
+    ``max_lyapunov_exp()``: the status is then ``MLE_CONVERGED`` (2) or
+    ``MLE_REGULAR`` (3), and the returned times are the stopping times.
+
+    If ``history_steps`` (shape (norbits, nhistory)) is given, the running
+    (finite-time) estimate of the exponent at these steps is written to the
+    preallocated arrays ``history`` and ``history_t`` (same shape). Entries
+    after an orbit stops early are not touched.
+    """
+    cdef:
+        int i
+        unsigned norbits = w0.shape[0]
+        unsigned nsub = w0.shape[1]
+        unsigned ndim = w0.shape[2]
+
+        double[:,:,::1] w = np.array(w0, copy=True)
+        double[:,::1] LEs = np.zeros((norbits,nsub-1))
+        double[::1] t = np.zeros(norbits)
+        int[::1] status = np.ones(norbits, dtype=np.int32)
+
+        Dop853Workspace *ws
+        double *d1
+
+        # set by any thread that fails to allocate its workspace
+        int[::1] failed = np.zeros(1, dtype=np.int32)
+
+        GradFn gradfunc = <GradFn>cpotential.c_gradient
+        double *gpars = &(cpotential._parameters[0])
+
+        int nhistory = 0
+        int *hsteps = NULL
+        double *ht = NULL
+        double *hist = NULL
+
+    if history_steps is not None:
+        nhistory = history_steps.shape[1]
+        hsteps = &history_steps[0,0]
+        ht = &history_t[0,0]
+        hist = &history[0,0]
+
+    with nogil, parallel(num_threads=nthreads):
+        # zeroed, so the workspace can be freed even if allocating it failed
+        ws = <Dop853Workspace*>calloc(1, sizeof(Dop853Workspace))
+        d1 = <double*>malloc(ndim*sizeof(double))
+        if ws == NULL or d1 == NULL or dop853_ws_alloc(ws, ndim*nsub) != 0:
+            failed[0] = 1
+
+        # can't raise in the parallel block: stop taking orbits instead
+        for i in prange(norbits, schedule='dynamic'):
+            if failed[0] == 0:
+                status[i] = _mle_one(ws, gradfunc, gpars, &w[i,0,0], nsub, ndim,
+                                     dt[i], nsteps[i], t0, atol, rtol, nmax,
+                                     d0, nsteps_per_pullback,
+                                     convergence_tol, regular_slope, min_nsteps,
+                                     nhistory, hsteps + i*nhistory, ht + i*nhistory,
+                                     hist + i*nhistory, d1, &LEs[i,0], &t[i])
+
+        if ws != NULL:
+            dop853_ws_free(ws)
+            free(ws)
+        if d1 != NULL:
+            free(d1)
+
+    if failed[0]:
+        raise MemoryError("Failed to allocate integrator workspace.")
+
+    return np.array(LEs), np.array(t), np.array(w), np.array(status)
+
+# relative step size for finite-difference derivatives of the gradient
+cdef double HESSIAN_STEP = 1E-5
+
+cdef void _variational_fcn(unsigned n, double t, double *w, double *f,
+                           GradFn gradfunc, double *gpars, unsigned nvec) nogil:
+    """
+    Right-hand side of the equations of motion for one orbit (the first 6
+    elements of ``w``) plus the linearized (variational) equations for
+    ``nvec`` tangent vectors (each 6 elements) along the orbit:
+
+        d(dq)/dt = dv,  d(dv)/dt = -H(q) dq
+
+    where H is the Hessian of the potential, computed with central finite
+    differences of the gradient function. For one or two tangent vectors,
+    only the directional derivatives along each vector are computed (2
+    gradient evaluations per vector); otherwise the full 3x3 Hessian is
+    computed (6 gradient evaluations) and applied to all vectors.
+    """
+    cdef:
+        int i, j, k
+        double qp[3]
+        double qm[3]
+        double gp[3]
+        double gm[3]
+        double H[3][3]
+        double *dw
+        double *df
+        double h, dq_mag
+
+    # the orbit itself
+    gradfunc(gpars, w, &f[3])
+    for k in range(3):
+        f[k] = w[3+k]
+        f[3+k] = -f[3+k]
+
+    h = HESSIAN_STEP * sqrt(w[0]*w[0] + w[1]*w[1] + w[2]*w[2])
+    if h == 0.:
+        h = HESSIAN_STEP
+
+    if 2*nvec < 6:
+        for i in range(nvec):
+            dw = &w[6*(i+1)]
+            df = &f[6*(i+1)]
+
+            dq_mag = sqrt(dw[0]*dw[0] + dw[1]*dw[1] + dw[2]*dw[2])
+            for k in range(3):
+                df[k] = dw[3+k]
+                df[3+k] = 0.
+
+            if dq_mag == 0.:
+                continue
+
+            for k in range(3):
+                qp[k] = w[k] + h*dw[k]/dq_mag
+                qm[k] = w[k] - h*dw[k]/dq_mag
+            gradfunc(gpars, &qp[0], &gp[0])
+            gradfunc(gpars, &qm[0], &gm[0])
+
+            for k in range(3):
+                df[3+k] = -dq_mag * (gp[k] - gm[k]) / (2*h)
+
+    else:
+        for j in range(3):
+            for k in range(3):
+                qp[k] = w[k]
+                qm[k] = w[k]
+            qp[j] = qp[j] + h
+            qm[j] = qm[j] - h
+            gradfunc(gpars, &qp[0], &gp[0])
+            gradfunc(gpars, &qm[0], &gm[0])
+
+            for k in range(3):
+                H[k][j] = (gp[k] - gm[k]) / (2*h)
+
+        for i in range(nvec):
+            dw = &w[6*(i+1)]
+            df = &f[6*(i+1)]
+            for k in range(3):
+                df[k] = dw[3+k]
+                df[3+k] = -(H[k][0]*dw[0] + H[k][1]*dw[1] + H[k][2]*dw[2])
+
+cdef int _variational_one(Dop853Workspace *ws, GradFn gradfunc, double *gpars,
+                          double *w, unsigned nvec,
+                          double dt, int nsteps, double t0,
+                          double atol, double rtol, int nmax,
+                          int nsteps_per_pullback,
+                          double convergence_tol, double regular_slope, int min_nsteps,
+                          int nhistory, int *history_steps, double *history_t, double *history,
+                          double *LEs, double *t_stop) nogil:
+    """
+    Integrate one orbit along with ``nvec`` tangent vectors, and every
+    ``nsteps_per_pullback`` steps re-orthonormalize the tangent vectors
+    (modified Gram-Schmidt) and accumulate the log of their stretching
+    factors. The tangent vectors in ``w`` must start orthonormal. Returns
+    the DOP853 status code, or ``MLE_CONVERGED`` / ``MLE_REGULAR`` if the
+    integration stopped early (based on the largest exponent), and stores
+    the final time in ``t_stop``. The history of the largest exponent is
+    recorded as in ``_mle_one()``. As there, the orbit is integrated from
+    one pullback to the next in one call to the integrator.
+    """
+    cdef:
+        int i, j, k, m, jiter
+        int res = 1
+        int stop = 0
+        int ihistory = 0
+        int next_check = nsteps_per_pullback
+        double t, proj, norm
+        double t_start = t0
+        double lyap_prev = 0., t_prev = 0.
+        int nconverged = 0, nregular = 0
+        double *u
+        double *v
+
+    if min_nsteps > next_check:
+        next_check = min_nsteps
+
+    for i in range(nvec):
+        LEs[i] = 0.
+
+    ws.hnext = dt
+    j = 0
+    while j < nsteps:
+        jiter = min(nsteps_per_pullback, nsteps - j)
+        j = j + jiter
+
+        # same (accumulated) times as stepping by dt
+        t = t0
+        for k in range(jiter):
+            t = t + dt
+
+        res = dop853_ws(ws, <FcnEqDiff> _variational_fcn, gradfunc, gpars, nvec,
+                        t0, w, t, rtol, atol, ws.hnext, _segment_nmax(nmax, jiter))
+        if res < 0:
+            return res
+
+        if (j % nsteps_per_pullback) == 0:
+            for i in range(nvec):
+                u = &w[6*(i+1)]
+                for m in range(i):
+                    v = &w[6*(m+1)]
+                    proj = 0.
+                    for k in range(6):
+                        proj = proj + u[k]*v[k]
+                    for k in range(6):
+                        u[k] = u[k] - proj*v[k]
+
+                norm = six_norm(u)
+                LEs[i] = LEs[i] + log(norm)
+                for k in range(6):
+                    u[k] = u[k] / norm
+
+            while ihistory < nhistory and history_steps[ihistory] <= j:
+                history_t[ihistory] = t
+                history[ihistory] = LEs[0] / (t - t_start)
+                ihistory = ihistory + 1
+
+            if convergence_tol > 0 and j >= next_check:
+                stop = _check_convergence(LEs[0], t - t_start, &lyap_prev, &t_prev,
+                                          &nconverged, &nregular,
+                                          convergence_tol, regular_slope)
+                next_check = 2*j
+
+        t0 = t
+        if stop:
+            res = stop
+            break
+
+    for i in range(nvec):
+        LEs[i] = LEs[i] / t0
+    t_stop[0] = t0
+
+    return res
+
+cpdef variational_lyapunov_many(_CPotential cpotential, double[:,::1] w0,
+                                double[:,:,::1] dw0, double[::1] dt, int[::1] nsteps,
+                                double t0, double atol, double rtol, int nmax,
+                                int nsteps_per_pullback, int nthreads=1,
+                                double convergence_tol=0., double regular_slope=-0.8,
+                                int min_nsteps=0, int[:,::1] history_steps=None,
+                                double[:,::1] history_t=None, double[:,::1] history=None):
+    """
+    Estimate the Lyapunov spectrum for many orbits by integrating the
+    variational equations along each orbit. ``w0`` has shape (norbits, 6)
+    and ``dw0`` contains the initial (orthonormal) tangent vectors with
+    shape (norbits, nvec, 6). Orbits are distributed over ``nthreads``
+    OpenMP threads, can stop early if ``convergence_tol`` > 0, and can
+    record the history of the largest exponent, as in
+    ``max_lyapunov_exp_many()``.
+
+    Returns the Lyapunov exponents with shape (norbits, nvec), the final
+    times, the final phase-space positions of the orbits, and an array of
+    DOP853 status codes (negative = failure).
+    """
+    cdef:
+        int i, k
+        unsigned norbits = w0.shape[0]
+        unsigned nvec = dw0.shape[1]
+        unsigned nstate = 6*(nvec+1)
+
+        double[:,::1] w = np.empty((norbits,nstate))
+        double[:,::1] LEs = np.zeros((norbits,nvec))
+        double[::1] t = np.zeros(norbits)
+        int[::1] status = np.ones(norbits, dtype=np.int32)
+
+        Dop853Workspace *ws
+
+        # set by any thread that fails to allocate its workspace
+        int[::1] failed = np.zeros(1, dtype=np.int32)
+
+        GradFn gradfunc = <GradFn>cpotential.c_gradient
+        double *gpars = &(cpotential._parameters[0])
+
+        int nhistory = 0
+        int *hsteps = NULL
+        double *ht = NULL
+        double *hist = NULL
+
+    if history_steps is not None:
+        nhistory = history_steps.shape[1]
+        hsteps = &history_steps[0,0]
+        ht = &history_t[0,0]
+        hist = &history[0,0]
+
+    if w0.shape[1] != 6 or dw0.shape[2] != 6:
+        raise ValueError("Orbits and tangent vectors must be 6-dimensional.")
+
+    # orbit followed by the tangent vectors
+    for i in range(norbits):
+        for k in range(6):
+            w[i,k] = w0[i,k]
+        for k in range(6*nvec):
+            w[i,6+k] = dw0[i,k//6,k%6]
+
+    with nogil, parallel(num_threads=nthreads):
+        ws = <Dop853Workspace*>calloc(1, sizeof(Dop853Workspace))
+        if ws == NULL or dop853_ws_alloc(ws, nstate) != 0:
+            failed[0] = 1
+
+        for i in prange(norbits, schedule='dynamic'):
+            if failed[0] == 0:
+                status[i] = _variational_one(ws, gradfunc, gpars, &w[i,0], nvec,
+                                             dt[i], nsteps[i], t0, atol, rtol, nmax,
+                                             nsteps_per_pullback,
+                                             convergence_tol, regular_slope, min_nsteps,
+                                             nhistory, hsteps + i*nhistory, ht + i*nhistory,
+                                             hist + i*nhistory, &LEs[i,0], &t[i])
+
+        if ws != NULL:
+            dop853_ws_free(ws)
+            free(ws)
+
+    if failed[0]:
+        raise MemoryError("Failed to allocate integrator workspace.")
+
+    return np.array(LEs), np.array(t), np.array(w[:,:6]), np.array(status)
+
 def mle(w0, potential, dt, nsteps, d0=1e-5,
         nsteps_per_pullback=10, noffset_orbits=2, t0=0.,
-        atol=1E-9, rtol=1E-9, nmax=0):
+        atol=1E-9, rtol=1E-9, nmax=0,
+        convergence_tol=0., regular_slope=-0.8, min_nsteps=0):
 
     if not hasattr(potential, 'c_instance'):
         raise TypeError("Input potential must be a CPotential subclass.")
@@ -132,4 +687,169 @@ def mle(w0, potential, dt, nsteps, d0=1e-5,
 
     return max_lyapunov_exp(potential.c_instance, w0,
                             dt, nsteps+1, t0, atol, rtol, nmax,
-                            d0, nsteps_per_pullback)
+                            d0, nsteps_per_pullback,
+                            convergence_tol, regular_slope, min_nsteps)
+
+def history_steps(nsteps, nhistory, nsteps_per_pullback=10):
+    """
+    Log-spaced steps (multiples of ``nsteps_per_pullback``) at which to
+    record the finite-time Lyapunov exponent estimate, from the first
+    pullback to ``nsteps``, for each orbit. ``nsteps`` can be a scalar or
+    array. Returns an integer array with shape (norbits, nhistory); if there
+    are fewer than ``nhistory`` pullbacks, some steps are repeated.
+    """
+    nsteps = np.atleast_1d(nsteps)
+    npullback = np.maximum(nsteps // nsteps_per_pullback, 1)
+    x = np.linspace(0., 1., nhistory)[None]
+    steps = np.round(npullback[:,None]**x) * nsteps_per_pullback
+    return np.ascontiguousarray(steps, dtype=np.int32)
+
+def _check_history(history_t, history, norbits):
+    if history is None or history_t is None:
+        raise ValueError("Both history_t and history must be specified.")
+
+    if (history.shape != history_t.shape or history.ndim != 2 or
+            history.shape[0] != norbits):
+        raise ValueError("History arrays must both have shape (norbits, nhistory).")
+
+def mle_many(w0, potential, dt, nsteps, d0=1e-5,
+             nsteps_per_pullback=10, noffset_orbits=2, t0=0.,
+             atol=1E-9, rtol=1E-9, nmax=0, nthreads=1,
+             convergence_tol=0., regular_slope=-0.8, min_nsteps=0,
+             history_t=None, history=None):
+    """
+    Estimate the maximum Lyapunov exponent for many orbits in parallel with
+    ``nthreads`` threads. ``w0`` is an array of initial conditions with
+    shape (norbits, ndim) and ``dt`` and ``nsteps`` can be scalars or
+    arrays with one value per orbit. Offset orbits are generated as in
+    ``mle()``.
+
+    If ``convergence_tol`` > 0, each orbit stops early once its running
+    Lyapunov exponent estimate converges to within this fractional
+    tolerance, or once it decays faster than ``t**regular_slope`` (i.e.,
+    the orbit looks regular), but not before ``min_nsteps`` steps.
+
+    If ``history`` and ``history_t`` are given, they must be arrays of
+    shape (norbits, nhistory). The running (finite-time) estimate of the
+    exponent and the corresponding times are written into them at
+    ``nhistory`` log-spaced times -- see ``history_steps()``. Entries
+    after an orbit stops early are left as they are.
+
+    Returns the Lyapunov exponent estimates with shape
+    (norbits, noffset_orbits), the final times, the final phase-space
+    positions with shape (norbits, noffset_orbits+1, ndim), and an array of
+    status codes: negative if the integration failed, 1 if the orbit was
+    integrated for all ``nsteps``, 2 if the estimate converged, and 3 if
+    the orbit was classified as regular.
+    """
+
+    if not hasattr(potential, 'c_instance'):
+        raise TypeError("Input potential must be a CPotential subclass.")
+
+    w0 = np.atleast_2d(w0)
+    if w0.ndim != 2:
+        raise ValueError('w0 must be 1- or 2-D.')
+    norbits,ndim = w0.shape
+
+    dt = np.zeros(norbits) + dt
+    nsteps = (np.zeros(norbits) + nsteps).astype(np.int32)
+
+    # generate offset orbits
+    d0_vec = np.random.uniform(size=(norbits,noffset_orbits,ndim))
+    norm = np.linalg.norm(d0_vec, axis=-1)
+    d0_vec *= d0/norm[...,None]  # rescale offset vectors
+
+    _new_w0 = np.zeros((norbits,noffset_orbits+1,ndim))
+    _new_w0[:,0] = w0
+    _new_w0[:,1:] = w0[:,None] + d0_vec
+
+    hsteps = None
+    if history is not None or history_t is not None:
+        _check_history(history_t, history, norbits)
+        hsteps = history_steps(nsteps, history.shape[1], nsteps_per_pullback)
+
+    return max_lyapunov_exp_many(potential.c_instance, _new_w0,
+                                 dt, nsteps+1, t0, atol, rtol, nmax,
+                                 d0, nsteps_per_pullback, nthreads,
+                                 convergence_tol, regular_slope, min_nsteps,
+                                 hsteps, history_t, history)
+
+def lyapunov_spectrum_many(w0, potential, dt, nsteps, nvectors=6,
+                           nsteps_per_pullback=10, t0=0., atol=1E-9, rtol=1E-9,
+                           nmax=0, nthreads=1,
+                           convergence_tol=0., regular_slope=-0.8, min_nsteps=0,
+                           history_t=None, history=None):
+    """
+    Estimate the ``nvectors`` largest Lyapunov exponents for many orbits by
+    integrating the variational equations, using ``nthreads`` threads.
+    ``w0`` has shape (norbits, 6) and ``dt`` and ``nsteps`` can be scalars or
+    arrays with one value per orbit. The initial tangent vectors are random
+    and orthonormal. Orbits can stop early based on the largest exponent,
+    and the history of the largest exponent can be recorded, as in
+    ``mle_many()``.
+
+    Returns the Lyapunov exponents with shape (norbits, nvectors) (largest
+    first), the final times, the final phase-space positions, and an array
+    of status codes as returned by ``mle_many()``.
+    """
+
+    if not hasattr(potential, 'c_instance'):
+        raise TypeError("Input potential must be a CPotential subclass.")
+
+    nvectors = int(nvectors)
+    if nvectors < 1 or nvectors > 6:
+        raise ValueError("Number of tangent vectors must be between 1 and 6.")
+
+    w0 = np.ascontiguousarray(np.atleast_2d(w0), dtype=np.float64)
+    norbits = w0.shape[0]
+
+    dt = np.zeros(norbits) + dt
+    nsteps = (np.zeros(norbits) + nsteps).astype(np.int32)
+
+    # random, orthonormal initial tangent vectors
+    dw0 = np.zeros((norbits,nvectors,6))
+    for i in range(norbits):
+        q,r = np.linalg.qr(np.random.normal(size=(6,nvectors)))
+        dw0[i] = q.T
+
+    hsteps = None
+    if history is not None or history_t is not None:
+        _check_history(history_t, history, norbits)
+        hsteps = history_steps(nsteps, history.shape[1], nsteps_per_pullback)
+
+    return variational_lyapunov_many(potential.c_instance, w0, dw0,
+                                     dt, nsteps+1, t0, atol, rtol, nmax,
+                                     nsteps_per_pullback, nthreads,
+                                     convergence_tol, regular_slope, min_nsteps,
+                                     hsteps, history_t, history)
+
+def lyapunov_spectrum(w0, potential, dt, nsteps, nvectors=6,
+                      nsteps_per_pullback=10, t0=0., atol=1E-9, rtol=1E-9, nmax=0,
+                      convergence_tol=0., regular_slope=-0.8, min_nsteps=0):
+    """
+    Estimate the ``nvectors`` largest Lyapunov exponents for a single orbit
+    by integrating the variational equations along the orbit. With
+    ``nvectors=1``, this is an alternative to ``mle()`` that doesn't depend
+    on the size of the initial offset.
+
+    Returns the Lyapunov exponents (largest first), the final time, and the
+    final phase-space position of the orbit.
+    """
+    LEs,t,w,status = lyapunov_spectrum_many(w0, potential, dt, nsteps, nvectors=nvectors,
+                                            nsteps_per_pullback=nsteps_per_pullback,
+                                            t0=t0, atol=atol, rtol=rtol, nmax=nmax,
+                                            convergence_tol=convergence_tol,
+                                            regular_slope=regular_slope,
+                                            min_nsteps=min_nsteps)
+
+    res = status[0]
+    if res == -1:
+        raise RuntimeError("Input is not consistent.")
+    elif res == -2:
+        raise RuntimeError("Larger nmax is needed.")
+    elif res == -3:
+        raise RuntimeError("Step size becomes too small.")
+    elif res == -4:
+        raise RuntimeError("The problem is probably stff (interrupted).")
+
+    return LEs[0], t[0], w[0]
@@ -0,0 +1,565 @@
+/*
+    A re-entrant version of the DOP853 integrator (Hairer, Norsett & Wanner)
+    used in gary. All of the integrator state lives in a workspace struct
+    owned by the caller instead of in file-level static variables, so
+    separate threads can integrate separate orbits at the same time as long
+    as each uses its own workspace. dop853_ws_dense() also uses the
+    continuous extension of the method to write out the solution at any
+    set of times without restricting the step size.
+
+    Author: adrn <adrn@astro.columbia.edu>
+*/
+
+#include <math.h>
+#include <stdlib.h>
+#include <string.h>
+#include "dop853_ws.h"
+
+/* coefficients of the method -- see dop853.c */
+static const double c2    = 0.526001519587677318785587544488E-01;
+static const double c3    = 0.789002279381515978178381316732E-01;
+static const double c4    = 0.118350341907227396726757197510E+00;
+static const double c5    = 0.281649658092772603273242802490E+00;
+static const double c6    = 0.333333333333333333333333333333E+00;
+static const double c7    = 0.25E+00;
+static const double c8    = 0.307692307692307692307692307692E+00;
+static const double c9    = 0.651282051282051282051282051282E+00;
+static const double c10   = 0.6E+00;
+static const double c11   = 0.857142857142857142857142857142E+00;
+static const double b1    = 5.42937341165687622380535766363E-2;
+static const double b6    = 4.45031289275240888144113950566E0;
+static const double b7    = 1.89151789931450038304281599044E0;
+static const double b8    = -5.8012039600105847814672114227E0;
+static const double b9    = 3.1116436695781989440891606237E-1;
+static const double b10   = -1.52160949662516078556178806805E-1;
+static const double b11   = 2.01365400804030348374776537501E-1;
+static const double b12   = 4.47106157277725905176885569043E-2;
+static const double bhh1  = 0.244094488188976377952755905512E+00;
+static const double bhh2  = 0.733846688281611857341361741547E+00;
+static const double bhh3  = 0.220588235294117647058823529412E-01;
+static const double er1   = 0.1312004499419488073250102996E-01;
+static const double er6   = -0.1225156446376204440720569753E+01;
+static const double er7   = -0.4957589496572501915214079952E+00;
+static const double er8   = 0.1664377182454986536961530415E+01;
+static const double er9   = -0.3503288487499736816886487290E+00;
+static const double er10  = 0.3341791187130174790297318841E+00;
+static const double er11  = 0.8192320648511571246570742613E-01;
+static const double er12  = -0.2235530786388629525884427845E-01;
+static const double a21   = 5.26001519587677318785587544488E-2;
+static const double a31   = 1.97250569845378994544595329183E-2;
+static const double a32   = 5.91751709536136983633785987549E-2;
+static const double a41   = 2.95875854768068491816892993775E-2;
+static const double a43   = 8.87627564304205475450678981324E-2;
+static const double a51   = 2.41365134159266685502369798665E-1;
+static const double a53   = -8.84549479328286085344864962717E-1;
+static const double a54   = 9.24834003261792003115737966543E-1;
+static const double a61   = 3.7037037037037037037037037037E-2;
+static const double a64   = 1.70828608729473871279604482173E-1;
+static const double a65   = 1.25467687566822425016691814123E-1;
+static const double a71   = 3.7109375E-2;
+static const double a74   = 1.70252211019544039314978060272E-1;
+static const double a75   = 6.02165389804559606850219397283E-2;
+static const double a76   = -1.7578125E-2;
+static const double a81   = 3.70920001185047927108779319836E-2;
+static const double a84   = 1.70383925712239993810214054705E-1;
+static const double a85   = 1.07262030446373284651809199168E-1;
+static const double a86   = -1.53194377486244017527936158236E-2;
+static const double a87   = 8.27378916381402288758473766002E-3;
+static const double a91   = 6.24110958716075717114429577812E-1;
+static const double a94   = -3.36089262944694129406857109825E0;
+static const double a95   = -8.68219346841726006818189891453E-1;
+static const double a96   = 2.75920996994467083049415600797E1;
+static const double a97   = 2.01540675504778934086186788979E1;
+static const double a98   = -4.34898841810699588477366255144E1;
+static const double a101  = 4.77662536438264365890433908527E-1;
+static const double a104  = -2.48811461997166764192642586468E0;
+static const double a105  = -5.90290826836842996371446475743E-1;
+static const double a106  = 2.12300514481811942347288949897E1;
+static const double a107  = 1.52792336328824235832596922938E1;
+static const double a108  = -3.32882109689848629194453265587E1;
+static const double a109  = -2.03312017085086261358222928593E-2;
+static const double a111  = -9.3714243008598732571704021658E-1;
+static const double a114  = 5.18637242884406370830023853209E0;
+static const double a115  = 1.09143734899672957818500254654E0;
+static const double a116  = -8.14978701074692612513997267357E0;
+static const double a117  = -1.85200656599969598641566180701E1;
+static const double a118  = 2.27394870993505042818970056734E1;
+static const double a119  = 2.49360555267965238987089396762E0;
+static const double a1110 = -3.0467644718982195003823669022E0;
+static const double a121  = 2.27331014751653820792359768449E0;
+static const double a124  = -1.05344954667372501984066689879E1;
+static const double a125  = -2.00087205822486249909675718444E0;
+static const double a126  = -1.79589318631187989172765950534E1;
+static const double a127  = 2.79488845294199600508499808837E1;
+static const double a128  = -2.85899827713502369474065508674E0;
+static const double a129  = -8.87285693353062954433549289258E0;
+static const double a1210 = 1.23605671757943030647266201528E1;
+static const double a1211 = 6.43392746015763530355970484046E-1;
+
+/* extra stages and coefficients for the dense output */
+static const double c14   = 0.1E+00;
+static const double c15   = 0.2E+00;
+static const double c16   = 0.777777777777777777777777777778E+00;
+static const double a141  = 5.61675022830479523392909219681E-2;
+static const double a147  = 2.53500210216624811088794765333E-1;
+static const double a148  = -2.46239037470802489917441475441E-1;
+static const double a149  = -1.24191423263816360469010140626E-1;
+static const double a1410 = 1.5329179827876569731206322685E-1;
+static const double a1411 = 8.20105229563468988491666602057E-3;
+static const double a1412 = 7.56789766054569976138603589584E-3;
+static const double a1413 = -8.298E-3;
+static const double a151  = 3.18346481635021405060768473261E-2;
+static const double a156  = 2.83009096723667755288322961402E-2;
+static const double a157  = 5.35419883074385676223797384372E-2;
+static const double a158  = -5.49237485713909884646569340306E-2;
+static const double a1511 = -1.08347328697249322858509316994E-4;
+static const double a1512 = 3.82571090835658412954920192323E-4;
+static const double a1513 = -3.40465008687404560802977114492E-4;
+static const double a1514 = 1.41312443674632500278074618366E-1;
+static const double a161  = -4.28896301583791923408573538692E-1;
+static const double a166  = -4.69762141536116384314449447206E0;
+static const double a167  = 7.68342119606259904184240953878E0;
+static const double a168  = 4.06898981839711007970213554331E0;
+static const double a169  = 3.56727187455281109270669543021E-1;
+static const double a1613 = -1.39902416515901462129418009734E-3;
+static const double a1614 = 2.9475147891527723389556272149E0;
+static const double a1615 = -9.15095847217987001081870187138E0;
+static const double d41   = -0.84289382761090128651353491142E+01;
+static const double d46   = 0.56671495351937776962531783590E+00;
+static const double d47   = -0.30689499459498916912797304727E+01;
+static const double d48   = 0.23846676565120698287728149680E+01;
+static const double d49   = 0.21170345824450282767155149946E+01;
+static const double d410  = -0.87139158377797299206789907490E+00;
+static const double d411  = 0.22404374302607882758541771650E+01;
+static const double d412  = 0.63157877876946881815570249290E+00;
+static const double d413  = -0.88990336451333310820698117400E-01;
+static const double d414  = 0.18148505520854727256656404962E+02;
+static const double d415  = -0.91946323924783554000451984436E+01;
+static const double d416  = -0.44360363875948939664310572000E+01;
+static const double d51   = 0.10427508642579134603413151009E+02;
+static const double d56   = 0.24228349177525818288430175319E+03;
+static const double d57   = 0.16520045171727028198505394887E+03;
+static const double d58   = -0.37454675472269020279518312152E+03;
+static const double d59   = -0.22113666853125306036270938578E+02;
+static const double d510  = 0.77334326684722638389603898808E+01;
+static const double d511  = -0.30674084731089398182061213626E+02;
+static const double d512  = -0.93321305264302278729567221706E+01;
+static const double d513  = 0.15697238121770843886131091075E+02;
+static const double d514  = -0.31139403219565177677282850411E+02;
+static const double d515  = -0.93529243588444783865713862664E+01;
+static const double d516  = 0.35816841486394083752465898540E+02;
+static const double d61   = 0.19985053242002433820987653617E+02;
+static const double d66   = -0.38703730874935176555105901742E+03;
+static const double d67   = -0.18917813819516756882830838328E+03;
+static const double d68   = 0.52780815920542364900561016686E+03;
+static const double d69   = -0.11573902539959630126141871134E+02;
+static const double d610  = 0.68812326946963000169666922661E+01;
+static const double d611  = -0.10006050966910838403183860980E+01;
+static const double d612  = 0.77771377980534432092869265740E+00;
+static const double d613  = -0.27782057523535084065932004339E+01;
+static const double d614  = -0.60196695231264120758267380846E+02;
+static const double d615  = 0.84320405506677161018159903784E+02;
+static const double d616  = 0.11992291136182789328035130030E+02;
+static const double d71   = -0.25693933462703749003312586129E+02;
+static const double d76   = -0.15418974869023643374053993627E+03;
+static const double d77   = -0.23152937917604549567536039109E+03;
+static const double d78   = 0.35763911791061412378285349910E+03;
+static const double d79   = 0.93405324183624310003907691704E+02;
+static const double d710  = -0.37458323136451633156875139351E+02;
+static const double d711  = 0.10409964950896230045147246184E+03;
+static const double d712  = 0.29840293426660503123344363579E+02;
+static const double d713  = -0.43533456590011143754432175058E+02;
+static const double d714  = 0.96324553959188282948394950600E+02;
+static const double d715  = -0.39177261675615439165231486172E+02;
+static const double d716  = -0.14972683625798562581422125276E+03;
+
+static double sign (double a, double b) {
+    return (b < 0.0)? -fabs(a) : fabs(a);
+}
+
+static double min_d (double a, double b) {
+    return (a < b)?a:b;
+}
+
+static double max_d (double a, double b) {
+    return (a > b)?a:b;
+}
+
+int dop853_ws_alloc (Dop853Workspace *ws, unsigned n) {
+    ws->n = n;
+    ws->work = (double*) malloc (19*n*sizeof(double));
+    if (!ws->work)
+        return -1;
+
+    ws->yy1 = ws->work;
+    ws->k1 = ws->work + n;
+    ws->k2 = ws->work + 2*n;
+    ws->k3 = ws->work + 3*n;
+    ws->k4 = ws->work + 4*n;
+    ws->k5 = ws->work + 5*n;
+    ws->k6 = ws->work + 6*n;
+    ws->k7 = ws->work + 7*n;
+    ws->k8 = ws->work + 8*n;
+    ws->k9 = ws->work + 9*n;
+    ws->k10 = ws->work + 10*n;
+    ws->rcont1 = ws->work + 11*n;
+    ws->rcont2 = ws->work + 12*n;
+    ws->rcont3 = ws->work + 13*n;
+    ws->rcont4 = ws->work + 14*n;
+    ws->rcont5 = ws->work + 15*n;
+    ws->rcont6 = ws->work + 16*n;
+    ws->rcont7 = ws->work + 17*n;
+    ws->rcont8 = ws->work + 18*n;
+    ws->ndense = 0;
+    ws->hnext = 0.0;
+    ws->nfcn = ws->nstep = ws->naccpt = ws->nrejct = 0;
+    return 0;
+}
+
+void dop853_ws_free (Dop853Workspace *ws) {
+    if (ws->work)
+        free (ws->work);
+    ws->work = NULL;
+}
+
+static double hinit (Dop853Workspace *ws, FcnEqDiff fcn, GradFn gradfunc, double *gpars,
+                     unsigned norbits, double x, double *y, double posneg, double hmax,
+                     double atol, double rtol) {
+    double dnf, dny, sk, h, h1, der2, der12, sqr;
+    unsigned i, n = ws->n;
+    double *f0 = ws->k1, *f1 = ws->k2, *yy1 = ws->k3;
+    int iord = 8;
+
+    dnf = 0.0;
+    dny = 0.0;
+    for (i = 0; i < n; i++) {
+        sk = atol + rtol * fabs(y[i]);
+        sqr = f0[i] / sk;
+        dnf += sqr*sqr;
+        sqr = y[i] / sk;
+        dny += sqr*sqr;
+    }
+
+    if ((dnf <= 1.0E-10) || (dny <= 1.0E-10))
+        h = 1.0E-6;
+    else
+        h = sqrt (dny/dnf) * 0.01;
+
+    h = min_d (h, hmax);
+    h = sign (h, posneg);
+
+    /* perform an explicit Euler step */
+    for (i = 0; i < n; i++)
+        yy1[i] = y[i] + h * f0[i];
+    fcn (n, x+h, yy1, f1, gradfunc, gpars, norbits);
+
+    /* estimate the second derivative of the solution */
+    der2 = 0.0;
+    for (i = 0; i < n; i++) {
+        sk = atol + rtol * fabs(y[i]);
+        sqr = (f1[i] - f0[i]) / sk;
+        der2 += sqr*sqr;
+    }
+    der2 = sqrt (der2) / h;
+
+    /* step size is computed such that h**iord * max_d(norm(f0),norm(der2)) = 0.01 */
+    der12 = max_d (fabs(der2), sqrt(dnf));
+    if (der12 <= 1.0E-15)
+        h1 = max_d (1.0E-6, fabs(h)*1.0E-3);
+    else
+        h1 = pow (0.01/der12, 1.0/(double)iord);
+    h = min_d (100.0 * fabs(h), min_d (h1, hmax));
+
+    return sign (h, posneg);
+}
+
+/* evaluate the continuous extension of the last accepted step (xold -> x)
+   at time t, writing all n components to out */
+static void contd8_ws (Dop853Workspace *ws, double t, double xold, double h, double *out) {
+    double s, s1;
+    unsigned i;
+
+    s = (t - xold) / h;
+    s1 = 1.0 - s;
+    for (i = 0; i < ws->n; i++)
+        out[i] = ws->rcont1[i]+s*(ws->rcont2[i]+s1*(ws->rcont3[i]+s*(ws->rcont4[i]+
+                 s1*(ws->rcont5[i]+s*(ws->rcont6[i]+s1*(ws->rcont7[i]+s*ws->rcont8[i]))))));
+}
+
+static int dopcor_ws (Dop853Workspace *ws, FcnEqDiff fcn, GradFn gradfunc, double *gpars,
+                      unsigned norbits, double x, double *y, double xend,
+                      double rtol, double atol, double h, long nmax,
+                      double *tout, unsigned nout, double *yout) {
+    /* Same defaults as dop853() called with zeros for all optional parameters */
+    const double uround = 2.3E-16, safe = 0.9, fac1 = 0.333, fac2 = 6.0;
+    const double beta = 0.0;
+    const long nstiff = 1000;
+
+    double facold, expo1, fac, facc1, facc2, fac11, posneg, xph;
+    double hlamb, err, sk, hnew, hmax;
+    double stnum, stden, sqr, err2, erri, deno, ydiff, bspl, xold;
+    int iasti, reject, last, nonsti = 0;
+    unsigned i, n = ws->n;
+
+    double *yy1 = ws->yy1, *k1 = ws->k1, *k2 = ws->k2, *k3 = ws->k3, *k4 = ws->k4;
+    double *k5 = ws->k5, *k6 = ws->k6, *k7 = ws->k7, *k8 = ws->k8, *k9 = ws->k9;
+    double *k10 = ws->k10;
+
+    if (!nmax)
+        nmax = 100000;
+
+    ws->nfcn = ws->nstep = ws->naccpt = ws->nrejct = 0;
+    ws->ndense = 0;
+
+    facold = 1.0E-4;
+    expo1 = 1.0/8.0 - beta * 0.2;
+    facc1 = 1.0 / fac1;
+    facc2 = 1.0 / fac2;
+    posneg = sign (1.0, xend-x);
+    hmax = fabs (xend - x);
+
+    last  = 0;
+    hlamb = 0.0;
+    iasti = 0;
+    fcn (n, x, y, k1, gradfunc, gpars, norbits);
+    if (h == 0.0)
+        h = hinit (ws, fcn, gradfunc, gpars, norbits, x, y, posneg, hmax, atol, rtol);
+    ws->nfcn += 2;
+    reject = 0;
+
+    /* output times at (or before) the initial time */
+    while ((ws->ndense < nout) && ((tout[ws->ndense] - x) * posneg <= 0.0)) {
+        memcpy (yout + ws->ndense*n, y, n * sizeof(double));
+        ws->ndense++;
+    }
+
+    /* basic integration step */
+    while (1) {
+        if (ws->nstep > nmax) {
+            ws->hnext = h;
+            return -2;
+        }
+
+        if (0.1 * fabs(h) <= fabs(x) * uround) {
+            ws->hnext = h;
+            return -3;
+        }
+
+        if ((x + 1.01*h - xend) * posneg > 0.0) {
+            h = xend - x;
+            last = 1;
+        }
+
+        ws->nstep++;
+
+        /* the twelve stages */
+        for (i = 0; i < n; i++)
+            yy1[i] = y[i] + h * a21 * k1[i];
+        fcn (n, x+c2*h, yy1, k2, gradfunc, gpars, norbits);
+        for (i = 0; i < n; i++)
+            yy1[i] = y[i] + h * (a31*k1[i] + a32*k2[i]);
+        fcn (n, x+c3*h, yy1, k3, gradfunc, gpars, norbits);
+        for (i = 0; i < n; i++)
+            yy1[i] = y[i] + h * (a41*k1[i] + a43*k3[i]);
+        fcn (n, x+c4*h, yy1, k4, gradfunc, gpars, norbits);
+        for (i = 0; i <n; i++)
+            yy1[i] = y[i] + h * (a51*k1[i] + a53*k3[i] + a54*k4[i]);
+        fcn (n, x+c5*h, yy1, k5, gradfunc, gpars, norbits);
+        for (i = 0; i < n; i++)
+            yy1[i] = y[i] + h * (a61*k1[i] + a64*k4[i] + a65*k5[i]);
+        fcn (n, x+c6*h, yy1, k6, gradfunc, gpars, norbits);
+        for (i = 0; i < n; i++)
+            yy1[i] = y[i] + h * (a71*k1[i] + a74*k4[i] + a75*k5[i] + a76*k6[i]);
+        fcn (n, x+c7*h, yy1, k7, gradfunc, gpars, norbits);
+        for (i = 0; i < n; i++)
+            yy1[i] = y[i] + h * (a81*k1[i] + a84*k4[i] + a85*k5[i] + a86*k6[i] +
+                                 a87*k7[i]);
+        fcn (n, x+c8*h, yy1, k8, gradfunc, gpars, norbits);
+        for (i = 0; i <n; i++)
+            yy1[i] = y[i] + h * (a91*k1[i] + a94*k4[i] + a95*k5[i] + a96*k6[i] +
+                                 a97*k7[i] + a98*k8[i]);
+        fcn (n, x+c9*h, yy1, k9, gradfunc, gpars, norbits);
+        for (i = 0; i < n; i++)
+            yy1[i] = y[i] + h * (a101*k1[i] + a104*k4[i] + a105*k5[i] + a106*k6[i] +
+                                 a107*k7[i] + a108*k8[i] + a109*k9[i]);
+        fcn (n, x+c10*h, yy1, k10, gradfunc, gpars, norbits);
+        for (i = 0; i < n; i++)
+            yy1[i] = y[i] + h * (a111*k1[i] + a114*k4[i] + a115*k5[i] + a116*k6[i] +
+                                 a117*k7[i] + a118*k8[i] + a119*k9[i] + a1110*k10[i]);
+        fcn (n, x+c11*h, yy1, k2, gradfunc, gpars, norbits);
+        xph = x + h;
+        for (i = 0; i < n; i++)
+            yy1[i] = y[i] + h * (a121*k1[i] + a124*k4[i] + a125*k5[i] + a126*k6[i] +
+                                 a127*k7[i] + a128*k8[i] + a129*k9[i] +
+                                 a1210*k10[i] + a1211*k2[i]);
+        fcn (n, xph, yy1, k3, gradfunc, gpars, norbits);
+        ws->nfcn += 11;
+        for (i = 0; i < n; i++) {
+            k4[i] = b1*k1[i] + b6*k6[i] + b7*k7[i] + b8*k8[i] + b9*k9[i] +
+                    b10*k10[i] + b11*k2[i] + b12*k3[i];
+            k5[i] = y[i] + h * k4[i];
+        }
+
+        /* error estimation */
+        err = 0.0;
+        err2 = 0.0;
+        for (i = 0; i < n; i++) {
+            sk = atol + rtol * max_d (fabs(y[i]), fabs(k5[i]));
+            erri = k4[i] - bhh1*k1[i] - bhh2*k9[i] - bhh3*k3[i];
+            sqr = erri / sk;
+            err2 += sqr*sqr;
+            erri = er1*k1[i] + er6*k6[i] + er7*k7[i] + er8*k8[i] + er9*k9[i] +
+                   er10 * k10[i] + er11*k2[i] + er12*k3[i];
+            sqr = erri / sk;
+            err += sqr*sqr;
+        }
+        deno = err + 0.01 * err2;
+        if (deno <= 0.0)
+            deno = 1.0;
+        err = fabs(h) * err * sqrt (1.0 / (deno*(double)n));
+
+        /* computation of hnew */
+        fac11 = pow (err, expo1);
+        /* Lund-stabilization */
+        fac = fac11 / pow(facold,beta);
+        /* we require fac1 <= hnew/h <= fac2 */
+        fac = max_d (facc2, min_d (facc1, fac/safe));
+        hnew = h / fac;
+
+        if (err <= 1.0) {
+            /* step accepted */
+            facold = max_d (err, 1.0E-4);
+            ws->naccpt++;
+            fcn (n, xph, k5, k4, gradfunc, gpars, norbits);
+            ws->nfcn++;
+
+            /* stiffness detection */
+            if (!(ws->naccpt % nstiff) || (iasti > 0)) {
+                stnum = 0.0;
+                stden = 0.0;
+                for (i = 0; i < n; i++) {
+                    sqr = k4[i] - k3[i];
+                    stnum += sqr*sqr;
+                    sqr = k5[i] - yy1[i];
+                    stden += sqr*sqr;
+                }
+                if (stden > 0.0)
+                    hlamb = h * sqrt (stnum / stden);
+                if (hlamb > 6.1) {
+                    nonsti = 0;
+                    iasti++;
+                    if (iasti == 15) {
+                        ws->hnext = h;
+                        return -4;
+                    }
+                } else {
+                    nonsti++;
+                    if (nonsti == 6)
+                        iasti = 0;
+                }
+            }
+
+            /* prepare the dense output, only if it's needed for this step */
+            if ((ws->ndense < nout) && ((tout[ws->ndense] - xph) * posneg <= 0.0)) {
+                for (i = 0; i < n; i++) {
+                    ws->rcont1[i] = y[i];
+                    ydiff = k5[i] - y[i];
+                    ws->rcont2[i] = ydiff;
+                    bspl = h * k1[i] - ydiff;
+                    ws->rcont3[i] = bspl;
+                    ws->rcont4[i] = ydiff - h*k4[i] - bspl;
+                    ws->rcont5[i] = d41*k1[i] + d46*k6[i] + d47*k7[i] + d48*k8[i] +
+                                    d49*k9[i] + d410*k10[i] + d411*k2[i] + d412*k3[i];
+                    ws->rcont6[i] = d51*k1[i] + d56*k6[i] + d57*k7[i] + d58*k8[i] +
+                                    d59*k9[i] + d510*k10[i] + d511*k2[i] + d512*k3[i];
+                    ws->rcont7[i] = d61*k1[i] + d66*k6[i] + d67*k7[i] + d68*k8[i] +
+                                    d69*k9[i] + d610*k10[i] + d611*k2[i] + d612*k3[i];
+                    ws->rcont8[i] = d71*k1[i] + d76*k6[i] + d77*k7[i] + d78*k8[i] +
+                                    d79*k9[i] + d710*k10[i] + d711*k2[i] + d712*k3[i];
+                }
+
+                /* the next three function evaluations */
+                for (i = 0; i < n; i++)
+                    yy1[i] = y[i] + h * (a141*k1[i] + a147*k7[i] + a148*k8[i] +
+                                         a149*k9[i] + a1410*k10[i] + a1411*k2[i] +
+                                         a1412*k3[i] + a1413*k4[i]);
+                fcn (n, x+c14*h, yy1, k10, gradfunc, gpars, norbits);
+                for (i = 0; i < n; i++)
+                    yy1[i] = y[i] + h * (a151*k1[i] + a156*k6[i] + a157*k7[i] + a158*k8[i] +
+                                         a1511*k2[i] + a1512*k3[i] + a1513*k4[i] +
+                                         a1514*k10[i]);
+                fcn (n, x+c15*h, yy1, k2, gradfunc, gpars, norbits);
+                for (i = 0; i < n; i++)
+                    yy1[i] = y[i] + h * (a161*k1[i] + a166*k6[i] + a167*k7[i] + a168*k8[i] +
+                                         a169*k9[i] + a1613*k4[i] + a1614*k10[i] +
+                                         a1615*k2[i]);
+                fcn (n, x+c16*h, yy1, k3, gradfunc, gpars, norbits);
+                ws->nfcn += 3;
+
+                for (i = 0; i < n; i++) {
+                    ws->rcont5[i] = h * (ws->rcont5[i] + d413*k4[i] + d414*k10[i] +
+                                         d415*k2[i] + d416*k3[i]);
+                    ws->rcont6[i] = h * (ws->rcont6[i] + d513*k4[i] + d514*k10[i] +
+                                         d515*k2[i] + d516*k3[i]);
+                    ws->rcont7[i] = h * (ws->rcont7[i] + d613*k4[i] + d614*k10[i] +
+                                         d615*k2[i] + d616*k3[i]);
+                    ws->rcont8[i] = h * (ws->rcont8[i] + d713*k4[i] + d714*k10[i] +
+                                         d715*k2[i] + d716*k3[i]);
+                }
+            }
+
+            memcpy (k1, k4, n * sizeof(double));
+            memcpy (y, k5, n * sizeof(double));
+            xold = x;
+            x = xph;
+
+            /* write out all requested times covered by this step */
+            while ((ws->ndense < nout) && ((tout[ws->ndense] - x) * posneg <= 0.0)) {
+                contd8_ws (ws, tout[ws->ndense], xold, h, yout + ws->ndense*n);
+                ws->ndense++;
+            }
+
+            /* normal exit */
+            if (last) {
+                /* x + (xend - x) can be off from xend by round-off */
+                while ((ws->ndense < nout) && ((tout[ws->ndense] - xend) * posneg <= 0.0)) {
+                    memcpy (yout + ws->ndense*n, y, n * sizeof(double));
+                    ws->ndense++;
+                }
+                ws->hnext = hnew;
+                return 1;
+            }
+
+            if (fabs(hnew) > hmax)
+                hnew = posneg * hmax;
+            if (reject)
+                hnew = posneg * min_d (fabs(hnew), fabs(h));
+
+            reject = 0;
+        } else {
+            /* step rejected */
+            hnew = h / min_d (facc1, fac11/safe);
+            reject = 1;
+            if (ws->naccpt >= 1)
+                ws->nrejct++;
+            last = 0;
+        }
+
+        h = hnew;
+    }
+}
+
+int dop853_ws (Dop853Workspace *ws, FcnEqDiff fcn, GradFn gradfunc, double *gpars,
+               unsigned norbits, double x, double *y, double xend,
+               double rtol, double atol, double h, long nmax) {
+    return dopcor_ws (ws, fcn, gradfunc, gpars, norbits, x, y, xend,
+                      rtol, atol, h, nmax, NULL, 0, NULL);
+}
+
+int dop853_ws_dense (Dop853Workspace *ws, FcnEqDiff fcn, GradFn gradfunc, double *gpars,
+                     unsigned norbits, double x, double *y, double xend,
+                     double rtol, double atol, double h, long nmax,
+                     double *tout, unsigned nout, double *yout) {
+    return dopcor_ws (ws, fcn, gradfunc, gpars, norbits, x, y, xend,
+                      rtol, atol, h, nmax, tout, nout, yout);
+}
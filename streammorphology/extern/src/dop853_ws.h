@@ -0,0 +1,38 @@
+/*
+    Re-entrant DOP853 -- see dop853_ws.c. The function pointer types are the
+    same as in gary's dop853.h, so the same right-hand side functions (e.g.,
+    Fwrapper) can be used with either integrator.
+*/
+
+#include "dop853.h"
+
+typedef struct {
+    unsigned n;       /* dimension of the system */
+    double *work;     /* one block of memory for all of the stages */
+    double *yy1, *k1, *k2, *k3, *k4, *k5, *k6, *k7, *k8, *k9, *k10;
+    double *rcont1, *rcont2, *rcont3, *rcont4, *rcont5, *rcont6, *rcont7, *rcont8;
+    double hnext;     /* predicted step size after the last call */
+    long nfcn, nstep, naccpt, nrejct;
+    unsigned ndense;  /* number of dense output times written by the last call */
+} Dop853Workspace;
+
+extern int dop853_ws_alloc (Dop853Workspace *ws, unsigned n);
+extern void dop853_ws_free (Dop853Workspace *ws);
+
+/* Integrate y from x to xend. Return values are the same as dop853(): 1 for
+   success, -2 if more than nmax steps are needed, -3 if the step size
+   becomes too small, -4 if the problem is probably stiff. */
+extern int dop853_ws (Dop853Workspace *ws, FcnEqDiff fcn, GradFn gradfunc, double *gpars,
+                      unsigned norbits, double x, double *y, double xend,
+                      double rtol, double atol, double h, long nmax);
+
+/* Same as dop853_ws(), but the step size is not limited by the output times:
+   the solution at each of the nout times in tout (sorted, in the direction
+   of integration) is interpolated with the continuous extension of the
+   method and written to yout (nout*n values). Output times equal to x get
+   the initial conditions, times past xend are not written; ws->ndense is
+   the number of times written. */
+extern int dop853_ws_dense (Dop853Workspace *ws, FcnEqDiff fcn, GradFn gradfunc, double *gpars,
+                            unsigned norbits, double x, double *y, double xend,
+                            double rtol, double atol, double h, long nmax,
+                            double *tout, unsigned nout, double *yout);
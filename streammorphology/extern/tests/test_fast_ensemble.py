@@ -10,7 +10,8 @@ import gary.potential as gp
 from gary.units import galactic
 
 # Project
-from ..fast_ensemble import ensemble_integrate
+from ..fast_ensemble import (ensemble_integrate, ensemble_integrate_independent,
+                             ensemble_integrate_dense)
 
 def test_integrate():
     potential = gp.LogarithmicPotential(v_c=1., r_h=0.1, q1=1., q2=1., q3=1., units=galactic)
@@ -22,3 +23,78 @@ def test_integrate():
 
     for i in range(1,norbits):
         assert np.all(w[0] == w[i])
+
+def test_integrate_independent():
+    potential = gp.LogarithmicPotential(v_c=1., r_h=0.1, q1=1., q2=1., q3=0.8, units=galactic)
+
+    norbits = 100
+    w0 = np.random.normal([1.,0.,0.5,0.,0.8,0.1], [0.01,0.01,0.01,0.005,0.005,0.005],
+                          size=(norbits,6))
+    w = ensemble_integrate_independent(potential.c_instance, w0, dt0=0.5, nsteps=1000, t0=0.)
+    w_shared = ensemble_integrate(potential.c_instance, w0, dt0=0.5, nsteps=1000, t0=0.)
+    np.testing.assert_allclose(w, w_shared, atol=1E-2)
+
+    E0 = potential.total_energy(w0[:,:3], w0[:,3:])
+    E = potential.total_energy(w[:,:3], w[:,3:])
+    assert np.all(np.abs((E-E0)/E0) < 1E-5)
+
+def test_integrate_threads():
+    potential = gp.LogarithmicPotential(v_c=1., r_h=0.1, q1=1., q2=1., q3=0.8, units=galactic)
+
+    norbits = 100
+    w0 = np.random.normal([1.,0.,0.5,0.,0.8,0.1], [0.01,0.01,0.01,0.005,0.005,0.005],
+                          size=(norbits,6))
+    w1 = ensemble_integrate_independent(potential.c_instance, w0, dt0=0.5, nsteps=1000, t0=0.)
+    w4 = ensemble_integrate_independent(potential.c_instance, w0, dt0=0.5, nsteps=1000, t0=0.,
+                                        nthreads=4)
+
+    # each orbit has its own integrator state, so the result can't depend on threads
+    assert np.all(w1 == w4)
+
+def test_integrate_inplace():
+    potential = gp.LogarithmicPotential(v_c=1., r_h=0.1, q1=1., q2=1., q3=0.8, units=galactic)
+
+    norbits = 100
+    w0 = np.random.normal([1.,0.,0.5,0.,0.8,0.1], [0.01,0.01,0.01,0.005,0.005,0.005],
+                          size=(norbits,6))
+
+    for func in [ensemble_integrate, ensemble_integrate_independent]:
+        w = func(potential.c_instance, w0, dt0=0.5, nsteps=100, t0=0.)
+
+        # separate output buffer
+        out = np.zeros_like(w0)
+        w_out = func(potential.c_instance, w0, dt0=0.5, nsteps=100, t0=0., out=out)
+        assert np.all(out == w)
+        assert np.may_share_memory(w_out, out)
+
+        # in place
+        ww = w0.copy()
+        func(potential.c_instance, ww, dt0=0.5, nsteps=100, t0=0., out=ww)
+        assert np.all(ww == w)
+
+def test_integrate_dense():
+    potential = gp.LogarithmicPotential(v_c=1., r_h=0.1, q1=1., q2=1., q3=0.8, units=galactic)
+
+    norbits = 100
+    w0 = np.random.normal([1.,0.,0.5,0.,0.8,0.1], [0.01,0.01,0.01,0.005,0.005,0.005],
+                          size=(norbits,6))
+    t = 0.5*np.array([0, 10, 250, 251, 1000])
+
+    # the shared step size is only controlled by the error norm of the whole
+    #   ensemble, so doesn't agree as well with restarting at each time
+    for per_orbit_steps,func,atol in [(0, ensemble_integrate, 1E-3),
+                                      (1, ensemble_integrate_independent, 1E-6)]:
+        ws = ensemble_integrate_dense(potential.c_instance, w0, t, dt0=0.5,
+                                      per_orbit_steps=per_orbit_steps)
+        assert ws.shape == (len(t), norbits, 6)
+        assert np.all(ws[0] == w0)
+
+        # same as restarting the integrator at each of the times
+        for i in range(1,len(t)):
+            w = func(potential.c_instance, w0, dt0=0.5, nsteps=int(t[i]/0.5), t0=0.)
+            np.testing.assert_allclose(ws[i], w, atol=atol)
+
+    w1 = ensemble_integrate_dense(potential.c_instance, w0, t, dt0=0.5, per_orbit_steps=1)
+    w4 = ensemble_integrate_dense(potential.c_instance, w0, t, dt0=0.5, per_orbit_steps=1,
+                                  nthreads=4)
+    assert np.all(w1 == w4)
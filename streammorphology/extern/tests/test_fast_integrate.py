@@ -0,0 +1,37 @@
+# coding: utf-8
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Third-party
+import numpy as np
+import gary.potential as gp
+from gary.units import galactic
+
+# Project
+from ..fast_ensemble import ensemble_integrate
+from ..fast_integrate import dense_integrate
+
+def test_dense_integrate():
+    potential = gp.LogarithmicPotential(v_c=1., r_h=0.1, q1=1., q2=1., q3=0.8, units=galactic)
+
+    w0 = np.array([1.,0.,0.5,0.,0.8,0.1])
+    t = np.linspace(0., 100., 10001)
+    w,res,nfcn = dense_integrate(potential.c_instance, w0, t, 1E-12, 1E-12, 0)
+    assert res == 1
+    assert np.all(w[0] == w0)
+    assert np.all(np.isfinite(w))
+
+    # the step size isn't limited by the output times
+    assert nfcn < 12*len(t)
+
+    # interpolated orbit agrees with integrating to each output time (note:
+    #   ensemble_integrate uses a tolerance of 1E-8)
+    for i in [2, 170, 5000, 10000]:
+        w_i = ensemble_integrate(potential.c_instance, w0[None].copy(), dt0=t[1], nsteps=i, t0=0.)
+        np.testing.assert_allclose(w[i], w_i[0], atol=1E-6)
+
+    # output times don't change the integration
+    w2,res,nfcn = dense_integrate(potential.c_instance, w0, t[::1000].copy(), 1E-12, 1E-12, 0)
+    np.testing.assert_allclose(w2, w[::1000], atol=1E-10)
@@ -16,7 +16,7 @@ import gary.potential as gp
 from gary.units import galactic
 
 # Project
-from ..fast_mle import mle
+from ..fast_mle import mle, mle_many, lyapunov_spectrum, history_steps
 
 def test_mle():
     potential = gp.LogarithmicPotential(v_c=1., r_h=0.1, q1=1., q2=1., q3=0.8, units=galactic)
@@ -28,3 +28,83 @@ def test_mle():
     print(l[-2] - l2)
     print(t[-2] - t2)
     print(w[-2] - w2.reshape(3,6))
+
+def test_mle_many():
+    potential = gp.LogarithmicPotential(v_c=1., r_h=0.1, q1=1., q2=1., q3=0.8, units=galactic)
+
+    w0 = np.array([[1., 0., 1., 0., 0.75, 0.],
+                   [1., 0., 0.2, 0., 0.9, 0.1],
+                   [0.5, 0.3, 0.2, 0.1, 0.5, 0.1]])
+
+    np.random.seed(42)
+    single = [mle(w.copy(), potential, dt=0.1, nsteps=10000) for w in w0]
+
+    # same random offsets, so should get exactly the same answer
+    np.random.seed(42)
+    LEs,t,w,status = mle_many(w0, potential, dt=0.1, nsteps=10000, nthreads=2)
+
+    assert np.all(status > 0)
+    for i,(l,tt,ww) in enumerate(single):
+        assert np.all(l == LEs[i])
+        assert np.all(ww == w[i])
+        assert np.allclose(tt, t[i])
+
+def test_lyapunov_spectrum():
+    potential = gp.LogarithmicPotential(v_c=1., r_h=0.05, q1=0.9, q2=1., q3=0.7, units=galactic)
+
+    w0 = np.array([0.5, 0.3, 0.2, 0., 0., 0.])
+    LEs,t,w = lyapunov_spectrum(w0, potential, dt=0.02, nsteps=50000, nvectors=6)
+
+    # Hamiltonian system, so the exponents come in +/- pairs
+    assert np.abs(LEs.sum()) < 1E-8
+    assert LEs[0] == LEs.max()
+
+    # should agree with the offset orbit estimate for a small enough offset
+    l,t2,w2 = mle(w0.copy(), potential, dt=0.02, nsteps=50000, d0=1E-8)
+    assert np.allclose(w, w2[0], atol=1E-3) # different adaptive steps
+    assert np.abs(LEs[0] - np.mean(l)) / np.mean(l) < 0.25
+
+def test_mle_convergence():
+    potential = gp.LogarithmicPotential(v_c=1., r_h=0.05, q1=0.9, q2=1., q3=0.7, units=galactic)
+
+    # a regular (tube) orbit and a chaotic orbit
+    w0 = np.array([[1., 0., 0.5, 0., 0.8, 0.],
+                   [1., 0., 0., 0., 0.2, 0.3]])
+    nsteps = 320000
+
+    LEs,t,w,status = mle_many(w0, potential, dt=0.02, nsteps=nsteps)
+    assert np.all(status == 1)
+    assert np.allclose(t, 0.02*(nsteps+1))
+
+    LEs,t,w,status = mle_many(w0, potential, dt=0.02, nsteps=nsteps,
+                              convergence_tol=0.1, min_nsteps=20000)
+    assert status[0] == 3 # regular
+    assert status[1] in [1,2] # chaotic -- shouldn't be called regular
+    assert t[0] < 0.02*nsteps / 4.
+
+    # stopping time is returned by the single-orbit version as well
+    l,t1,w1 = mle(w0[0].copy(), potential, dt=0.02, nsteps=nsteps,
+                  convergence_tol=0.1, min_nsteps=20000)
+    assert np.allclose(t1, t[0])
+
+def test_mle_history():
+    potential = gp.LogarithmicPotential(v_c=1., r_h=0.05, q1=0.9, q2=1., q3=0.7, units=galactic)
+
+    w0 = np.array([[1., 0., 0.5, 0., 0.8, 0.],
+                   [1., 0., 0., 0., 0.2, 0.3]])
+    nsteps = np.array([100000, 50000])
+
+    steps = history_steps(nsteps, 32)
+    assert steps.shape == (2,32)
+    assert np.all(steps[:,-1] == nsteps)
+    assert np.all(np.diff(steps, axis=1) >= 0)
+
+    history = np.zeros((2,32)) + np.nan
+    history_t = np.zeros((2,32)) + np.nan
+    LEs,t,w,status = mle_many(w0, potential, dt=0.02, nsteps=nsteps,
+                              history_t=history_t, history=history)
+    assert np.all(np.isfinite(history))
+    assert np.allclose(history_t, 0.02*steps)
+
+    # last sample is (nearly) the final estimate
+    assert np.allclose(history[:,-1], LEs.mean(axis=1), rtol=1E-3)
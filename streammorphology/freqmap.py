@@ -12,15 +12,17 @@ from astropy import log as logger
 import gary.integrate as gi
 import gary.coordinates as gc
 import gary.dynamics as gd
-from superfreq import SuperFreq
 
 # Project
-from .util import estimate_dt_nsteps
+from .util import estimate_dt_nsteps, extend_orbit, superfreq_context
 from .experimentrunner import OrbitGridExperiment
 
 __all__ = ['Freqmap']
 
 class Freqmap(OrbitGridExperiment):
+    # share the estimated periods with other experiments on the same grid
+    cache_periods = True
+
     # failure error codes
     error_codes = {
         1: "Failed to integrate orbit or estimate dt, nsteps.",
@@ -41,7 +43,8 @@ class Freqmap(OrbitGridExperiment):
     ]
 
     _run_kwargs = ['nperiods', 'nsteps_per_period', 'hamming_p', 'energy_tolerance',
-                   'force_cartesian', 'nintvec']
+                   'force_cartesian', 'nintvec', 'batch_size', 'batch_dt_tolerance',
+                   'reuse_exploration']
     config_defaults = dict(
         energy_tolerance=1E-8, # Maximum allowed fractional energy difference
         nperiods=256, # Total number of orbital periods to integrate for
@@ -49,11 +52,29 @@ class Freqmap(OrbitGridExperiment):
         hamming_p=4, # Exponent to use for Hamming filter in SuperFreq
         nintvec=15, # maximum number of integer vectors to use in SuperFreq
         force_cartesian=False, # Do frequency analysis on cartesian coordinates
+        batch_size=1, # Max. number of orbits to integrate together when run in blocks (1 = off)
+        batch_dt_tolerance=1.25, # Max. ratio of timesteps for orbits integrated together
+        reuse_exploration=False, # Start the integration from the orbit used to estimate dt, nsteps (not with batch_size > 1)
         w0_filename='w0.npy', # Name of the initial conditions file
         cache_filename='freqmap.npy', # Name of the cache file
         potential_filename='potential.yml' # Name of cached potential file
     )
 
+    @classmethod
+    def map_value(cls, d):
+        """
+        log10 of the frequency diffusion time: the integration time divided
+        by the fractional change in the frequencies between the two windows,
+        averaged over the three frequencies.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac_freq_diff = np.abs((np.abs(d['freqs'][:,1]) - np.abs(d['freqs'][:,0])) /
+                                    d['freqs'][:,0])
+            diffusion_time = (d['dt']*d['nsteps'])[:,None] / frac_freq_diff
+            val = np.log10(diffusion_time.mean(axis=1))
+        val[~d['success'] | ~np.isfinite(val)] = np.nan
+        return val
+
     @classmethod
     def run(cls, w0, potential, **kwargs):
         c = dict()
@@ -68,9 +89,21 @@ class Freqmap(OrbitGridExperiment):
 
         # get timestep and nsteps for integration
         try:
-            dt, nsteps = estimate_dt_nsteps(w0.copy(), potential,
-                                            c['nperiods'],
-                                            c['nsteps_per_period'])
+            if c['reuse_exploration']:
+                dt, nsteps, periods, t, ws = estimate_dt_nsteps(w0.copy(), potential,
+                                                                c['nperiods'],
+                                                                c['nsteps_per_period'],
+                                                                periods=kwargs.get('periods'),
+                                                                return_periods=True,
+                                                                return_orbit=True,
+                                                                **cls.period_cache_params)
+            else:
+                dt, nsteps, periods = estimate_dt_nsteps(w0.copy(), potential,
+                                                         c['nperiods'],
+                                                         c['nsteps_per_period'],
+                                                         periods=kwargs.get('periods'),
+                                                         return_periods=True,
+                                                         **cls.period_cache_params)
         except RuntimeError:
             logger.warning("Failed to integrate orbit when estimating dt,nsteps")
             result['freqs'] = np.ones((2,3))*np.nan
@@ -87,11 +120,125 @@ class Freqmap(OrbitGridExperiment):
         # integrate orbit
         logger.debug("Integrating orbit with dt={0}, nsteps={1}".format(dt, nsteps))
         try:
-            t,ws = potential.integrate_orbit(w0.copy(), dt=dt, nsteps=nsteps,
-                                             Integrator=gi.DOPRI853Integrator,
-                                             Integrator_kwargs=dict(atol=1E-11))
+            if c['reuse_exploration']:
+                # continue from the end of the exploratory orbit
+                t,ws = extend_orbit(t, ws, potential, dt, nsteps,
+                                    Integrator=gi.DOPRI853Integrator,
+                                    Integrator_kwargs=dict(atol=1E-11))
+            else:
+                t,ws = potential.integrate_orbit(w0.copy(), dt=dt, nsteps=nsteps,
+                                                 Integrator=gi.DOPRI853Integrator,
+                                                 Integrator_kwargs=dict(atol=1E-11))
         except RuntimeError: # ODE integration failed
             logger.warning("Orbit integration failed.")
+            t = ws = None
+
+        result = cls._analyze_orbit(t, ws, potential, dt, nsteps, c)
+        result['_periods'] = periods
+        return result
+
+    @classmethod
+    def run_batch(cls, w0, potential, **kwargs):
+        """
+        Run the experiment on a block of orbits. Orbits with similar timesteps
+        (within a factor of ``batch_dt_tolerance``) are integrated together,
+        up to ``batch_size`` at a time, using the smallest timestep in the
+        group, then the frequency analysis is done for each orbit separately.
+        Returns a list of result dictionaries, one per orbit.
+
+        The orbits are integrated from their initial conditions with the
+        shared timestep, so this can't be combined with ``reuse_exploration``.
+        """
+        c = dict()
+        for k in cls.config_defaults.keys():
+            if k not in kwargs:
+                c[k] = cls.config_defaults[k]
+            else:
+                c[k] = kwargs[k]
+
+        if c['reuse_exploration'] and c['batch_size'] > 1:
+            raise ValueError("reuse_exploration can't be used when orbits are integrated "
+                             "together (batch_size > 1).")
+
+        norbits = len(w0)
+        results = [None]*norbits
+
+        # periods from a previous run, if any
+        periods = kwargs.get('periods')
+        periods = [None]*norbits if periods is None else list(periods)
+
+        # get timestep and nsteps for integration for each orbit
+        dts = np.zeros(norbits) + np.nan
+        nsteps = np.zeros(norbits, dtype=int)
+        for i in range(norbits):
+            try:
+                dts[i], nsteps[i], periods[i] = estimate_dt_nsteps(w0[i].copy(), potential,
+                                                                   c['nperiods'],
+                                                                   c['nsteps_per_period'],
+                                                                   periods=periods[i],
+                                                                   return_periods=True,
+                                                                   **cls.period_cache_params)
+            except RuntimeError:
+                logger.warning("Failed to integrate orbit when estimating dt,nsteps")
+                results[i] = dict(freqs=np.ones((2,3))*np.nan, success=False, error_code=1)
+            except:
+                logger.warning("Unexpected failure!")
+                results[i] = dict(freqs=np.ones((2,3))*np.nan, success=False, error_code=4)
+
+        # group orbits with similar timesteps
+        ix = np.where(np.isfinite(dts))[0]
+        ix = ix[np.argsort(dts[ix])]
+        blocks = []
+        for i in ix:
+            if (len(blocks) == 0 or len(blocks[-1]) >= c['batch_size'] or
+                    dts[i] > c['batch_dt_tolerance']*dts[blocks[-1][0]]):
+                blocks.append([i])
+            else:
+                blocks[-1].append(i)
+
+        for block in blocks:
+            # all orbits in the block share the smallest timestep, but are each
+            #   integrated for the same total time as they would be on their own
+            dt = dts[block[0]]
+            block_nsteps = np.round(nsteps[block] * dts[block] / dt).astype(int)
+
+            logger.debug("Integrating {0} orbits with dt={1}, nsteps={2}"
+                         .format(len(block), dt, block_nsteps.max()))
+            try:
+                t,ws = potential.integrate_orbit(w0[block].copy(), dt=dt,
+                                                 nsteps=block_nsteps.max(),
+                                                 Integrator=gi.DOPRI853Integrator,
+                                                 Integrator_kwargs=dict(atol=1E-11))
+            except RuntimeError:
+                # one bad orbit shouldn't fail the whole block
+                logger.warning("Block integration failed -- running orbits individually.")
+                for i in block:
+                    results[i] = cls.run(w0[i], potential, periods=periods[i], **c)
+                continue
+
+            for j,i in enumerate(block):
+                sl = slice(None, block_nsteps[j]+1)
+                results[i] = cls._analyze_orbit(t[sl], ws[sl,j:j+1], potential,
+                                                dt, block_nsteps[j], c)
+
+        for i in range(norbits):
+            if periods[i] is not None:
+                results[i]['_periods'] = periods[i]
+
+        return results
+
+    @classmethod
+    def _analyze_orbit(cls, t, ws, potential, dt, nsteps, c):
+        """
+        Check energy conservation and compute the frequencies for a single
+        integrated orbit. ``ws`` should have shape (nsteps+1,1,6), or be
+        ``None`` if the integration failed.
+        """
+
+        # return dict
+        result = dict()
+
+        if ws is None:
             dEmax = 1E10
         else:
             logger.debug('Orbit integrated successfully, checking energy conservation...')
@@ -110,9 +257,10 @@ class Freqmap(OrbitGridExperiment):
             result['dE_max'] = dEmax
             return result
 
-        # start finding the frequencies -- do first half then second half
-        sf1 = SuperFreq(t[:nsteps//2+1], p=c['hamming_p'])
-        sf2 = SuperFreq(t[nsteps//2:], p=c['hamming_p'])
+        # start finding the frequencies -- do first half then second half (for
+        #   even nsteps, these have the same sampling and share a SuperFreq)
+        sf1 = superfreq_context(t[:nsteps//2+1], p=c['hamming_p'])
+        sf2 = superfreq_context(t[nsteps//2:], p=c['hamming_p'])
 
         # classify orbit full orbit
         circ = gd.classify_orbit(ws)
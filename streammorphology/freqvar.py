@@ -11,15 +11,18 @@ import gary.integrate as gi
 import gary.coordinates as gc
 import gary.dynamics as gd
 from gary.util import rolling_window
-from superfreq import SuperFreq
 
 # Project
-from .util import estimate_dt_nsteps
+from .slidingfreq import SlidingFrequencies
+from .util import estimate_dt_nsteps, superfreq_context
 from .experimentrunner import OrbitGridExperiment
 
 __all__ = ['FreqVariance']
 
 class FreqVariance(OrbitGridExperiment):
+    # share the estimated periods with other experiments on the same grid
+    cache_periods = True
+
     # failure error codes
     error_codes = {
         1: "Failed to integrate orbit or estimate dt, nsteps.",
@@ -29,7 +32,7 @@ class FreqVariance(OrbitGridExperiment):
 
     _run_kwargs = ['total_nperiods', 'window_width', 'window_stride',
                    'energy_tolerance', 'nsteps_per_period', 'hamming_p',
-                   'force_cartesian', 'nintvec']
+                   'force_cartesian', 'nintvec', 'incremental']
     config_defaults = dict(
         total_nperiods=128+64, # total number of periods to integrate for
         window_width=128, # width of the window (in orbital periods) to compute freqs in
@@ -39,6 +42,7 @@ class FreqVariance(OrbitGridExperiment):
         hamming_p=1, # Exponent to use for Hamming filter
         nintvec=10, # maximum number of integer vectors to use in SuperFreq
         force_cartesian=False, # Do frequency analysis on cartesian coordinates
+        incremental=False, # Follow the frequencies from the first window instead of rerunning SuperFreq
         w0_filename='w0.npy', # Name of the initial conditions file
         cache_filename='freqvariance.npy', # Name of the cache file
         potential_filename='potential.yml' # Name of cached potential file
@@ -76,14 +80,18 @@ class FreqVariance(OrbitGridExperiment):
 
         # automatically estimate dt, nsteps
         try:
-            dt, nsteps = estimate_dt_nsteps(w0.copy(), potential,
-                                            c['total_nperiods'], c['nsteps_per_period'])
+            dt, nsteps, periods = estimate_dt_nsteps(w0.copy(), potential,
+                                                     c['total_nperiods'], c['nsteps_per_period'],
+                                                     periods=kwargs.get('periods'),
+                                                     return_periods=True,
+                                                     **cls.period_cache_params)
         except RuntimeError:
             logger.warning("Failed to integrate orbit when estimating dt,nsteps")
             result['freqs'] = np.nan
             result['success'] = False
             result['error_code'] = 1
             return result
+        result['_periods'] = periods
 
         logger.debug("Integrating orbit with dt={0}, nsteps={1}".format(dt, nsteps))
         try:
@@ -117,6 +125,23 @@ class FreqVariance(OrbitGridExperiment):
         circ = gd.classify_orbit(ws[:,0])
         is_tube = np.any(circ)
 
+        # the coordinate transformation is done point by point, so it only
+        #   has to be done once for the whole orbit
+        if is_tube and not c['force_cartesian']:
+            # need to flip coordinates until circulation is around z axis
+            new_ws = gd.align_circulation_with_z(ws[:,0], circ)
+            new_ws = gc.cartesian_to_poincare_polar(new_ws)
+        else:
+            new_ws = ws[:,0]
+        all_fs = [(new_ws[:,j] + 1j*new_ws[:,j+3]) for j in range(3)]
+
+        # in incremental mode, SuperFreq is only run on the first window (or
+        #   after the frequencies can no longer be followed) -- see
+        #   SlidingFrequencies
+        tracker = None
+        if c['incremental']:
+            tracker = SlidingFrequencies(t, all_fs, p=c['hamming_p'])
+
         logger.debug("Running SuperFreq on each window:")
 
         allfreqs = []
@@ -126,26 +151,35 @@ class FreqVariance(OrbitGridExperiment):
                 break
 
             logger.debug("Window: {0}:{1}".format(i1,i2))
-            if is_tube and not c['force_cartesian']:
-                # need to flip coordinates until circulation is around z axis
-                new_ws = gd.align_circulation_with_z(ww, circ)
-                new_ws = gc.cartesian_to_poincare_polar(new_ws)
-            else:
-                new_ws = ww
-
-            fs = [(new_ws[:,j] + 1j*new_ws[:,j+3]) for j in range(3)]
-            naff = SuperFreq(t[i1:i2], p=c['hamming_p'])
+            tracked = None
+            if tracker is not None and tracker.tracking:
+                tracked = tracker.advance(i1, i2)
 
-            try:
-                freqs,d,ixs = naff.find_fundamental_frequencies(fs, nintvec=c['nintvec'])
-            except:
-                result['freqs'] = np.nan
-                result['success'] = False
-                result['error_code'] = 3
-                return result
+            if tracked is not None:
+                freqs,amps = tracked
 
-            allfreqs.append(freqs.tolist())
-            allamps.append(d['|A|'][ixs].tolist())
+            else:
+                fs = [f[i1:i2] for f in all_fs]
+                naff = superfreq_context(t[i1:i2], p=c['hamming_p'])
+
+                try:
+                    freqs,d,ixs = naff.find_fundamental_frequencies(fs, nintvec=c['nintvec'])
+                except:
+                    result['freqs'] = np.nan
+                    result['success'] = False
+                    result['error_code'] = 3
+                    return result
+                amps = d['|A|'][ixs]
+
+                if tracker is not None:
+                    tracker.start(i1, i2, freqs)
+
+            allfreqs.append(np.array(freqs).tolist())
+            allamps.append(np.array(amps).tolist())
+
+        if tracker is not None:
+            logger.debug("Followed frequencies in {0} windows, {1} full recomputations of "
+                         "the transform".format(tracker.nslide, tracker.nrecompute))
         allfreqs = np.array(allfreqs)
         allamps = np.array(allamps)
 
@@ -7,13 +7,96 @@ from __future__ import division, print_function
 __author__ = "adrn <adrn@astro.columbia.edu>"
 
 # Third-party
-from astropy import log as logger
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.optimize import minimize
 
 __all__ = ['tube_grid_xz', 'box_grid']
 
+def _zvc_distance(E, potential, x0, direction, s0=1., tol=1E-12, maxiter=256):
+    r"""
+    Solve :math:`\Phi(x_0 + s\,\hat{n}) = E` for the distance :math:`s`
+    along many rays at once, where :math:`x_0` is a point inside the
+    zero-velocity surface and :math:`\hat{n}` is a direction. The root is
+    first bracketed by doubling the distance, then found with Newton's method
+    (using the potential gradient), falling back to bisection whenever a
+    Newton step would leave the bracket. Each iteration evaluates the
+    potential for all unconverged rays in a single call.
+
+    This assumes that the potential increases monotonically along each ray.
+    Rays that start outside of the zero-velocity surface get a distance of 0.
+    The potential is never evaluated at the starting points themselves.
+
+    Parameters
+    ----------
+    E : numeric
+        Energy of the zero-velocity surface.
+    potential : :class:`~gary.potential.Potential`
+        A :class:`~gary.potential.Potential` subclass instance.
+    x0 : array_like
+        Starting points, shape ``(n,3)``.
+    direction : array_like
+        Directions (unit vectors), shape ``(n,3)``.
+    s0 : numeric (optional)
+        Initial guess for the upper bracket of the distance.
+    tol : numeric (optional)
+        Fractional tolerance on the distance (relative to ``s0`` for
+        distances smaller than ``s0``).
+    maxiter : int (optional)
+        Maximum number of iterations for each of the bracketing and the
+        root finding.
+
+    Returns
+    -------
+    s : :class:`numpy.ndarray`
+        The distance to the zero-velocity surface along each ray.
+    """
+    x0 = np.atleast_2d(np.asarray(x0, dtype=float))
+    direction = np.atleast_2d(np.asarray(direction, dtype=float))
+    n = len(x0)
+
+    lo = np.zeros(n)
+    hi = np.zeros(n) + s0
+
+    # expand the upper bracket until the potential is above E for all rays
+    ix = np.arange(n)
+    for i in range(maxiter):
+        xyz = np.ascontiguousarray(x0[ix] + hi[ix,None]*direction[ix])
+        inside = potential.value(xyz) < E
+        if not np.any(inside):
+            break
+        ix = ix[inside]
+        lo[ix] = hi[ix]
+        hi[ix] *= 2.
+    else:
+        raise ValueError("Failed to bracket the zero-velocity surface for {0} rays."
+                         .format(len(ix)))
+
+    # safeguarded Newton iterations for all rays that haven't converged yet
+    s = 0.5 * (lo + hi)
+    ix = np.arange(n)
+    for i in range(maxiter):
+        xyz = np.ascontiguousarray(x0[ix] + s[ix,None]*direction[ix])
+        dPhi = potential.value(xyz) - E
+        dPhi_ds = np.sum(potential.gradient(xyz) * direction[ix], axis=-1)
+
+        # shrink the brackets
+        inside = dPhi < 0
+        lo[ix[inside]] = s[ix[inside]]
+        hi[ix[~inside]] = s[ix[~inside]]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s_new = s[ix] - dPhi / dPhi_ds
+        bisect = ~((s_new > lo[ix]) & (s_new < hi[ix]))
+        s_new[bisect] = 0.5 * (lo[ix[bisect]] + hi[ix[bisect]])
+
+        converged = np.abs(s_new - s[ix]) <= tol*np.maximum(s_new, s0)
+        s[ix] = s_new
+        ix = ix[~converged]
+        if len(ix) == 0:
+            break
+
+    # (rays that start outside the surface have their bracket shrink to 0)
+    return s
+
 def tube_grid_xz(E, potential, dx=1., dz=1.):
     r"""
     Generate a grid of points in the :math:`x-z` plane (:math:`y=0`),
@@ -41,46 +124,34 @@ def tube_grid_xz(E, potential, dx=1., dz=1.):
     """
 
     # find maximum x on z=0
-    def func(x):
-        return (E - potential.value(np.array([[x[0],0,0]])))**2
-    res = minimize(func, x0=[10.], method='powell')
-    if not res.success:
-        raise ValueError("Failed to find boundary of ZVC on x-axis.")
-    max_x = res.x
-
+    max_x = _zvc_distance(E, potential, [[0.,0,0]], [[1.,0,0]])[0]
     xgrid = np.arange(0.1, max_x+dx, dx)
 
-    # compute ZVC boundary for each x
-    for xg in xgrid:
-        # find maximum allowed z along x=xx
-        def func(x):
-            return (E - potential.value(np.array([[xg,0,x[0]]])))**2
-        res = minimize(func, x0=[25.], method='powell')
-        max_z = np.abs(res.x)
-        if not res.success or max_z == 25.:
-            vals = np.linspace(0.1,100)
-            plt.clf()
-            plt.plot(vals,[func([derp]) for derp in vals])
-            plt.show()
-            raise ValueError("Failed to find boundary of ZVC for x={}.".format(xg))
-
-        logger.debug("Max. z: {}".format(max_z))
-        zgrid = np.arange(0.1, max_z, dz)
-        xs = np.zeros_like(zgrid) + xg
-        try:
-            xz = np.hstack((xz, np.vstack((xs,zgrid))))
-        except NameError:
-            xz = np.vstack((xs,zgrid))
-
-    xyz = np.zeros((xz.shape[-1],3))
-    xyz[:,0] = xz[0]
-    xyz[:,2] = xz[1]
+    # compute ZVC boundary (maximum allowed z) for all x at once
+    x0 = np.zeros((len(xgrid),3))
+    x0[:,0] = xgrid
+    n = np.zeros_like(x0)
+    n[:,2] = 1.
+    max_z = _zvc_distance(E, potential, x0, n)
+
+    # same number of points per column as np.arange(0.1, max_z, dz)
+    nz = np.ceil((max_z - 0.1) / dz).astype(int)
+    nz[nz < 0] = 0
+
+    # index of each point within its column
+    offset = np.cumsum(nz) - nz
+    iz = np.arange(nz.sum()) - np.repeat(offset, nz)
+
+    xyz = np.zeros((nz.sum(),3))
+    xyz[:,0] = np.repeat(xgrid, nz)
+    xyz[:,2] = 0.1 + iz*dz
 
     # now, for each grid point, compute the y velocity
-    vxyz = np.zeros_like(xyz)
-    vxyz[:,1] = np.sqrt(2*(E - potential.value(xyz)))
+    w0 = np.zeros((len(xyz),6))
+    w0[:,:3] = xyz
+    w0[:,4] = np.sqrt(2*(E - potential.value(xyz)))
 
-    return np.hstack((xyz, vxyz))
+    return w0
 
 def tube_grid_xz_zoom(E, potential, nx=0, nz=0, bounds=[]):
     r"""
@@ -117,51 +188,36 @@ def tube_grid_xz_zoom(E, potential, nx=0, nz=0, bounds=[]):
     zbounds = bounds[2:]
 
     # find maximum x on z=0
-    def func(x):
-        return (E - potential.value(np.array([[x[0],0,0]])))**2
-    res = minimize(func, x0=[10.], method='powell')
-    if not res.success:
-        raise ValueError("Failed to find boundary of ZVC on x-axis.")
-    max_x = res.x
-
+    max_x = _zvc_distance(E, potential, [[0.,0,0]], [[1.,0,0]])[0]
     if xbounds[1] > max_x:
         raise ValueError("x bounds go outside of allowed energy region.")
 
     xgrid = np.linspace(xbounds[0], xbounds[1], nx)
 
-    # compute ZVC boundary for each x
-    for xg in xgrid:
-        # find maximum allowed z along x=xx
-        def func(x):
-            return (E - potential.value(np.array([[xg,0,x[0]]])))**2
-        res = minimize(func, x0=[25.], method='powell')
-        max_z = np.abs(res.x)
-        if not res.success or max_z == 25.:
-            vals = np.linspace(0.1,100)
-            plt.clf()
-            plt.plot(vals,[func([derp]) for derp in vals])
-            plt.show()
-            raise ValueError("Failed to find boundary of ZVC for x={}.".format(xg))
-
-        if zbounds[1] > max_z:
-            raise ValueError("z bounds go outside of allowed energy region.")
-
-        zgrid = np.linspace(zbounds[0], zbounds[1], nz)
-        xs = np.zeros_like(zgrid) + xg
-        try:
-            xz = np.hstack((xz, np.vstack((xs,zgrid))))
-        except NameError:
-            xz = np.vstack((xs,zgrid))
-
-    xyz = np.zeros((xz.shape[-1],3))
-    xyz[:,0] = xz[0]
-    xyz[:,2] = xz[1]
+    # compute ZVC boundary (maximum allowed z) for all x at once
+    x0 = np.zeros((nx,3))
+    x0[:,0] = xgrid
+    n = np.zeros_like(x0)
+    n[:,2] = 1.
+    max_z = _zvc_distance(E, potential, x0, n)
+
+    if np.any(zbounds[1] > max_z):
+        bad_x = xgrid[zbounds[1] > max_z]
+        raise ValueError("z bounds go outside of allowed energy region for x={0}."
+                         .format(bad_x))
+
+    zgrid = np.linspace(zbounds[0], zbounds[1], nz)
+
+    xyz = np.zeros((nx*nz,3))
+    xyz[:,0] = np.repeat(xgrid, nz)
+    xyz[:,2] = np.tile(zgrid, nx)
 
     # now, for each grid point, compute the y velocity
-    vxyz = np.zeros_like(xyz)
-    vxyz[:,1] = np.sqrt(2*(E - potential.value(xyz)))
+    w0 = np.zeros((len(xyz),6))
+    w0[:,:3] = xyz
+    w0[:,4] = np.sqrt(2*(E - potential.value(xyz)))
 
-    return np.hstack((xyz, vxyz))
+    return w0
 
 def box_grid(E, potential, approx_num=1000, x0=1.):
     r"""
@@ -187,7 +243,7 @@ def box_grid(E, potential, approx_num=1000, x0=1.):
         of initial conditions might have slightly less than this number
         of points.
     x0 : numeric
-        Initial guess for optimization.
+        Initial guess for the radius of the equipotential surface.
 
     """
 
@@ -214,16 +270,11 @@ def box_grid(E, potential, approx_num=1000, x0=1.):
     theta = theta[ix]
     # phi,theta = map(np.ravel, np.meshgrid(phi,theta))
 
-    def func(r,phi,theta):
-        x = r[0]*np.cos(phi)*np.sin(theta)
-        y = r[0]*np.sin(phi)*np.sin(theta)
-        z = r[0]*np.cos(theta)
-        return (E - potential.value(np.array([[x,y,z]])))**2
-
-    r = np.zeros_like(phi)
-    for i,p,t in zip(np.arange(len(phi)),phi,theta):
-        res = minimize(func, x0=[x0], method='powell', args=(p,t))
-        r[i] = res.x
+    # solve for the radius of the equipotential surface along all directions
+    n = np.vstack((np.cos(phi)*np.sin(theta),
+                   np.sin(phi)*np.sin(theta),
+                   np.cos(theta))).T
+    r = _zvc_distance(E, potential, np.zeros_like(n), n, s0=x0)
 
     x = r*np.cos(phi)*np.sin(theta)
     y = r*np.sin(phi)*np.sin(theta)
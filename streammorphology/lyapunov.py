@@ -11,40 +11,112 @@ import numpy as np
 from astropy import log as logger
 
 # Project
-from .extern.fast_mle import mle
+from .extern.fast_mle import mle_many, lyapunov_spectrum_many
 from .util import estimate_dt_nsteps
 from .experimentrunner import OrbitGridExperiment
 
 __all__ = ['Lyapmap']
 
 class Lyapmap(OrbitGridExperiment):
+    # share the estimated periods with other experiments on the same grid
+    cache_periods = True
+
     # failure error codes
     error_codes = {
         1: "Failed to integrate orbit or estimate dt, nsteps.",
         2: "Energy conservation criteria not met."
     }
 
-    cache_dtype = [
-        ('lyap_exp','f8'), # MLE estimate
-        ('success','b1'), # whether computing the frequencies succeeded or not
-        ('error_code','i8'), # if not successful, why did it fail? see below
-        # ('lyap_exp_end','f8',(1024,)), # last 1024 timesteps of FTMLE estimate
-        ('dE_max','f8'), # maximum energy difference (compared to initial) during integration
-    ]
+    # why the integration stopped (when convergence_tol > 0)
+    stop_codes = {
+        0: "Integrated for the full nperiods.",
+        1: "Lyapunov exponent estimate converged.",
+        2: "Estimate decays like a regular orbit."
+    }
+
+    # methods for estimating the Lyapunov exponent
+    lyapunov_methods = ['offset', 'variational']
 
-    _run_kwargs = ['nperiods', 'nsteps_per_period', 'noffset_orbits', 'energy_tolerance']
+    _run_kwargs = ['nperiods', 'nsteps_per_period', 'noffset_orbits', 'energy_tolerance',
+                   'batch_size', 'nthreads', 'lyapunov_method', 'nvectors',
+                   'convergence_tol', 'min_nperiods', 'regular_slope', 'nhistory']
     config_defaults = dict(
         energy_tolerance=1E-7, # Maximum allowed fractional energy difference
         nperiods=1000, # Total number of orbital periods to integrate for
         nsteps_per_period=512, # Number of steps per integration period for integration stepsize
+        lyapunov_method='offset', # 'offset' (offset orbits) or 'variational' (tangent vectors)
         noffset_orbits=2, # Number of offset orbits to integrate and average.
+        nvectors=1, # Number of tangent vectors (Lyapunov exponents) for 'variational'
+        convergence_tol=0., # Stop once the estimate changes by less than this fraction (0 = off)
+        min_nperiods=100, # Minimum number of orbital periods to integrate before stopping early
+        regular_slope=-0.8, # Stop if the estimate decays faster than t^regular_slope (regular orbit)
+        nhistory=0, # Number of log-spaced samples of the finite-time estimate to store (0 = off)
+        batch_size=1, # Number of orbits to send to each worker at a time (1 = off)
+        nthreads=1, # Number of threads to use for integrating a batch of orbits
         w0_filename='w0.npy', # Name of the initial conditions file
         cache_filename='lyapmap.npy', # Name of the cache file
         potential_filename='potential.yml' # Name of cached potential file
     )
 
+    @property
+    def cache_dtype(self):
+        dt = [
+            ('lyap_exp','f8'), # MLE estimate
+            ('success','b1'), # whether computing the frequencies succeeded or not
+            ('error_code','i8'), # if not successful, why did it fail? see below
+            ('dE_max','f8'), # maximum energy difference (compared to initial) during integration
+            ('t_stop','f8'), # time at which the integration stopped
+            ('stop_code','i8'), # why the integration stopped, see above
+        ]
+        if self.config.lyapunov_method == 'variational' and self.config.nvectors > 1:
+            dt.append(('lyap_spectrum','f8',(self.config.nvectors,))) # largest exponents
+
+        return dt
+
+    @property
+    def history_dtype(self):
+        # finite-time estimates at log-spaced times, stored in a separate file
+        if self.config.nhistory <= 0:
+            return None
+
+        return [
+            ('t','f8',(self.config.nhistory,)), # times of each sample
+            ('lyap_exp','f8',(self.config.nhistory,)) # finite-time MLE estimate
+        ]
+
+    @classmethod
+    def map_value(cls, d):
+        """
+        log10 of the maximum Lyapunov exponent.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            val = np.log10(d['lyap_exp'])
+        val[~d['success'] | ~np.isfinite(val)] = np.nan
+        return val
+
     @classmethod
     def run(cls, w0, potential, **kwargs):
+        if 'periods' in kwargs:
+            kwargs['periods'] = [kwargs['periods']]
+        return cls.run_batch(np.atleast_2d(w0), potential, **kwargs)[0]
+
+    @classmethod
+    def run_batch(cls, w0, potential, **kwargs):
+        """
+        Run the experiment on a block of orbits. Each orbit is integrated
+        with its own timestep, but the integrations are split over
+        ``nthreads`` threads in a single process. Returns a list of result
+        dictionaries, one per orbit.
+
+        If ``convergence_tol`` is > 0, the integration of each orbit stops
+        as soon as the running estimate of the Lyapunov exponent converges
+        or the orbit looks regular (but not before ``min_nperiods`` orbital
+        periods). The stopping time and reason are stored in the results.
+
+        If ``nhistory`` is > 0, the running estimate of the (largest)
+        Lyapunov exponent at ``nhistory`` log-spaced times is returned in the
+        results under the key ``'_history'``.
+        """
         c = dict()
         for k in cls.config_defaults.keys():
             if k not in kwargs:
@@ -52,35 +124,98 @@ class Lyapmap(OrbitGridExperiment):
             else:
                 c[k] = kwargs[k]
 
+        if c['lyapunov_method'] not in cls.lyapunov_methods:
+            raise ValueError("Invalid Lyapunov exponent method '{0}' -- must be one of {1}"
+                             .format(c['lyapunov_method'], cls.lyapunov_methods))
+
+        norbits = len(w0)
+        results = [None]*norbits
+
+        # periods from a previous run, if any
+        periods = kwargs.get('periods')
+        periods = [None]*norbits if periods is None else list(periods)
+
+        # get timestep and nsteps for integration for each orbit
+        dts = np.zeros(norbits) + np.nan
+        nsteps = np.zeros(norbits, dtype=int)
+        for i in range(norbits):
+            try:
+                dts[i], nsteps[i], periods[i] = estimate_dt_nsteps(w0[i].copy(), potential,
+                                                                   c['nperiods'],
+                                                                   c['nsteps_per_period'],
+                                                                   periods=periods[i],
+                                                                   return_periods=True,
+                                                                   **cls.period_cache_params)
+            except RuntimeError:
+                logger.warning("Failed to integrate orbit when estimating dt,nsteps")
+                results[i] = dict(lyap_exp=np.nan, success=False, error_code=1)
+
+        ix = np.where(np.isfinite(dts))[0]
+        if len(ix) == 0:
+            return results
+
+        # options for stopping early and recording the history
+        mle_kwargs = dict(convergence_tol=c['convergence_tol'],
+                           regular_slope=c['regular_slope'],
+                           min_nsteps=c['min_nperiods']*c['nsteps_per_period'])
+
+        # buffers for the finite-time estimates, filled in by the integrator
+        if c['nhistory'] > 0:
+            mle_kwargs['history'] = np.zeros((len(ix),c['nhistory'])) + np.nan
+            mle_kwargs['history_t'] = np.zeros((len(ix),c['nhistory'])) + np.nan
+
+        logger.debug("Integrating {0} orbits with {1} threads".format(len(ix), c['nthreads']))
+        if c['lyapunov_method'] == 'variational':
+            LEs,t,w,status = lyapunov_spectrum_many(w0[ix].copy(), potential,
+                                                    dt=dts[ix], nsteps=nsteps[ix],
+                                                    nvectors=c['nvectors'],
+                                                    nthreads=c['nthreads'],
+                                                    **mle_kwargs)
+        else:
+            LEs,t,w,status = mle_many(w0[ix].copy(), potential, dt=dts[ix], nsteps=nsteps[ix],
+                                      noffset_orbits=c['noffset_orbits'],
+                                      nthreads=c['nthreads'], **mle_kwargs)
+            w = w[:,0] # parent orbits
+
+        for j,i in enumerate(ix):
+            if status[j] < 0: # ODE integration failed
+                logger.warning("Orbit integration failed.")
+                results[i] = cls._analyze_orbit(w0[i], None, None, potential, c)
+            else:
+                results[i] = cls._analyze_orbit(w0[i], LEs[j], w[j], potential, c)
+                results[i]['t_stop'] = t[j]
+                results[i]['stop_code'] = status[j] - 1 # see stop_codes
+                if c['nhistory'] > 0:
+                    results[i]['_history'] = dict(t=mle_kwargs['history_t'][j],
+                                                  lyap_exp=mle_kwargs['history'][j])
+                logger.debug("Stopped at t={0:.1f}: {1}".format(t[j],
+                             cls.stop_codes[status[j]-1]))
+
+            results[i]['_periods'] = periods[i]
+
+        return results
+
+    @classmethod
+    def _analyze_orbit(cls, w0, LEs, w, potential, c):
+        """
+        Check energy conservation for a single integrated orbit and store the
+        Lyapunov exponent estimate. ``w`` is the final phase-space position of
+        the (parent) orbit, or ``None`` if the integration failed. ``LEs`` are
+        the estimates from each offset orbit, or the Lyapunov spectrum
+        (largest first) for the variational method.
+        """
+
         # return dict
         result = dict()
 
-        # get timestep and nsteps for integration
-        try:
-            dt, nsteps = estimate_dt_nsteps(w0.copy(), potential,
-                                            c['nperiods'],
-                                            c['nsteps_per_period'])
-        except RuntimeError:
-            logger.warning("Failed to integrate orbit when estimating dt,nsteps")
-            result['lyap_exp'] = np.nan
-            result['success'] = False
-            result['error_code'] = 1
-            return result
-
-        # integrate orbit
-        logger.debug("Integrating orbit with dt={0}, nsteps={1}".format(dt, nsteps))
-        try:
-            LEs,t,w = mle(w0.copy(), potential, dt=dt, nsteps=nsteps,
-                          noffset_orbits=c['noffset_orbits'])
-        except RuntimeError: # ODE integration failed
-            logger.warning("Orbit integration failed.")
+        if w is None:
             dEmax = 1E10
         else:
             logger.debug('Orbit integrated successfully, checking energy conservation...')
 
             # check energy conservation for the orbit
             E0 = potential.total_energy(w0[:3].copy(), w0[3:].copy())[0]
-            E1 = potential.total_energy(w[0,:3].copy(), w[0,3:].copy())[0]
+            E1 = potential.total_energy(w[:3].copy(), w[3:].copy())[0]
             dEmax = np.abs((E1-E0)/E0)
             logger.debug('max(∆E) = {0:.2e}'.format(dEmax))
 
@@ -90,10 +225,11 @@ class Lyapmap(OrbitGridExperiment):
             result['error_code'] = 2
             return result
 
-        # le_end = np.mean(LEs[-16384::16], axis=1)
-        # le_end.resize(1024)
-        result['lyap_exp'] = np.mean(LEs)
-        # result['lyap_exp_end'] = le_end
+        if c['lyapunov_method'] == 'variational':
+            result['lyap_exp'] = LEs[0]
+            result['lyap_spectrum'] = LEs
+        else:
+            result['lyap_exp'] = np.mean(LEs)
         result['success'] = True
         result['error_code'] = 0
         result['dE_max'] = dEmax
@@ -0,0 +1,114 @@
+# coding: utf-8
+
+""" Persistent cache of the estimated periods of the orbits in a grid. """
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import hashlib
+import os
+
+# Third-party
+import numpy as np
+from astropy import log as logger
+
+# Project
+from .util import period_dtype
+
+__all__ = ['PeriodCache']
+
+class PeriodCache(object):
+    """
+    The periods and loop/box classification estimated for each orbit in an
+    initial conditions grid (see ``period_dtype``), stored in a memmap'd file
+    next to the initial conditions file. Every experiment run on the same
+    grid and potential reads from and adds to the same file, so each orbit
+    only has to be explored once.
+
+    The filename contains a hash of the potential file and of the parameters
+    used to estimate the periods, so changing either starts a new cache.
+    Each row also stores the initial conditions the periods were estimated
+    for, so rows for orbits that have since changed (e.g., the grid was
+    regenerated with ``--overwrite``) can be ignored.
+
+    Parameters
+    ----------
+    w0_path : str
+        Path to the initial conditions file.
+    potential_path : str
+        Path to the potential (YAML) file.
+    norbits : int
+        Number of orbits in the grid.
+    **params
+        Any parameters of the period estimation, e.g., ``explore_time``.
+    """
+
+    def __init__(self, w0_path, potential_path, norbits, **params):
+        self.norbits = int(norbits)
+        self.key = self.make_key(potential_path, **params)
+        self.filename = "{0}_periods_{1}.npy".format(os.path.splitext(os.path.abspath(w0_path))[0],
+                                                     self.key)
+        self._memmap = None
+
+        if not os.path.exists(self.filename):
+            logger.debug("Creating period cache {0}".format(self.filename))
+            d = np.memmap(self.filename, mode='w+', dtype=period_dtype, shape=(self.norbits,))
+            d[:] = np.zeros(self.norbits, dtype=period_dtype)
+            d.flush()
+            del d
+
+        else:
+            # the grid may have grown since the cache was created
+            itemsize = np.dtype(period_dtype).itemsize
+            ncached = os.path.getsize(self.filename) // itemsize
+            if ncached < self.norbits:
+                logger.debug("Extending period cache {0} to {1} orbits"
+                             .format(self.filename, self.norbits))
+                with open(self.filename, 'r+b') as f:
+                    f.truncate(ncached*itemsize)
+                    f.seek(0, os.SEEK_END)
+                    f.write(np.zeros(self.norbits - ncached, dtype=period_dtype).tobytes())
+
+    @staticmethod
+    def make_key(potential_path, **params):
+        """
+        A hash of the contents of the potential file, the given parameters,
+        and the layout of the cache (``period_dtype``).
+        """
+        h = hashlib.sha1()
+        with open(potential_path, 'rb') as f:
+            h.update(f.read())
+        h.update(repr(np.dtype(period_dtype).descr).encode('utf-8'))
+
+        for k in sorted(params.keys()):
+            h.update("{0}={1!r};".format(k, params[k]).encode('utf-8'))
+
+        return h.hexdigest()[:16]
+
+    def read(self):
+        """
+        Read-only memmap of the period cache.
+        """
+        return np.memmap(self.filename, mode='r', dtype=period_dtype, shape=(self.norbits,))
+
+    def write(self, index, periods):
+        """
+        Store the periods of the orbit at the given index, a record with
+        dtype ``period_dtype``. Changes are written to disk by ``flush()``.
+        """
+        if self._memmap is None:
+            self._memmap = np.memmap(self.filename, mode='r+',
+                                     dtype=period_dtype, shape=(self.norbits,))
+        self._memmap[index] = periods
+
+    def flush(self):
+        if self._memmap is not None:
+            self._memmap.flush()
+
+    def close(self):
+        if self._memmap is not None:
+            self._memmap.flush()
+            del self._memmap
+            self._memmap = None
@@ -0,0 +1,242 @@
+# coding: utf-8
+
+""" Adaptive refinement of grids of initial conditions in the x-z plane. """
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+
+# Third-party
+import numpy as np
+from astropy import log as logger
+from scipy.spatial import cKDTree
+
+__all__ = ['tree_dtype', 'tree_filename', 'read_tree', 'refine_grid', 'refine_experiment']
+
+# for each orbit in a refined grid: the index of the orbit whose cell it was
+#   generated in (-1 for the initial grid), the generation (number of
+#   refinements), and the size of its cell in x and z
+tree_dtype = [('parent','i8'), ('generation','i4'), ('h','f8',(2,))]
+
+def tree_filename(w0_path):
+    """
+    Name of the file that stores the refinement tree for the grid of initial
+    conditions in the file ``w0_path``.
+    """
+    return "{0}_tree.npy".format(os.path.splitext(os.path.abspath(w0_path))[0])
+
+def _grid_spacing(w0):
+    """
+    The spacing of a regular grid of initial conditions in :math:`x` and
+    :math:`z`, e.g., from :func:`~streammorphology.initialconditions.tube_grid_xz`.
+    """
+    h = np.zeros(2)
+    for i,j in enumerate([0,2]):
+        dx = np.diff(np.unique(w0[:,j]))
+        dx = dx[dx > 1E-8*np.abs(w0[:,j]).max()]
+        if len(dx) == 0:
+            raise ValueError("Can't determine the grid spacing along axis {0}.".format(j))
+        h[i] = dx.min()
+    return h
+
+def _check_tree(tree, w0):
+    """
+    Raise a ``ValueError`` if the refinement tree doesn't describe the grid
+    of initial conditions ``w0``: the initial grid must have the stored cell
+    size and every refined orbit must sit at the center of a subcell of its
+    parent's cell.
+    """
+    if len(tree) != len(w0):
+        raise ValueError("Refinement tree has {0} orbits but the grid has {1}."
+                         .format(len(tree), len(w0)))
+
+    gen0 = tree['generation'] == 0
+    if np.any(tree['parent'][gen0] != -1) or \
+       not np.allclose(tree['h'][gen0], _grid_spacing(w0[gen0])):
+        raise ValueError("Initial grid doesn't match the refinement tree.")
+
+    ix = np.where(~gen0)[0]
+    parent = tree['parent'][ix]
+    if np.any((parent < 0) | (parent >= ix)):
+        raise ValueError("Invalid parent indices in refinement tree.")
+
+    h = tree['h'][parent]
+    dxz = np.abs(w0[ix][:,[0,2]] - w0[parent][:,[0,2]])
+    if np.any(tree['generation'][ix] != tree['generation'][parent] + 1) or \
+       not np.allclose(tree['h'][ix], 0.5*h) or not np.allclose(dxz, 0.25*h):
+        raise ValueError("Refined orbits don't match the refinement tree.")
+
+def read_tree(w0_path, w0=None):
+    """
+    Read the refinement tree for the grid of initial conditions in the file
+    ``w0_path``. If the grid has never been refined, this returns the tree of
+    the initial grid: every orbit has generation 0, no parent, and a cell
+    size equal to the grid spacing.
+
+    An existing tree is checked against the grid, and a ``ValueError`` is
+    raised if it doesn't match (e.g., the grid was regenerated but the old
+    tree file was kept).
+    """
+    if w0 is None:
+        w0 = np.load(w0_path)
+
+    filename = tree_filename(w0_path)
+    if os.path.exists(filename):
+        tree = np.load(filename)
+        try:
+            _check_tree(tree, w0)
+        except ValueError as e:
+            raise ValueError("{0} doesn't belong to the grid in {1}: {2} Delete it "
+                             "to start refining from the initial grid."
+                             .format(filename, w0_path, e))
+        return tree
+
+    tree = np.zeros(len(w0), dtype=tree_dtype)
+    tree['parent'] = -1
+    tree['h'] = _grid_spacing(w0)
+    return tree
+
+def refine_grid(w0, values, potential, tree, threshold, max_generation=4, max_new=None):
+    r"""
+    Generate new initial conditions in the cells of a grid in the :math:`x-z`
+    plane where the mapped quantity has structure. Each orbit sits at the
+    center of a rectangular cell. Cells that haven't already been refined
+    are compared to all neighboring cells (including ones that only share a
+    corner). If ``values`` differs from any neighbor by more than
+    ``threshold``, the cell is split into four. The new orbits are at the
+    centers of the four subcells and have the same energy as the parent
+    orbit. As for :func:`~streammorphology.initialconditions.tube_grid_xz`,
+    :math:`v_y` is solved for from the energy and :math:`v_x = v_z = 0`.
+    Subcells outside of the zero-velocity curve or outside of the
+    :math:`x,z > 0` quadrant are dropped.
+
+    Parameters
+    ----------
+    w0 : array_like
+        The initial conditions of the grid, shape ``(norbits,6)``.
+    values : array_like
+        The mapped quantity for each orbit (e.g., the log of the diffusion
+        time). Orbits with NaN values are never refined or compared.
+    potential : :class:`~gary.potential.Potential`
+        A :class:`~gary.potential.Potential` subclass instance.
+    tree : :class:`numpy.ndarray`
+        Refinement tree of the grid, with dtype ``tree_dtype`` (see
+        :func:`read_tree`).
+    threshold : numeric
+        Split cells that differ from a neighbor by more than this.
+    max_generation : int (optional)
+        Don't split cells that were generated by this many refinements.
+    max_new : int (optional)
+        Maximum number of new orbits. The cells with the largest differences
+        are split first, and a cell is only split if all of its new orbits
+        fit, so there may be fewer than ``max_new``.
+
+    Returns
+    -------
+    w0_new : :class:`numpy.ndarray`
+        The new initial conditions, shape ``(nnew,6)``.
+    tree_new : :class:`numpy.ndarray`
+        The refinement tree entries for the new orbits.
+    """
+    w0 = np.asarray(w0)
+    values = np.asarray(values)
+    if not np.all(w0[:,[1,3,5]] == 0.):
+        raise ValueError("Can only refine grids in the x-z plane with v_x = v_z = 0 "
+                         "(e.g., from tube_grid_xz()).")
+
+    # only cells that haven't already been split
+    is_leaf = np.ones(len(w0), dtype=bool)
+    is_leaf[tree['parent'][tree['parent'] >= 0]] = False
+    leaf = np.where(is_leaf & np.isfinite(values))[0]
+
+    xz = w0[leaf][:,[0,2]]
+    h = tree['h'][leaf]
+    v = values[leaf]
+
+    # pairs of cells that touch (at a side or a corner)
+    kdtree = cKDTree(xz)
+    pairs = np.array(sorted(kdtree.query_pairs(r=h.max()*(1+1E-8), p=np.inf)), dtype=int)
+    pairs = pairs.reshape(-1,2)
+    i,j = pairs.T
+    touch = np.all(np.abs(xz[i] - xz[j]) <= 0.5*(h[i] + h[j])*(1+1E-8), axis=1)
+    i,j = i[touch], j[touch]
+
+    # largest difference to any neighbor
+    dv = np.abs(v[i] - v[j])
+    score = np.zeros(len(leaf))
+    np.maximum.at(score, i, dv)
+    np.maximum.at(score, j, dv)
+
+    split = np.where((score > threshold) & (tree['generation'][leaf] < max_generation))[0]
+    split = split[np.argsort(-score[split], kind='mergesort')]
+    logger.debug("Splitting {0} of {1} cells".format(len(split), len(leaf)))
+
+    # four subcells per split cell
+    offsets = 0.25 * np.array([[-1.,-1], [-1,1], [1,-1], [1,1]])
+    parent = np.repeat(leaf[split], 4)
+    xz_new = w0[parent][:,[0,2]] + np.tile(offsets, (len(split),1))*tree['h'][parent]
+
+    xyz = np.zeros((len(parent),3))
+    xyz[:,0] = xz_new[:,0]
+    xyz[:,2] = xz_new[:,1]
+    E = potential.total_energy(w0[parent,:3].copy(), w0[parent,3:].copy())
+    dPhi = E - potential.value(xyz)
+    keep = (dPhi > 0) & (xyz[:,0] > 0) & (xyz[:,2] > 0)
+
+    if max_new is not None:
+        # only whole cells: a split cell is never revisited, so a partly
+        #   split cell would be left with holes
+        nkeep = keep.reshape(len(split),4).sum(axis=1)
+        keep &= np.repeat(np.cumsum(nkeep) <= max_new, 4)
+
+    w0_new = np.zeros((keep.sum(),6))
+    w0_new[:,:3] = xyz[keep]
+    w0_new[:,4] = np.sqrt(2*dPhi[keep])
+
+    tree_new = np.zeros(keep.sum(), dtype=tree_dtype)
+    tree_new['parent'] = parent[keep]
+    tree_new['generation'] = tree['generation'][parent[keep]] + 1
+    tree_new['h'] = 0.5 * tree['h'][parent[keep]]
+
+    return w0_new, tree_new
+
+def refine_experiment(experiment, threshold, max_generation=4, max_new=None):
+    """
+    Refine the grid of initial conditions of a completed experiment (e.g.,
+    :class:`~streammorphology.freqmap.Freqmap` or
+    :class:`~streammorphology.lyapunov.Lyapmap`) using the experiment's
+    ``map_value()``, see :func:`refine_grid`. The new orbits are appended to
+    the initial conditions file as a new generation, and the refinement tree
+    is saved next to it (see :func:`tree_filename`). Existing results are kept:
+    the cache files are padded with empty rows for the new orbits the next
+    time an experiment is run on the grid, so only the new orbits are run.
+
+    The experiment instance is stale afterwards -- create a new one to run
+    the new orbits.
+
+    Returns the number of new orbits.
+    """
+    import gary.potential as gp
+
+    potential = gp.load(os.path.join(experiment.cache_path,
+                                     experiment.config.potential_filename))
+    w0 = np.load(experiment.w0_path)
+    tree = read_tree(experiment.w0_path, w0)
+    values = experiment.map_value(experiment.read_cache())
+
+    w0_new,tree_new = refine_grid(w0, values, potential, tree, threshold=threshold,
+                                  max_generation=max_generation, max_new=max_new)
+    if len(w0_new) == 0:
+        logger.info("No cells to refine.")
+        return 0
+
+    logger.info("Adding {0} orbits (up to generation {1}) to the {2} orbits in {3}"
+                .format(len(w0_new), tree_new['generation'].max(), len(w0),
+                        experiment.w0_path))
+    np.save(experiment.w0_path, np.vstack((w0, w0_new)))
+    np.save(tree_filename(experiment.w0_path), np.concatenate((tree, tree_new)))
+
+    return len(w0_new)
@@ -0,0 +1,146 @@
+# coding: utf-8
+
+""" Utilities for splitting up and ordering the orbits sent to a pool. """
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import heapq
+
+# Third-party
+import numpy as np
+
+__all__ = ['guided_chunks', 'dynamical_time', 'longest_first', 'predict_makespan']
+
+def guided_chunks(indices, nworkers, max_chunk=None, min_chunk=1, factor=2,
+                  costs=None, max_cost=None):
+    """
+    Split an array of orbit indices into blocks to send to the workers using
+    guided self-scheduling: each block takes ``1/(factor*nworkers)`` of the
+    orbits that are left, so blocks start large (cheap to dispatch) and shrink
+    towards the end of the run (so no worker is left holding a big block when
+    everyone else is done).
+
+    If the predicted ``costs`` of the orbits are given, the blocks are sized
+    by their total cost instead of by the number of orbits: each block takes
+    ``1/(factor*nworkers)`` of the cost that is left.
+
+    Parameters
+    ----------
+    indices : array_like
+        The orbit indices to split up.
+    nworkers : int
+        Number of workers in the pool.
+    max_chunk : int (optional)
+        Maximum number of orbits in a block, e.g., set from the observed
+        time per orbit.
+    min_chunk : int (optional)
+        Minimum number of orbits in a block.
+    factor : numeric (optional)
+        Controls how quickly the block size decreases.
+    costs : array_like (optional)
+        Predicted cost of each orbit, in the same order as ``indices``.
+        Orbits with unknown (non-finite) cost are assumed to have the mean
+        cost.
+    max_cost : numeric (optional)
+        Maximum total cost of a block (only used with ``costs``), e.g., set
+        from the observed time per unit cost.
+
+    Returns
+    -------
+    chunks : list
+        A list of arrays of orbit indices.
+    """
+    indices = np.asarray(indices)
+    nworkers = max(int(nworkers), 1)
+    min_chunk = max(int(min_chunk), 1)
+
+    if costs is not None:
+        costs = np.asarray(costs, dtype=float)
+        if len(costs) != len(indices):
+            raise ValueError("Must have one cost per orbit.")
+        finite = np.isfinite(costs)
+        costs = np.where(finite, costs, costs[finite].mean() if np.any(finite) else 1.)
+        cumcost = np.cumsum(costs)
+
+    chunks = []
+    i = 0
+    n = len(indices)
+    while i < n:
+        if costs is None:
+            size = int(np.ceil((n - i) / (factor*nworkers)))
+        else:
+            done = cumcost[i-1] if i > 0 else 0.
+            target = (cumcost[-1] - done) / (factor*nworkers)
+            if max_cost is not None:
+                target = min(target, max_cost)
+
+            # largest block within the target cost
+            size = int(np.searchsorted(cumcost, done + target, side='right')) - i
+
+        if max_chunk is not None:
+            size = min(size, int(max_chunk))
+        size = max(size, min_chunk)
+
+        chunks.append(indices[i:i+size])
+        i += size
+
+    return chunks
+
+def dynamical_time(w0, potential):
+    r"""
+    A cheap estimate of the orbital time scale for each set of initial
+    conditions, :math:`t_{\rm dyn} = \sqrt{r / |\nabla \Phi|}`, which
+    only requires one (vectorized) evaluation of the potential gradient.
+
+    Parameters
+    ----------
+    w0 : array_like
+        Array of initial conditions with shape (norbits,6).
+    potential : :class:`~gary.potential.Potential`
+        The gravitational potential.
+
+    Returns
+    -------
+    t_dyn : :class:`numpy.ndarray`
+    """
+    w0 = np.atleast_2d(w0)
+    x = np.ascontiguousarray(w0[:,:3])
+    r = np.sqrt(np.sum(x**2, axis=-1))
+    acc = np.sqrt(np.sum(np.atleast_2d(potential.gradient(x))**2, axis=-1))
+    return np.sqrt(r / acc)
+
+def longest_first(costs):
+    """
+    Return the order in which to dispatch orbits so that the most expensive
+    orbits are run first (longest-processing-time-first scheduling). Orbits
+    with unknown (non-finite) cost go last.
+
+    Parameters
+    ----------
+    costs : array_like
+        Predicted cost of each orbit.
+    """
+    costs = np.asarray(costs, dtype=float)
+    costs = np.where(np.isfinite(costs), costs, -np.inf)
+    return np.argsort(-costs, kind='mergesort')
+
+def predict_makespan(costs, nworkers):
+    """
+    Predict the total wall time for running tasks with the given costs, in
+    the order given, on a pool with ``nworkers`` load-balanced workers: each
+    task goes to whichever worker frees up first.
+
+    Parameters
+    ----------
+    costs : array_like
+        Cost (e.g., run time) of each task, in dispatch order.
+    nworkers : int
+        Number of workers in the pool.
+    """
+    loads = [0.] * max(int(nworkers), 1)
+    for cost in costs:
+        heapq.heappush(loads, heapq.heappop(loads) + cost)
+    return max(loads)
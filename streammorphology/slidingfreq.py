@@ -0,0 +1,215 @@
+# coding: utf-8
+
+""" Incrementally track frequencies in a window sliding along a time series. """
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+from math import factorial
+
+# Third-party
+import numpy as np
+from astropy import log as logger
+
+__all__ = ['SlidingFrequencies']
+
+class SlidingFrequencies(object):
+    r"""
+    Follow a set of frequencies (e.g., the fundamental frequencies found by
+    SuperFreq in the first window) as a window slides along complex time
+    series, without redoing the frequency analysis in each window.
+
+    The frequency is the peak of the Hanning-filtered transform in the
+    window,
+
+    .. math::
+
+        F(\omega) = \sum_k \chi(t_k - t_c)\,f(t_k)\,e^{-i\omega t_k}
+
+    where :math:`\chi(\tau) \propto (1 + \cos(\pi\tau/T))^p`, :math:`t_c` is the
+    center, and :math:`T` is the half-width of the window. The filter is a sum
+    of :math:`2p+1` complex exponentials. The transform and its first two
+    derivatives with respect to :math:`\omega` at a fixed "anchor" frequency are
+    therefore linear combinations of plain sums over the window. When the
+    window slides, only the samples entering and leaving the window update
+    these sums. The peak is then found with a Newton step from the anchor. The
+    sums are only recomputed over the whole window if the frequency moves
+    more than ``anchor_tol`` (in units of :math:`1/T`) from the anchor.
+
+    The time series must be uniformly sampled.
+
+    Parameters
+    ----------
+    t : array_like
+        Times of the full time series.
+    fs : iterable
+        The complex time series, each with the same length as ``t``.
+    p : int (optional)
+        Exponent of the Hanning filter.
+    anchor_tol : numeric (optional)
+        Recompute the sums at a new anchor frequency once the frequency is
+        more than this many :math:`1/T` away from the anchor.
+    maxiter : int (optional)
+        Maximum number of Newton steps per frequency per window.
+    min_amp_ratio : numeric (optional)
+        The frequency is considered lost (e.g., the Newton steps ended up on
+        a side lobe) if its amplitude drops by more than this factor from one
+        window to the next.
+    """
+
+    def __init__(self, t, fs, p=1, anchor_tol=1E-4, maxiter=8, min_amp_ratio=0.5):
+        self.t = np.asarray(t)
+        self.fs = [np.asarray(f) for f in fs]
+        self.p = int(p)
+        self.anchor_tol = float(anchor_tol)
+        self.maxiter = int(maxiter)
+        self.min_amp_ratio = float(min_amp_ratio)
+
+        # measure time from the middle of the time series to keep the
+        #   moments small
+        self._tt = self.t - self.t[len(self.t)//2]
+
+        # coefficients of the exponentials in the filter
+        self._q = np.arange(-self.p, self.p+1)
+        self._coeff = np.array([factorial(self.p)**2 / (factorial(self.p+q)*factorial(self.p-q))
+                                for q in self._q])
+
+        self.window = None
+        self.nrecompute = 0
+        self.nslide = 0
+
+    @property
+    def tracking(self):
+        return self.window is not None
+
+    def _window_sums(self, f, nu, i1, i2):
+        r"""
+        The sums :math:`\sum t^m f e^{-i(\nu - q\pi/T)t}` for m=0,1,2 (with
+        the factors of -i from the derivatives) over samples i1 to i2.
+        """
+        tt = self._tt[i1:i2]
+        fe = f[i1:i2] * np.exp(-1j*np.outer(nu - self._q*np.pi/self.T, tt))
+        return np.array([fe.sum(axis=-1),
+                         (-1j*tt*fe).sum(axis=-1),
+                         (-tt**2*fe).sum(axis=-1)])
+
+    def _transform(self, j):
+        """
+        The transform and its first two derivatives at the anchor frequency
+        of frequency j, in the current window.
+        """
+        tc = self._tt[self.window[0]] + self.T
+        w = self._coeff * np.exp(-1j*self._q*np.pi*tc/self.T)
+        return self._sums[j].dot(w)
+
+    def _anchor(self, j, nu):
+        self._nu[j] = nu
+        self._sums[j] = self._window_sums(self.fs[self._ix[j]], nu, *self.window)
+        self.nrecompute += 1
+
+    def start(self, i1, i2, freqs):
+        """
+        Start tracking the given frequencies in the window of samples i1 to
+        i2. Each frequency is followed in the time series where it has the
+        largest amplitude.
+        """
+        tw = self.t[i1:i2]
+        self.T = 0.5 * (tw[-1] - tw[0])
+        self.window = (i1, i2)
+
+        # normalization of the filter
+        tau = tw - tw[0] - self.T
+        self._norm = self._coeff.dot(np.cos(np.outer(self._q*np.pi/self.T, tau))).sum()
+
+        # for each frequency, pick the time series and the sign of the
+        #   frequency with the largest amplitude
+        nfreqs = len(freqs)
+        self._ix = np.zeros(nfreqs, dtype=int)
+        self._sign = np.ones(nfreqs)
+        self._nu = np.zeros(nfreqs)
+        self._sums = np.zeros((nfreqs,3,len(self._q)), dtype=complex)
+        for j,freq in enumerate(freqs):
+            best = -np.inf
+            for k in range(len(self.fs)):
+                for sign in [1.,-1.]:
+                    self._ix[j] = k
+                    self._anchor(j, sign*freq)
+                    amp = np.abs(self._transform(j)[0])
+                    if amp > best:
+                        best = amp
+                        best_k, best_sign = k, sign
+            self._ix[j] = best_k
+            self._sign[j] = best_sign
+            self._anchor(j, best_sign*freq)
+        self._amps = np.array([np.abs(self._transform(j)[0]) for j in range(nfreqs)]) / self._norm
+
+    def stop(self):
+        self.window = None
+
+    def advance(self, i1, i2):
+        """
+        Slide the window to samples i1 to i2 (same length as the window passed
+        to ``start()``) and return the frequencies (with the sign convention of
+        the ones passed to ``start()``) and their amplitudes, or ``None`` if the
+        peak of any frequency was lost (tracking then stops).
+        """
+        j1, j2 = self.window
+        if (i2 - i1) != (j2 - j1):
+            raise ValueError("Window size can't change.")
+
+        nfreqs = len(self._nu)
+        if i1 >= j2 or i1 < j1:
+            # no overlap with the previous window
+            self.window = (i1, i2)
+            for j in range(nfreqs):
+                self._anchor(j, self._nu[j])
+        else:
+            # update sums for the samples leaving and entering the window
+            for j in range(nfreqs):
+                f = self.fs[self._ix[j]]
+                self._sums[j] -= self._window_sums(f, self._nu[j], j1, i1)
+                self._sums[j] += self._window_sums(f, self._nu[j], j2, i2)
+            self.window = (i1, i2)
+            self.nslide += 1
+
+        freqs = np.zeros(nfreqs)
+        amps = np.zeros(nfreqs)
+        for j in range(nfreqs):
+            for it in range(self.maxiter):
+                F, dF, d2F = self._transform(j)
+
+                # Newton step towards the maximum of |F|^2
+                g1 = 2*np.real(np.conj(F)*dF)
+                g2 = 2*(np.abs(dF)**2 + np.real(np.conj(F)*d2F))
+                if not g2 < 0:
+                    logger.debug("Lost the peak of frequency {0}".format(j))
+                    self.stop()
+                    return None
+                delta = -g1 / g2
+
+                if np.abs(delta)*self.T > 0.5*np.pi:
+                    logger.debug("Frequency {0} jumped by more than the width of the peak".format(j))
+                    self.stop()
+                    return None
+
+                elif np.abs(delta)*self.T <= self.anchor_tol:
+                    break
+
+                self._anchor(j, self._nu[j] + delta)
+
+            else:
+                self.stop()
+                return None
+
+            freqs[j] = self._sign[j] * (self._nu[j] + delta)
+            amps[j] = np.abs(F + dF*delta + 0.5*d2F*delta**2) / self._norm
+
+        if np.any(amps < self.min_amp_ratio*self._amps):
+            logger.debug("Amplitude dropped -- lost the peak")
+            self.stop()
+            return None
+        self._amps = amps
+
+        return freqs, amps
@@ -0,0 +1,51 @@
+# coding: utf-8
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Third-party
+import numpy as np
+
+# Project
+from ..batchfreq import batch_fundamental_frequencies
+
+def test_batch():
+    nsteps_per_period = 64
+    t = np.arange(100*nsteps_per_period+1) * 2*np.pi / nsteps_per_period
+
+    norbits = 16
+    rnd = np.random.RandomState(42)
+    true_freqs = np.vstack((rnd.uniform(0.9, 1.1, size=norbits),
+                            -rnd.uniform(0.7, 0.75, size=norbits),
+                            rnd.uniform(0.4, 0.45, size=norbits))).T
+    true_amps = np.array([1., 0.8, 0.5])
+
+    fs = np.zeros((norbits,3,len(t)), dtype=complex)
+    for i,(f1,f2,f3) in enumerate(true_freqs):
+        # the combination in the last component is stronger than its fundamental
+        fs[i,0] = np.exp(1j*f1*t) + 0.3*np.exp(1j*(f1+f2)*t + 0.2j)
+        fs[i,1] = 0.8*np.exp(1j*f2*t + 1.1j) + 0.2*np.exp(1j*(2*f2+f3)*t)
+        fs[i,2] = 0.5*np.exp(1j*f3*t) + 0.7*np.exp(1j*(f1+f2)*t + 0.5j)
+
+    freqs,amps = batch_fundamental_frequencies(t, fs, p=4)
+    assert freqs.shape == (norbits,3)
+    np.testing.assert_allclose(freqs, true_freqs, rtol=1E-9)
+    np.testing.assert_allclose(amps, np.tile(true_amps, (norbits,1)), rtol=1E-6)
+
+    # lower filter exponent -- more leakage between terms
+    freqs,amps = batch_fundamental_frequencies(t, fs, p=1)
+    np.testing.assert_allclose(freqs, true_freqs, rtol=1E-5)
+
+    # same result one orbit at a time
+    freqs,amps = batch_fundamental_frequencies(t, fs, p=4, max_size=1)
+    for i in [0,7]:
+        f,A = batch_fundamental_frequencies(t, fs[i:i+1], p=4)
+        np.testing.assert_allclose(f[0], freqs[i], rtol=1E-14)
+        np.testing.assert_allclose(A[0], amps[i], rtol=1E-14)
+
+    # no fundamental in a component that only has combinations
+    fs[:,2] = 0.7*np.exp(1j*(true_freqs[:,0]+true_freqs[:,1])[:,None]*t[None])
+    freqs,amps = batch_fundamental_frequencies(t, fs, p=4)
+    assert np.all(np.isnan(freqs[:,2]))
+    assert np.all(np.isfinite(freqs[:,:2]))
@@ -0,0 +1,109 @@
+# coding: utf-8
+
+""" Test the buffered cache writer """
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+import shutil
+
+# Third-party
+import numpy as np
+
+# Project
+from ..cachewriter import BufferedCacheWriter
+
+test_path = '/tmp/test-cachewriter'
+dtype = [('freqs','f8',(2,3)), ('success','b1'), ('error_code','i8')]
+norbits = 32
+
+def _make_cache():
+    if os.path.exists(test_path):
+        shutil.rmtree(test_path)
+    os.mkdir(test_path)
+
+    cache_file = os.path.join(test_path, 'test.npy')
+    d = np.memmap(cache_file, mode='w+', dtype=dtype, shape=(norbits,))
+    d[:] = np.zeros(norbits, dtype=dtype)
+    d.flush()
+    del d
+    return cache_file
+
+def _result(index):
+    return dict(index=index, freqs=np.ones((2,3))*index,
+                success=True, error_code=0)
+
+def test_buffered_write():
+    cache_file = _make_cache()
+
+    indices = np.random.permutation(norbits)[:24]
+    with BufferedCacheWriter(cache_file, dtype, norbits, buffer_size=10) as writer:
+        for i in indices:
+            writer.write(_result(i))
+        assert os.path.exists(writer.journal_file)
+
+    assert not os.path.exists(writer.journal_file)
+
+    d = np.memmap(cache_file, mode='r', dtype=dtype, shape=(norbits,))
+    for i in range(norbits):
+        if i in indices:
+            assert d['success'][i]
+            assert np.all(d['freqs'][i] == i)
+        else:
+            assert not d['success'][i]
+
+    shutil.rmtree(test_path)
+
+def test_error_result():
+    cache_file = _make_cache()
+
+    with BufferedCacheWriter(cache_file, dtype, norbits) as writer:
+        writer.write(dict(index=5, success=False, error_code=2))
+
+    d = np.memmap(cache_file, mode='r', dtype=dtype, shape=(norbits,))
+    assert not d['success'][5]
+    assert d['error_code'][5] == 2
+    del d
+
+    # columns that aren't in the result keep their values, whether the row
+    #   is already in the cache or still staged
+    with BufferedCacheWriter(cache_file, dtype, norbits, buffer_size=10) as writer:
+        writer.write(_result(7))
+        writer.flush()
+        writer.write(dict(index=7, error_code=3))
+
+        writer.write(_result(9))
+        writer.write(dict(index=9, error_code=4))
+
+    d = np.memmap(cache_file, mode='r', dtype=dtype, shape=(norbits,))
+    for i,code in [(7,3), (9,4)]:
+        assert np.all(d['freqs'][i] == i)
+        assert d['success'][i]
+        assert d['error_code'][i] == code
+
+    shutil.rmtree(test_path)
+
+def test_journal_recovery():
+    cache_file = _make_cache()
+
+    # simulate a crash: results are staged but never flushed
+    writer = BufferedCacheWriter(cache_file, dtype, norbits,
+                                 buffer_size=100, flush_interval=1E10)
+    for i in [3,4,5,11]:
+        writer.write(_result(i))
+    writer._journal.close()
+
+    d = np.memmap(cache_file, mode='r', dtype=dtype, shape=(norbits,))
+    assert d['success'].sum() == 0
+    del d
+
+    with BufferedCacheWriter(cache_file, dtype, norbits) as writer:
+        d = np.memmap(cache_file, mode='r', dtype=dtype, shape=(norbits,))
+        assert d['success'].sum() == 4
+        for i in [3,4,5,11]:
+            assert np.all(d['freqs'][i] == i)
+
+    shutil.rmtree(test_path)
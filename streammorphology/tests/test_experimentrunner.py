@@ -17,6 +17,7 @@ import pytest
 # Project
 from ..config import ConfigNamespace, save
 from ..experimentrunner import OrbitGridExperiment, ExperimentRunner
+from ..util import period_dtype
 
 class TestOrbitGridExperiment(object):
 
@@ -62,8 +63,9 @@ class TestOrbitGridExperiment(object):
 
         # nothing set
         with StupidExperiment(test_path, **test_defaults) as exp:
-            tmpdir = exp._tmpdir
-            assert os.path.exists(tmpdir)
+            journal_file = exp.journal_file
+            assert os.path.exists(exp.cache_file)
+            assert os.path.exists(journal_file)
             assert exp.config.test == 0.
 
         # --
@@ -76,11 +78,12 @@ class TestOrbitGridExperiment(object):
 
         # nothing set
         with StupidExperiment(test_path, **kwargy) as exp:
-            tmpdir = exp._tmpdir
-            assert os.path.exists(tmpdir)
+            journal_file = exp.journal_file
+            assert os.path.exists(exp.cache_file)
+            assert os.path.exists(journal_file)
             assert exp.config.test == 0.
 
-        assert not os.path.exists(tmpdir)
+        assert not os.path.exists(journal_file)
         shutil.rmtree(test_path)
 
         # ----------------------------------------------
@@ -117,11 +120,203 @@ class TestOrbitGridExperiment(object):
 
         with StupidExperiment2.from_config(test_path,
                                            config_filename='test.cfg') as exp:
-            tmpdir = exp._tmpdir
-            assert os.path.exists(tmpdir)
+            journal_file = exp.journal_file
+            assert os.path.exists(exp.cache_file)
+            assert os.path.exists(journal_file)
             assert exp.config.test == 0.
 
-        assert not os.path.exists(tmpdir)
+        assert not os.path.exists(journal_file)
+        shutil.rmtree(test_path)
+
+    def test_getstate(self):
+        test_path = '/tmp/stupid-experiment'
+        test_defaults = dict(
+            cache_filename='test.npy',
+            w0_filename='w0.npy',
+            potential_filename='potential.yml'
+        )
+
+        if not os.path.exists(test_path):
+            os.mkdir(test_path)
+        np.save(os.path.join(test_path, test_defaults['w0_filename']),
+                np.random.random(size=(128,6)))
+
+        class PickleExperiment(OrbitGridExperiment):
+            _run_kwargs = []
+            error_codes = dict()
+            cache_dtype = [('test', 'f8')]
+            config_defaults = test_defaults
+
+            @classmethod
+            def run(cls, w0, potential):
+                pass
+
+        # the writer and initial conditions shouldn't be sent to the workers
+        with PickleExperiment(test_path, **test_defaults) as exp:
+            state = exp.__getstate__()
+            assert exp._writer is not None
+            assert state['_writer'] is None
+            assert state['w0'] is None
+            assert state['norbits'] == exp.norbits
+
+        shutil.rmtree(test_path)
+
+    def test_history(self):
+        test_path = '/tmp/stupid-experiment'
+        test_defaults = dict(
+            cache_filename='test.npy',
+            w0_filename='w0.npy',
+            potential_filename='potential.yml'
+        )
+
+        if not os.path.exists(test_path):
+            os.mkdir(test_path)
+        np.save(os.path.join(test_path, test_defaults['w0_filename']),
+                np.random.random(size=(16,6)))
+
+        class HistoryExperiment(OrbitGridExperiment):
+            _run_kwargs = []
+            error_codes = dict()
+            cache_dtype = [('test', 'f8'), ('success', 'b1'), ('error_code', 'i8')]
+            history_dtype = [('t', 'f8', (8,)), ('x', 'f8', (8,))]
+            config_defaults = test_defaults
+
+            @classmethod
+            def run(cls, w0, potential):
+                pass
+
+        with HistoryExperiment(test_path, **test_defaults) as exp:
+            for i in [4,1,4]:
+                exp.callback(dict(index=i, test=1., success=True, error_code=0,
+                                  _history=dict(t=np.arange(8.), x=np.ones(8)*i)))
+
+        d = exp.read_cache()
+        assert d['success'].sum() == 2
+
+        # history doesn't end up in the cache, and the last result for an orbit wins
+        h = exp.read_history()
+        assert np.all(h['index'] == [1,4])
+        assert np.all(h['x'][1] == 4.)
+        assert np.all(h['t'][0] == np.arange(8.))
+
+        # overwriting removes the history
+        exp = HistoryExperiment(test_path, overwrite=True, **test_defaults)
+        assert len(exp.read_history()) == 0
+
+        shutil.rmtree(test_path)
+
+    def test_periods(self):
+        test_path = '/tmp/stupid-experiment'
+        test_defaults = dict(
+            cache_filename='test.npy',
+            w0_filename='w0.npy',
+            potential_filename='potential.yml'
+        )
+
+        if not os.path.exists(test_path):
+            os.mkdir(test_path)
+        w0_path = os.path.join(test_path, test_defaults['w0_filename'])
+        w0 = np.random.random(size=(16,6))
+        np.save(w0_path, w0)
+        with open(os.path.join(test_path, test_defaults['potential_filename']), 'w') as f:
+            f.write("type: LogarithmicPotential\n")
+
+        class PeriodExperiment(OrbitGridExperiment):
+            _run_kwargs = []
+            error_codes = dict()
+            cache_dtype = [('test', 'f8'), ('success', 'b1'), ('error_code', 'i8')]
+            config_defaults = test_defaults
+            cache_periods = True
+
+            @classmethod
+            def run(cls, w0, potential, **kwargs):
+                pass
+
+        class OtherExperiment(PeriodExperiment):
+            config_defaults = dict(test_defaults, cache_filename='other.npy')
+
+        periods = np.zeros(1, dtype=period_dtype)[0]
+        periods['T'] = [1., 2., 3.]
+        periods['w0'] = w0[5]
+        periods['success'] = True
+
+        with PeriodExperiment(test_path, **test_defaults) as exp:
+            assert os.path.dirname(exp.periods_file) == test_path
+            exp.callback(dict(index=5, test=1., success=True, error_code=0,
+                              _periods=periods))
+
+        # periods are shared with other experiments on the same grid
+        with OtherExperiment(test_path, **OtherExperiment.config_defaults) as exp2:
+            assert exp2.periods_file == exp.periods_file
+            state = dict(periods=exp2._periods.read(), w0=w0)
+            assert exp2._cached_periods(state, 4) is None
+            assert np.all(exp2._cached_periods(state, 5)['T'] == [1., 2., 3.])
+
+            # ...unless the grid has been regenerated
+            state['w0'] = np.random.random(size=(16,6))
+            assert exp2._cached_periods(state, 5) is None
+
+        # ...but not if the potential changes
+        with open(os.path.join(test_path, test_defaults['potential_filename']), 'w') as f:
+            f.write("type: NFWPotential\n")
+        exp3 = OtherExperiment(test_path, **OtherExperiment.config_defaults)
+        assert exp3.periods_file != exp.periods_file
+        assert exp3._periods.read()['success'].sum() == 0
+
+        shutil.rmtree(test_path)
+
+    def test_grow_grid(self):
+        test_path = '/tmp/stupid-experiment'
+        test_defaults = dict(
+            cache_filename='test.npy',
+            w0_filename='w0.npy',
+            potential_filename='potential.yml'
+        )
+
+        if not os.path.exists(test_path):
+            os.mkdir(test_path)
+        w0_path = os.path.join(test_path, test_defaults['w0_filename'])
+        np.save(w0_path, np.random.random(size=(16,6)))
+        with open(os.path.join(test_path, test_defaults['potential_filename']), 'w') as f:
+            f.write("type: LogarithmicPotential\n")
+
+        class GrowExperiment(OrbitGridExperiment):
+            _run_kwargs = []
+            error_codes = dict()
+            cache_dtype = [('test', 'f8'), ('success', 'b1'), ('error_code', 'i8')]
+            config_defaults = test_defaults
+            cache_periods = True
+
+            @classmethod
+            def run(cls, w0, potential, **kwargs):
+                pass
+
+        periods = np.zeros(1, dtype=period_dtype)[0]
+        periods['success'] = True
+
+        with GrowExperiment(test_path, **test_defaults) as exp:
+            exp.callback(dict(index=5, test=1., success=True, error_code=0,
+                              _periods=periods))
+
+        # append orbits to the grid (e.g., refine.py)
+        np.save(w0_path, np.vstack((np.load(w0_path), np.random.random(size=(8,6)))))
+
+        # cache files are padded, existing results are kept
+        with GrowExperiment(test_path, **test_defaults) as exp:
+            assert exp.norbits == 24
+            d = exp.read_cache()
+            assert len(d) == 24
+            assert d['success'].sum() == 1 and d['test'][5] == 1.
+
+            exp.callback(dict(index=20, test=2., success=True, error_code=0,
+                              _periods=periods))
+
+        d = exp.read_cache()
+        assert d['success'].sum() == 2 and d['test'][20] == 2.
+        p = exp._periods.read()
+        assert len(p) == 24
+        assert np.all(np.where(p['success'])[0] == [5,20])
+
         shutil.rmtree(test_path)
 
 class TestExperimentRunner(object):
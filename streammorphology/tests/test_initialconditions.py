@@ -14,7 +14,7 @@ import matplotlib.pyplot as plt
 # Project
 import gary.potential as gp
 from gary.units import galactic
-from ..initialconditions import tube_grid_xz, box_grid
+from ..initialconditions import tube_grid_xz, tube_grid_xz_zoom, box_grid, _zvc_distance
 
 plot_path = "output/tests/initialconditions"
 if not os.path.exists(plot_path):
@@ -35,6 +35,24 @@ def test_tube():
         plt.savefig(os.path.join(plot_path, "tube_E{:.2f}.png".format(E)))
         plt.clf()
 
+def test_zvc_distance():
+    E = -0.15
+    x0 = np.zeros((16,3))
+    x0[:,0] = np.linspace(0.1, 10., 16)
+    n = np.zeros_like(x0)
+    n[:,2] = 1.
+
+    s = _zvc_distance(E, potential, x0, n)
+    xyz = x0 + s[:,None]*n
+    np.testing.assert_allclose(potential.value(xyz), E)
+
+def test_tube_zoom():
+    E = -0.15
+    w0 = tube_grid_xz_zoom(E=E, potential=potential, nx=8, nz=4, bounds=[1.,10.,1.,5.])
+    assert w0.shape == (32,6)
+    Es = potential.total_energy(w0[:,:3], w0[:,3:])
+    np.testing.assert_allclose(Es, E)
+
 def test_box():
     from mpl_toolkits.mplot3d import Axes3D
 
@@ -0,0 +1,93 @@
+# coding: utf-8
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Standard library
+import os
+
+# Third-party
+import numpy as np
+
+# Project
+import gary.potential as gp
+from gary.units import galactic
+from ..initialconditions import tube_grid_xz
+from ..refine import read_tree, refine_grid, tree_filename
+
+potential = gp.LeeSutoTriaxialNFWPotential(v_c=0.22, r_s=30.,
+                                           a=1., b=1., c=0.8, units=galactic)
+
+def test_refine_grid():
+    E = -0.15
+    w0 = tube_grid_xz(E=E, potential=potential, dx=1., dz=1.)
+    tree = read_tree('/tmp/this-grid-was-never-refined.npy', w0)
+    assert np.all(tree['parent'] == -1)
+    assert np.allclose(tree['h'], 1.)
+
+    # a sharp boundary at R = 15
+    def f(w):
+        return (np.sqrt(w[:,0]**2 + w[:,2]**2) > 15.).astype(float)
+
+    for generation in range(1,4):
+        w0_new,tree_new = refine_grid(w0, f(w0), potential, tree, threshold=0.5)
+        assert len(w0_new) > 0
+        assert np.all(tree_new['generation'] == generation)
+        assert np.allclose(tree_new['h'], 0.5**generation)
+
+        # new orbits are on the same energy surface, in the parent's cell
+        Es = potential.total_energy(w0_new[:,:3], w0_new[:,3:])
+        np.testing.assert_allclose(Es, E)
+        parent = w0[tree_new['parent']]
+        assert np.all(np.abs(w0_new[:,[0,2]] - parent[:,[0,2]]) < 0.5*tree['h'][tree_new['parent']])
+
+        w0 = np.vstack((w0, w0_new))
+        tree = np.concatenate((tree, tree_new))
+
+    # refinement is concentrated at the boundary
+    R = np.sqrt(w0[:,0]**2 + w0[:,2]**2)
+    assert np.all(np.abs(R[tree['generation'] == 3] - 15.) < 1.)
+
+    # cap on the generation and number of new orbits
+    w0_new,tree_new = refine_grid(w0, f(w0), potential, tree, threshold=0.5, max_generation=3)
+    assert len(w0_new) == 0
+    w0_all,tree_all = refine_grid(w0, f(w0), potential, tree, threshold=0.5,
+                                  max_generation=4)
+    w0_new,tree_new = refine_grid(w0, f(w0), potential, tree, threshold=0.5,
+                                  max_generation=4, max_new=10)
+    assert 0 < len(w0_new) <= 10
+
+    # only whole cells are split
+    for p in np.unique(tree_new['parent']):
+        assert np.sum(tree_new['parent'] == p) == np.sum(tree_all['parent'] == p)
+
+def test_read_tree():
+    w0_path = '/tmp/stupid-refine-w0.npy'
+    w0 = tube_grid_xz(E=-0.15, potential=potential, dx=1., dz=1.)
+    tree = read_tree(w0_path, w0)
+
+    def f(w):
+        return (np.sqrt(w[:,0]**2 + w[:,2]**2) > 15.).astype(float)
+    w0_new,tree_new = refine_grid(w0, f(w0), potential, tree, threshold=0.5)
+    w0 = np.vstack((w0, w0_new))
+    tree = np.concatenate((tree, tree_new))
+    np.save(w0_path, w0)
+    np.save(tree_filename(w0_path), tree)
+
+    tree2 = read_tree(w0_path)
+    assert np.all(tree2 == tree)
+
+    # the grid was regenerated, but the old tree was kept
+    for w0_regen in [tube_grid_xz(E=-0.15, potential=potential, dx=0.5, dz=0.5),
+                     tube_grid_xz(E=-0.1, potential=potential, dx=1., dz=1.)[:len(w0)]]:
+        np.save(w0_path, w0_regen)
+        try:
+            read_tree(w0_path)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Stale refinement tree wasn't detected.")
+
+    os.remove(w0_path)
+    os.remove(tree_filename(w0_path))
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+""" Test the orbit scheduling utilities """
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Third-party
+import numpy as np
+
+# Project
+from ..scheduling import guided_chunks, longest_first, predict_makespan
+
+def test_guided_chunks():
+    indices = np.arange(10000)
+
+    for nworkers in [1, 16, 1024]:
+        chunks = guided_chunks(indices, nworkers)
+        np.testing.assert_equal(np.concatenate(chunks), indices)
+
+        # block sizes never increase, and end with single orbits
+        sizes = np.array(list(map(len, chunks)))
+        assert np.all(np.diff(sizes) <= 0)
+        assert sizes[-1] == 1
+
+def test_guided_chunks_max():
+    indices = np.arange(10000)
+    chunks = guided_chunks(indices, 4, max_chunk=50)
+    np.testing.assert_equal(np.concatenate(chunks), indices)
+    assert max(map(len, chunks)) == 50
+
+    assert guided_chunks(indices[:0], 4) == []
+
+def test_guided_chunks_costs():
+    # most expensive first, as from longest_first()
+    costs = np.sort(np.random.uniform(1., 100., size=10000))[::-1]
+    indices = np.arange(len(costs))
+
+    for nworkers in [1, 16, 1024]:
+        chunks = guided_chunks(indices, nworkers, costs=costs)
+        np.testing.assert_equal(np.concatenate(chunks), indices)
+
+        # each block takes at most 1/(2*nworkers) of the remaining cost (or a
+        #   single orbit), so expensive orbits go out in small blocks
+        remaining = costs.sum()
+        for c in chunks:
+            assert len(c) == 1 or costs[c].sum() <= remaining / (2*nworkers)
+            remaining -= costs[c].sum()
+
+        sizes = np.array(list(map(len, chunks)))
+        count_sizes = np.array(list(map(len, guided_chunks(indices, nworkers))))
+        assert sizes[0] < count_sizes[0]
+
+    chunks = guided_chunks(indices, 4, costs=costs, max_cost=500.)
+    np.testing.assert_equal(np.concatenate(chunks), indices)
+    assert max(costs[c].sum() for c in chunks) <= 500.
+
+    # unknown costs count as the mean cost
+    costs[-10:] = np.nan
+    chunks = guided_chunks(indices, 4, costs=costs)
+    np.testing.assert_equal(np.concatenate(chunks), indices)
+
+def test_longest_first():
+    costs = np.array([1., 5., np.nan, 3., 5.])
+    np.testing.assert_equal(longest_first(costs), [1, 4, 3, 0, 2])
+
+def test_predict_makespan():
+    assert predict_makespan([1.]*8, nworkers=4) == 2.
+    assert predict_makespan([4., 1., 1., 1., 1.], nworkers=2) == 4.
+
+    # one expensive task at the end leaves the other workers idle
+    costs = np.append(np.ones(100), 50.)
+    assert predict_makespan(costs, 10) > predict_makespan(costs[longest_first(costs)], 10)
@@ -0,0 +1,61 @@
+# coding: utf-8
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Third-party
+import numpy as np
+from scipy.optimize import brentq
+
+# Project
+from ..slidingfreq import SlidingFrequencies
+
+def _peak(t, f, freq, p):
+    """ Maximum of the filtered transform near freq, computed directly """
+    T = 0.5*(t[-1] - t[0])
+    tt = t - t[0] - T
+    chi = (1 + np.cos(np.pi*tt/T))**p
+
+    def dF2(w):
+        e = chi*f*np.exp(-1j*w*tt)
+        return np.real(np.conj(e.sum()) * np.sum(-1j*tt*e))
+
+    w = brentq(dF2, freq-0.05/T, freq+0.05/T, xtol=1E-15, rtol=1E-15)
+    return w, np.abs(np.sum(chi*f*np.exp(-1j*w*tt))) / chi.sum()
+
+def test_sliding():
+    freqs = np.array([1., -0.7320508, 0.4142136])
+
+    nsteps_per_period = 64
+    t = np.arange(192*nsteps_per_period) * 2*np.pi / nsteps_per_period
+
+    # first frequency drifts slowly
+    drift = 1 + 1E-5*np.sin(2*np.pi*t/t[-1])
+    phase = np.cumsum(drift) * (t[1] - t[0])
+    fs = [np.exp(1j*freqs[0]*phase) + 0.3*np.exp(1j*(freqs[0]+freqs[1])*t),
+          0.8*np.exp(1j*freqs[1]*t) + 0.2*np.exp(-1j*(2*freqs[1]+freqs[2])*t),
+          0.5*np.exp(1j*freqs[2]*t) + 0.1*np.exp(1j*freqs[0]*t)]
+
+    width = 128*nsteps_per_period
+    for p in [1,4]:
+        sf = SlidingFrequencies(t, fs, p=p)
+
+        # frequencies with the opposite sign convention are also followed
+        sf.start(0, width, -freqs)
+        nstart = sf.nrecompute
+        for i1 in range(0, len(t)-width, 4*nsteps_per_period):
+            f,A = sf.advance(i1, i1+width)
+            for j in range(3):
+                w,amp = _peak(t[i1:i1+width], fs[j][i1:i1+width], -f[j], p=p)
+                np.testing.assert_allclose(-f[j], w, rtol=1E-12)
+                np.testing.assert_allclose(A[j], amp, rtol=1E-12)
+
+        # only the drifting frequency ever needs the sums over the whole window
+        assert sf.nrecompute - nstart <= sf.nslide
+
+    # losing the peak stops tracking
+    sf = SlidingFrequencies(t, [np.exp(1j*t*(1 + 0.1*(t > t[-1]/4)))], p=1)
+    sf.start(0, width, [1.])
+    assert sf.advance(len(t)-width, len(t)) is None
+    assert not sf.tracking
@@ -0,0 +1,48 @@
+# coding: utf-8
+
+from __future__ import division, print_function
+
+__author__ = "adrn <adrn@astro.columbia.edu>"
+
+# Third-party
+from astropy import log as logger
+import gary.potential as gp
+from gary.units import galactic
+import numpy as np
+
+# Project
+from ..util import explore_orbit
+
+potential = gp.LogarithmicPotential(v_c=1., r_h=0.1, q1=1., q2=1., q3=0.8, units=galactic)
+w0 = np.array([1.,0.,0.5,0.,0.8,0.1])
+
+def test_explore_orbit():
+    t,w = explore_orbit(w0, potential, dt=0.1, explore_time=2000.)
+    assert w.shape == (len(t),1,6)
+    assert np.all(w[0,0] == w0)
+
+    E = potential.total_energy(w[:,0,:3].copy(), w[:,0,3:].copy())
+    assert np.abs((E[t <= 1000.][-1] - E[0]) / E[0]) < 1E-9
+
+def test_explore_orbit_energy_failure():
+    # energy can't be conserved this well, so the best attempt is returned
+    #   with a warning instead of failing
+    with logger.log_to_list() as log:
+        t,w = explore_orbit(w0, potential, dt=0.1, explore_time=2000.,
+                            dE_threshold=1E-30, max_tries=2)
+    assert np.all(np.isfinite(w))
+    assert any('Failed to conserve energy' in rec.message for rec in log)
+
+def test_explore_orbit_python_potential():
+    # a potential without a C implementation is integrated with gary
+    class PythonPotential(object):
+        def integrate_orbit(self, *args, **kwargs):
+            return potential.integrate_orbit(*args, **kwargs)
+
+        def total_energy(self, x, v):
+            return potential.total_energy(x, v)
+
+    t1,w1 = explore_orbit(w0, potential, dt=0.1, explore_time=500.)
+    t2,w2 = explore_orbit(w0, PythonPotential(), dt=0.1, explore_time=500.)
+    assert np.all(t1 == t2)
+    np.testing.assert_allclose(w2, w1, atol=1E-6)
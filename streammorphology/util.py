@@ -6,12 +6,30 @@ from __future__ import division, print_function
 
 __author__ = "adrn <adrn@astro.columbia.edu>"
 
+# Standard library
+from collections import OrderedDict
+
 # Third-party
 import numpy as np
+from astropy import log as logger
 import gary.dynamics as gd
 import gary.integrate as gi
 
-__all__ = ['_validate_nd_array', 'estimate_dt_nsteps']
+# Project
+from .scheduling import dynamical_time
+
+__all__ = ['_validate_nd_array', 'estimate_dt_nsteps', 'explore_orbit', 'extend_orbit',
+           'period_dtype', 'superfreq_context']
+
+# estimated periods of an orbit, as returned by estimate_dt_nsteps() and
+#   stored in the period cache (see periodcache.py)
+period_dtype = [
+    ('T','f8',(3,)), # peak-to-peak periods in (R,phi,z) for loops, (x,y,z) for boxes
+    ('T_r','f8'), # peak-to-peak period of the spherical radius
+    ('loop','b1'), # the orbit is a loop (tube) orbit
+    ('w0','f8',(6,)), # initial conditions the periods were estimated for
+    ('success','b1') # whether the periods have been estimated
+]
 
 def _validate_nd_array(x, expected_ndim):
     # ensure we have a 1D array of initial conditions
@@ -21,85 +39,321 @@ def _validate_nd_array(x, expected_ndim):
                          .format(expected_ndim, x.ndim))
     return x
 
-def _autodetermine_initial_dt(w0, potential, dE_threshold=1E-9):
-    if w0.ndim > 1:
-        raise ValueError("Only one set of initial conditions may be passed in at a time. (w0.ndim == 1)")
+def _orbit_periods(t, w):
+    """
+    Estimate the peak-to-peak periods of an orbit, ``w``, with shape
+    ``(ntimes,1,6)``. For loop orbits, the circulation is aligned with the z
+    axis and the periods are computed in cylindrical coordinates.
+
+    Returns the three periods, the period in spherical radius, and whether
+    the orbit is a loop orbit.
+    """
 
-    if dE_threshold is None:
-        return 1.
+    r = np.sqrt(np.sum(w[:,0,:3]**2, axis=-1))
+    T_r = gd.peak_to_peak_period(t, r)
+
+    # if loop, align circulation with Z and take R period
+    loop = gd.classify_orbit(w[:,0])
+    if np.any(loop):
+        w = gd.align_circulation_with_z(w[:,0], loop)
+
+        # convert to cylindrical coordinates
+        R = np.sqrt(w[:,0]**2 + w[:,1]**2)
+        phi = np.arctan2(w[:,1], w[:,0])
+        z = w[:,2]
+
+        T = np.array([gd.peak_to_peak_period(t, f) for f in [R, phi, z]])
+
+    else:
+        T = np.array([gd.peak_to_peak_period(t, f) for f in w.T[:3,0]])
 
-    dts = np.logspace(-3, 1, 8)[::-1]
-    _base_nsteps = 1000
+    return T, T_r, np.any(loop)
+
+def _integrate_dense(w0, potential, t, atol, rtol, nmax):
+    """
+    Integrate an orbit with error-controlled steps and return it at the
+    times ``t``, shape ``(ntimes,6)``. Raises a ``RuntimeError`` if the
+    integration fails.
+    """
+    if hasattr(potential, 'c_instance'):
+        from .extern.fast_integrate import dense_integrate
+
+        w,res,nfcn = dense_integrate(potential.c_instance, w0, t, atol, rtol, nmax)
+        if res < 0:
+            raise RuntimeError("Failed to integrate orbit (DOP853 returned {0})".format(res))
+        logger.debug("Exploratory integration took {0} force evaluations".format(nfcn))
+        return w
+
+    # no C implementation of the potential: slower, but the same integrator
+    _,w = potential.integrate_orbit(w0.copy(), t=t, Integrator=gi.DOPRI853Integrator,
+                                    Integrator_kwargs=dict(atol=atol, rtol=rtol, nsteps=nmax))
+    return w[:,0]
+
+def explore_orbit(w0, potential, dt, explore_time=10000., dE_threshold=1E-9,
+                  atol=1E-12, rtol=1E-12, max_tries=3):
+    """
+    Integrate an orbit once with error-controlled steps (i.e. the step size
+    is not limited by the output spacing), and use the dense output of the
+    integrator to sample the orbit with a fixed timestep, ``dt``.
+
+    If the fractional energy difference between the start of the orbit and
+    the last sample within the first 1000 time units is larger than
+    ``dE_threshold``, the integrator tolerances are tightened (assuming the
+    energy error scales with the tolerance) and the orbit is integrated
+    again, up to ``max_tries`` times. If energy still isn't conserved, the
+    attempt with the smallest energy error is returned with a warning.
+
+    Parameters
+    ----------
+    w0 : array_like
+        Initial conditions.
+    potential : :class:`~gary.potential.PotentialBase`
+        For a ``CPotential`` subclass, the orbit is integrated in C with dense
+        output. Otherwise, it is integrated with
+        :class:`~gary.integrate.DOPRI853Integrator`.
+    dt : numeric
+        Spacing of the output times.
+    explore_time : numeric (optional)
+        Total time to integrate for.
+    dE_threshold : numeric (optional)
+        Maximum fractional energy difference. Set to ``None`` to ignore this.
+    atol : numeric (optional)
+        Absolute tolerance of the (first) integration.
+    rtol : numeric (optional)
+        Relative tolerance of the (first) integration.
+    max_tries : int (optional)
+        Maximum number of integrations.
+
+    Returns
+    -------
+    t : :class:`numpy.ndarray`
+    w : :class:`numpy.ndarray`
+        The orbit, with shape ``(ntimes,1,6)``.
+    """
+    w0 = _validate_nd_array(w0, expected_ndim=1).astype(float)
+
+    nsamples = int(np.ceil(explore_time / dt))
+    t = dt * np.arange(nsamples+1, dtype=float)
+    nmax = 100*nsamples + 100000
+
+    # compare the energy at the start and at the last sample before t=1000
+    ix = np.array([0, max(np.searchsorted(t, 1000., side='right') - 1, 0)])
+
+    best_w = None
+    best_dE = np.inf
+    for i in range(max_tries):
+        w = _integrate_dense(w0, potential, t, atol, rtol, nmax)
+
+        if dE_threshold is None:
+            best_w = w
+            break
 
-    for dt in dts:
-        nsteps = int(round(_base_nsteps / dt))
-        t,w = potential.integrate_orbit(w0, dt=dt, nsteps=nsteps, Integrator=gi.DOPRI853Integrator)
-        Ei = potential.total_energy(w[0,0,:3], w[0,0,3:])
-        Ef = potential.total_energy(w[-1,0,:3], w[-1,0,3:])
-        dE = np.abs((Ef - Ei) / Ei)
+        E = potential.total_energy(w[ix,:3].copy(), w[ix,3:].copy())
+        dE = np.abs((E[1] - E[0]) / E[0])
+        if best_w is None or dE < best_dE:
+            best_w,best_dE = w,dE
 
         if dE < dE_threshold:
             break
 
-    return dt
+        scale = min(0.5 * dE_threshold / dE, 0.1)
+        atol = max(atol*scale, 1E-15)
+        rtol = max(rtol*scale, 1E-15)
+        logger.debug("∆E = {0:.2e} -- tightening tolerance to {1:.1e}".format(dE, rtol))
 
-def estimate_dt_nsteps(w0, potential, nperiods, nsteps_per_period, dE_threshold=1E-9, return_periods=False):
+    else:
+        logger.warning("Failed to conserve energy in exploratory integration "
+                       "(∆E = {0:.2e}) -- using the best attempt.".format(best_dE))
+
+    return t, best_w[:,None]
+
+def estimate_dt_nsteps(w0, potential, nperiods, nsteps_per_period, dE_threshold=1E-9,
+                       return_periods=False, return_orbit=False, explore_time=10000.,
+                       explore_nsteps_per_period=512, atol=1E-12, rtol=1E-12,
+                       max_nsamples=2**20, periods=None):
     """
     Estimate the timestep and number of steps to integrate for given a potential
     and set of initial conditions.
 
+    The orbit is integrated once, with error-controlled steps, for
+    ``explore_time`` (see :func:`explore_orbit`) and the periods are estimated
+    from the dense output of the integrator, sampled with
+    ``explore_nsteps_per_period`` samples per dynamical time. This sampling
+    doesn't depend on ``nsteps_per_period``, so the estimated periods are the
+    same for any experiment (and can be shared through the period cache).
+    With ``return_orbit=True``, the exploratory orbit is resampled at the
+    returned timestep so it can be reused as the start of the production
+    integration (see :func:`extend_orbit`). In this case, the timestep is
+    rounded down to a multiple of the sampling interval.
+
     Parameters
     ----------
     w0 : array_like
-    potential : :class:`~gary.potential.Potential`
+    potential : :class:`~gary.potential.CPotentialBase`
     nperiods : int
         Number of (max) periods to integrate.
     nsteps_per_period : int
         Number of steps to take per (max) orbital period.
     dE_threshold : numeric (optional)
-        Maximum fractional energy difference -- used to determine initial timestep.
+        Maximum fractional energy difference in the exploratory integration.
         Set to ``None`` to ignore this.
     return_periods : bool (optional)
-        Also return the estimated periods for the orbit.
+        Also return the estimated periods for the orbit, as a record with
+        dtype ``period_dtype``.
+    return_orbit : bool (optional)
+        Also return the exploratory orbit, sampled at the returned timestep,
+        and truncated to at most ``nsteps+1`` times. If the sampling of the
+        exploratory orbit is too coarse, or ``periods`` is given, only the
+        initial conditions are returned.
+    explore_time : numeric (optional)
+        Total time to integrate the exploratory orbit for.
+    explore_nsteps_per_period : int (optional)
+        Number of samples of the exploratory orbit per dynamical time.
+    atol : numeric (optional)
+        Absolute tolerance of the exploratory integration.
+    rtol : numeric (optional)
+        Relative tolerance of the exploratory integration.
+    max_nsamples : int (optional)
+        Maximum number of times to sample the exploratory orbit at, to limit
+        the memory used for long integrations.
+    periods : :class:`numpy.void` (optional)
+        The periods of this orbit from a previous call (e.g., from the period
+        cache), a record with dtype ``period_dtype``. If given, the orbit is
+        not integrated at all.
 
     """
 
-    # integrate orbit
-    dt = _autodetermine_initial_dt(w0, potential, dE_threshold=dE_threshold)
-    nsteps = int(round(10000 / dt))
-    t,w = potential.integrate_orbit(w0, dt=dt, nsteps=nsteps)
+    w0 = _validate_nd_array(w0, expected_ndim=1)
 
-    # if loop, align circulation with Z and take R period
-    loop = gd.classify_orbit(w[:,0])
-    if np.any(loop):
-        w = gd.align_circulation_with_z(w[:,0], loop)
+    if periods is None:
+        # sample the orbit with a fixed number of steps per dynamical time --
+        #   this is (almost always) shorter than the periods, so the orbit can
+        #   be resampled at the final timestep unless nsteps_per_period is larger
+        dt_sample = dynamical_time(w0, potential)[0] / float(explore_nsteps_per_period)
+        if not np.isfinite(dt_sample) or dt_sample <= 0.:
+            raise RuntimeError("Failed to estimate dynamical time.")
+        dt_sample = max(dt_sample, explore_time / float(max_nsamples))
 
-        # convert to cylindrical coordinates
-        R = np.sqrt(w[:,0]**2 + w[:,1]**2)
-        phi = np.arctan2(w[:,1], w[:,0])
-        z = w[:,2]
+        t,w = explore_orbit(w0, potential, dt_sample, explore_time=explore_time,
+                            dE_threshold=dE_threshold, atol=atol, rtol=rtol)
+        T,T_r,loop = _orbit_periods(t, w)
 
-        T = np.array([gd.peak_to_peak_period(t, f) for f in [R, phi, z]])
-
-    else:
-        T = np.array([gd.peak_to_peak_period(t, f) for f in w.T[:3,0]])
+        # timestep from number of steps per period
+        Tmax = T[np.isfinite(T)].max() if np.any(np.isfinite(T)) else np.nan
+        if np.isnan(Tmax):
+            raise RuntimeError("Failed to find period.")
 
-    # timestep from number of steps per period
-    Tmax = T.max()
-    if np.isnan(Tmax):
-        T = T[np.isfinite(T)]
-        Tmax = T.max()
+        periods = np.zeros(1, dtype=period_dtype)[0]
+        periods['T'] = T
+        periods['T_r'] = T_r
+        periods['loop'] = loop
+        periods['w0'] = w0
+        periods['success'] = True
 
-    if np.isnan(Tmax):
-        raise RuntimeError("Failed to find period.")
+    else:
+        dt_sample = None
+        T = periods['T']
+        Tmax = T[np.isfinite(T)].max()
 
     dt = float(Tmax) / float(nsteps_per_period)
+    every = int(dt / dt_sample) if dt_sample is not None else 0
+    if return_orbit and every >= 1:
+        dt = every * dt_sample
     nsteps = int(round(nperiods * Tmax / dt))
 
     if dt == 0.:
         raise ValueError("Timestep is zero!")
 
+    returns = [dt, nsteps]
     if return_periods:
-        return dt, nsteps, T
+        returns.append(periods)
+
+    if return_orbit:
+        if every >= 1:
+            t = t[::every][:nsteps+1]
+            w = w[::every][:nsteps+1]
+        else:
+            t = np.zeros(1)
+            w = np.array(w0, dtype=float)[None,None]
+        returns += [t, w]
+
+    return tuple(returns)
+
+def extend_orbit(t, w, potential, dt, nsteps, **kwargs):
+    """
+    Continue integrating an orbit, e.g., the exploratory orbit returned by
+    :func:`estimate_dt_nsteps`, from its last time until it has ``nsteps``
+    steps of size ``dt``. Any extra keyword arguments are passed to
+    ``potential.integrate_orbit()``.
+
+    Parameters
+    ----------
+    t : array_like
+        Times, spaced by ``dt``.
+    w : array_like
+        Orbit, with shape ``(len(t),1,6)``.
+    potential : :class:`~gary.potential.Potential`
+    dt : numeric
+    nsteps : int
+
+    Returns
+    -------
+    t : :class:`numpy.ndarray`
+    w : :class:`numpy.ndarray`
+        The orbit, with shape ``(nsteps+1,1,6)``.
+    """
+    t = np.asarray(t)
+    w = np.asarray(w)
+
+    nleft = nsteps + 1 - len(t)
+    if nleft <= 0:
+        return t[:nsteps+1], w[:nsteps+1]
+
+    t2,w2 = potential.integrate_orbit(w[-1,0].copy(), dt=dt, nsteps=nleft,
+                                      t1=t[-1], **kwargs)
+    return np.concatenate((t, t2[1:])), np.concatenate((w, w2[1:]))
+
+# SuperFreq instances shared by all time series with the same sampling, most
+#   recently used last -- see superfreq_context()
+_superfreq_cache = OrderedDict()
+
+def superfreq_context(t, p=1, maxsize=8):
+    """
+    Get a :class:`~superfreq.SuperFreq` instance for the times ``t`` and
+    Hanning filter exponent ``p``.
+
+    The setup of the frequency analysis (the filter, time normalization)
+    only depends on the number of samples, the sampling interval, and ``p``,
+    so for uniformly sampled times the instance is cached (per process) and
+    shared by all time series with the same sampling: all orbits of an
+    ensemble, both halves of a frequency map orbit, or all windows of a
+    frequency variance run. The shared instance measures time from the first
+    sample, which only changes the phases, not the frequencies or amplitudes.
+
+    Parameters
+    ----------
+    t : array_like
+        Array of times.
+    p : int (optional)
+        Exponent of the Hanning filter.
+    maxsize : int (optional)
+        Maximum number of instances to keep around.
+    """
+    from superfreq import SuperFreq
+
+    t = np.asarray(t)
+    dt = (t[-1] - t[0]) / (len(t) - 1)
+    if not np.allclose(np.diff(t), dt, rtol=1E-8, atol=0.):
+        # not uniformly sampled -- nothing to share
+        return SuperFreq(t, p=p)
+
+    key = (len(t), "{0:.12e}".format(dt), int(p))
+    if key in _superfreq_cache:
+        _superfreq_cache[key] = _superfreq_cache.pop(key)
     else:
-        return dt, nsteps
+        logger.debug("Setting up SuperFreq for {0} samples, dt={1}, p={2}".format(*key))
+        _superfreq_cache[key] = SuperFreq(t - t[0], p=p)
+        while len(_superfreq_cache) > maxsize:
+            _superfreq_cache.popitem(last=False)
+
+    return _superfreq_cache[key]